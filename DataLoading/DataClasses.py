@@ -5,10 +5,53 @@
 import configparser
 import logging
 import os
-import re
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 
 from DataLoading.AbstractClasses import AbstractAnnotation
+from DataLoading.SpanAlignment import assign_contained_labels
+from DataLoading.TokenLabels import TokenLabels
+from NERUtilities.RequestLogging import TRACE, count, observe
+
+
+class SpanIndex(object):
+    """
+    Start and end offsets of a list of (start, end) spans in document order (tokens, sentences), for O(log n)
+    character offset -> span index lookups with bisect
+    """
+    def __init__(self, source, spans):
+        '''
+        :param source: the list the spans were read from, used to tell when the index is out of date
+        :param spans: list of (start, end) character offsets, sorted and not overlapping
+        '''
+        self.source = source
+        self.size = len(source)
+        self.starts = [span[0] for span in spans]
+        self.ends = [span[1] for span in spans]
+
+    def is_current(self, source):
+        return source is self.source and len(source) == self.size
+
+    def index_at(self, offset):
+        '''
+        :return: index of the last span starting at or before offset (0 if there is none)
+        '''
+        return max(bisect_right(self.starts, offset) - 1, 0)
+
+    def index_containing(self, offset):
+        '''
+        :return: index of the first span with start <= offset <= end, or None
+        '''
+        i = bisect_left(self.ends, offset)
+        if i < len(self.starts) and self.starts[i] <= offset:
+            return i
+        return None
+
+    def range_starting_in(self, start, end):
+        '''
+        :return: (first, last + 1) indexes of the spans whose start offset is in [start, end)
+        '''
+        return bisect_left(self.starts, start), bisect_left(self.starts, end)
 
 
 class Document(object):
@@ -24,8 +67,10 @@ class Document(object):
         self.token_spans = list()
         self.tokens = list()
         self.sections = dict()
-        self.NER_token_labels = list()
+        self.NER_token_labels = TokenLabels([], [], [], [])
         self.negation_indexes = list()
+        self._token_index = None
+        self._sentence_index = None
 
         self.is_i2b2 = None
 
@@ -33,6 +78,24 @@ class Document(object):
         #self.color_config_dir = os.path.join(os.path.dirname(__file__), os.path.join("..", "NERResources","NER_Colors.ini"))
         #self.colors = self.set_color_config("concept_colors")
 
+    @property
+    def token_index(self):
+        '''
+        SpanIndex over token_spans, rebuilt whenever token_spans is replaced or extended
+        '''
+        if self._token_index is None or not self._token_index.is_current(self.token_spans):
+            self._token_index = SpanIndex(self.token_spans, self.token_spans)
+        return self._token_index
+
+    @property
+    def sentence_index(self):
+        '''
+        SpanIndex over the sentences' (span_start, span_end), rebuilt whenever sentences is replaced or extended
+        '''
+        if self._sentence_index is None or not self._sentence_index.is_current(self.sentences):
+            self._sentence_index = SpanIndex(self.sentences, [(s.span_start, s.span_end) for s in self.sentences])
+        return self._sentence_index
+
     def get_detected_section_names(self):
         '''
         Retrieve all the sections detected in this document
@@ -57,14 +120,14 @@ class Document(object):
                     section_tokens_list = list()
                     span_start = int(section_entry['start'])
                     span_end = int(section_entry['end'])
-                    # TODO: instead of iterating over list, do recursive binary search for index of start and end spans?
-                    for i, tok in enumerate(self.token_spans):
+                    # tokens whose start offset falls inside the section
+                    first, last = self.token_index.range_starting_in(span_start, span_end)
+                    for i in range(first, last):
                         token_level_data=list()
-                        if tok[0] >= span_start and tok[0] < span_end:
-                            token_level_data.append(self.tokens[i])
-                            #for list_tok_tups in self.NER_token_labels:
-                            token_level_data.append(self.NER_token_labels[i]['text'])
-                            section_tokens_list.append(token_level_data)
+                        token_level_data.append(self.tokens[i])
+                        #for list_tok_tups in self.NER_token_labels:
+                        token_level_data.append(self.NER_token_labels.texts[i])
+                        section_tokens_list.append(token_level_data)
                     section_tokens_list_dict[section].append(section_tokens_list)
         return section_tokens_list_dict
 
@@ -94,65 +157,45 @@ class Document(object):
         return self.crf_tags
 
     def _set_crf_training_vectors(self, gold_events, ctags):
-        tok_counter = 0
-        for tok in self.tokens:
-            for gold in gold_events:
-                curr_start = tok.idx
-                curr_end = tok.idx + len(tok)
-                if curr_start >= gold.start and curr_end <= gold.stop:
-                    ctags[tok_counter] = gold.label
-            tok_counter +=1
-        return ctags
+        token_spans = [(tok.idx, tok.idx + len(tok)) for tok in self.tokens]
+        return assign_contained_labels(token_spans, gold_events, ctags)
 
     def _set_crf_training_vectors_i2b2(self, gold_events, ctags):
-        tok_counter = 0
-        for sent in self.sentences:
-            for tok in sent.tokens:
-                for gold in gold_events:
-                    curr_start = tok.idx + sent.span_start
-                    curr_end = tok.idx + len(tok) + sent.span_start
-                    if curr_start >= gold.start and curr_end <= gold.stop:
-                        ctags[tok_counter] = gold.label
-                tok_counter += 1
-        return ctags
+        # i2b2 token offsets are relative to their sentence
+        token_spans = [(tok.idx + sent.span_start, tok.idx + len(tok) + sent.span_start)
+                       for sent in self.sentences for tok in sent.tokens]
+        return assign_contained_labels(token_spans, gold_events, ctags)
 
     def set_sections(self, list_of_section_dicts):
         self.sections = list_of_section_dicts
 
     def set_NER_predictions(self, probabilities,model_name):
-        # Expand tuple to have span as well as probability
-        final_result_dict = self._expand_result_dicts(self.tokens, probabilities)
-        self.NER_token_labels = final_result_dict
-
-    def _expand_result_dicts(self, tokenized_doc, probability):
-        final_class_and_span = list()
-        classified_text = list()
-        for idx, tok in enumerate(tokenized_doc):
-            # Retrieve top-scoring label and its marginal probability
-            maximum_label = max(probability[idx], key=probability[idx].get)
-            print (tok.orth_ + ':' + maximum_label)
-            maximum_prob = probability[idx][maximum_label]
-            classified_text.append((tok.orth_, maximum_label))
-
-            if re.match('^\s+$',
-                        tok.orth_) and maximum_label is not 'O':  # If a newline or series of newline chars got tagged, thats probably wrong...reset tag to 'O'
-                combined = {
-                    'text': tokenized_doc[idx].orth_,
-                    'label': 'O',
-                    'start': self.token_spans[idx][0],
-                    'stop' : self.token_spans[idx][1],
-                    'confidence' : 1.0
-                }
-            else:
-                combined= {
-                    'text': tokenized_doc[idx].orth_,
-                    'label': maximum_label,
-                    'start': self.token_spans[idx][0],
-                    'stop': self.token_spans[idx][1],
-                    'confidence' : maximum_prob
-                }
-            final_class_and_span.append(combined)
-        return final_class_and_span
+        # Retrieve top-scoring label and its marginal probability
+        labels = [max(marginals, key=marginals.get) for marginals in probabilities]
+        self.NER_token_labels = self._token_labels(
+            TokenLabels.from_labels([tok.orth_ for tok in self.tokens], self.token_spans, labels,
+                                    [marginals[label] for marginals, label in zip(probabilities, labels)]))
+
+    def set_NER_decoding(self, label_ids, confidences, classes):
+        '''
+        Sets predictions from a CRFDecoder decoding
+        :param label_ids: array of label indices into classes, one per token
+        :param confidences: array of the marginal probability of each token's label
+        :param classes: the model's label strings
+        '''
+        self.NER_token_labels = self._token_labels(
+            TokenLabels([tok.orth_ for tok in self.tokens], self.token_spans, label_ids, classes, confidences))
+
+    def _token_labels(self, token_labels):
+        if self.logger.isEnabledFor(TRACE):
+            for text, label in zip(token_labels.texts, token_labels.labels()):
+                self.logger.log(TRACE, "%s:%s", text, label)
+        # If a newline or series of newline chars got tagged, thats probably wrong...reset tag to 'O'
+        token_labels.reset_whitespace()
+        count("tokens", len(token_labels))
+        count("labelled_tokens", token_labels.labelled())
+        observe("document_tokens", len(token_labels))
+        return token_labels
 
     def doc2html(self):
         # define html tags and possible colors
@@ -2,10 +2,54 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import json
+
 from DataLoading.AbstractClasses import AbstractDataLoader
-from NERPreprocessing.DocumentPreprocessing import UnformattedDocumentPreprocessor
+from NERPreprocessing.DocumentPreprocessing import UnformattedDocumentPreprocessor, DEFAULT_BATCH_SIZE
 
 from DataLoading.DataClasses import Document
+from NERUtilities.RequestLogging import timed
+
+
+class MalformedNDJSON(ValueError):
+    """
+    An NDJSON input line that isn't a JSON object of {doc_id: text}
+    """
+    pass
+
+
+def iter_ndjson_batches(lines, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Reads newline-delimited JSON documents and groups them into batches. Each line is a JSON object of
+    {doc_id: doc_text} (usually a single document); blank lines are skipped. A document id already in the current batch
+    starts a new batch, so every document gets its own result line.
+    :param lines: iterable of str or bytes lines, e.g. a request stream
+    :param batch_size: maximum number of documents per batch
+    :return: generator of dict{doc_id:doc_text} batches, in input order
+    :raise MalformedNDJSON: at the first line that isn't a JSON object
+    '''
+    batch = dict()
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            documents = json.loads(line)
+        except ValueError:
+            raise MalformedNDJSON("Line " + str(line_number) + " is not valid JSON")
+        if not isinstance(documents, dict):
+            raise MalformedNDJSON("Line " + str(line_number) + " is not a JSON object of {doc_id: text}")
+        for doc_id, text in documents.items():
+            if doc_id in batch:
+                yield batch
+                batch = dict()
+            batch[doc_id] = text
+            if len(batch) >= batch_size:
+                yield batch
+                batch = dict()
+    if batch:
+        yield batch
 
 
 class JSONDataLoader(AbstractDataLoader):
@@ -25,16 +69,21 @@ class JSONDataLoader(AbstractDataLoader):
         self.logger.warning("The JSON data loader does not load annotations: It can only consume a list of document text in JSON format")
         raise NotImplementedError("The JSON data loader does not load annotations: It can only consume a list of document text in JSON format")
 
-    def preprocess(self, spacy_model):
+    def preprocess(self, spacy_model, batch_size=DEFAULT_BATCH_SIZE, n_process=1, cache_dir=None):
         '''
         Using attributes from self, loads documents from JSON into memory (dict{doc_id:doc_text, ...:...})
+        :param batch_size: number of documents spaCy parses per nlp.pipe() batch
+        :param n_process: number of processes spaCy parses with
+        :param cache_dir: preprocessing cache directory (defaults to $HUTCHNER_PREPROCESS_CACHE)
         :return: True if load() succeeded, False otherwise
         '''
         doc_objs = dict()
         for id, doc in self.documents.items():
             doc_objs[id] = Document(id, doc)
         #Run loaded documents through preprocessor to get sentence segmentation, indx alignment, etc
-        UnformattedDocumentPreprocessor(doc_objs, spacy_model=spacy_model)
+        with timed("preprocess"):
+            UnformattedDocumentPreprocessor(doc_objs, spacy_model=spacy_model, batch_size=batch_size,
+                                            n_process=n_process, cache_dir=cache_dir)
         self.documents = doc_objs
         self.logger.info("preprocessing: {} documents were preprocessed.".format(len(doc_objs)))
         return self.documents
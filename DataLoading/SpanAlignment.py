@@ -0,0 +1,66 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import heapq
+
+
+def _containing_spans_quadratic(token_spans, gold_spans):
+    containing = [None] * len(token_spans)
+    for t, (tok_start, tok_end) in enumerate(token_spans):
+        for g, (gold_start, gold_stop) in enumerate(gold_spans):
+            if tok_start >= gold_start and tok_end <= gold_stop:
+                containing[t] = g
+    return containing
+
+
+def containing_spans(token_spans, gold_spans):
+    '''
+    For every token, finds the gold span that contains it (gold start <= token start and token end <= gold stop).
+    When several gold spans contain a token the one latest in gold_spans wins, the same as assigning labels gold by
+    gold in list order.
+
+    Tokens are swept in start order while gold spans enter a heap, ordered by list position, once their start is
+    reached; a gold span whose stop is before the current token's end is discarded, which is final as long as token
+    ends don't decrease along the sweep (true of any tokenization). That makes this O((tokens + gold) log gold); the
+    rare inputs with nested tokens fall back to comparing every pair.
+    :param token_spans: list of (start, end) character offsets of the tokens
+    :param gold_spans: list of (start, stop) character offsets of the gold annotations
+    :return: list with, for each token, the index into gold_spans of its containing span, or None
+    '''
+    token_order = sorted(range(len(token_spans)), key=lambda t: token_spans[t])
+    for previous, current in zip(token_order, token_order[1:]):
+        if token_spans[current][1] < token_spans[previous][1]:
+            return _containing_spans_quadratic(token_spans, gold_spans)
+
+    gold_order = sorted(range(len(gold_spans)), key=lambda g: gold_spans[g][0])
+    containing = [None] * len(token_spans)
+    active = list()  # heap of (-list position, stop)
+    next_gold = 0
+    for t in token_order:
+        tok_start, tok_end = token_spans[t]
+        while next_gold < len(gold_order) and gold_spans[gold_order[next_gold]][0] <= tok_start:
+            g = gold_order[next_gold]
+            heapq.heappush(active, (-g, gold_spans[g][1]))
+            next_gold += 1
+        while active and active[0][1] < tok_end:
+            heapq.heappop(active)
+        if active:
+            containing[t] = -active[0][0]
+    return containing
+
+
+def assign_contained_labels(token_spans, gold_annotations, tags):
+    '''
+    Sets the tag of every token contained in a gold annotation to that annotation's label; other tags are left as
+    they are
+    :param token_spans: list of (start, end) character offsets of the tokens, in document coordinates
+    :param gold_annotations: list of GoldAnnotation (anything with start, stop and label)
+    :param tags: list of current tags, one per token; updated in place
+    :return: tags
+    '''
+    containing = containing_spans(token_spans, [(gold.start, gold.stop) for gold in gold_annotations])
+    for t, g in enumerate(containing):
+        if g is not None:
+            tags[t] = gold_annotations[g].label
+    return tags
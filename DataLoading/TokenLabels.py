@@ -0,0 +1,123 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import numpy as np
+
+OUTSIDE_LABEL = "O"
+
+# Negation codes in increasing order of certainty; a token keeps the highest code any trigger gave it
+NEGATION_LABELS = [None, "AMBIVALENT_EXISTENCE", "PROBABLE_NEGATED_EXISTENCE", "DEFINITE_NEGATED_EXISTENCE"]
+
+_vocabularies = dict()
+
+
+def intern_vocabulary(labels):
+    '''
+    :param labels: label strings, e.g. a model's classes
+    :return: a tuple of the labels, the same object for every equal list, so documents tagged by one model share it
+    '''
+    labels = tuple(labels)
+    return _vocabularies.setdefault(labels, labels)
+
+
+class TokenLabels(object):
+    """
+    A document's predicted token labels, stored column by column: the token texts, and parallel arrays of character
+    offsets, label ids into a shared label vocabulary, confidences (None when the tagger doesn't give any) and negation
+    codes (indexes into NEGATION_LABELS). The per-token dicts of the JSON response are only built by to_dicts().
+    """
+    __slots__ = ("texts", "starts", "stops", "label_ids", "vocabulary", "confidences", "negations", "outside")
+
+    def __init__(self, texts, spans, label_ids, vocabulary, confidences=None):
+        '''
+        :param texts: list of token strings
+        :param spans: list of (start, stop) character offsets, one per token
+        :param label_ids: array of indexes into vocabulary, one per token
+        :param vocabulary: list of distinct label strings
+        :param confidences: array of the probability of each token's label, or None
+        '''
+        assert len(texts) == len(spans) == len(label_ids)
+        if OUTSIDE_LABEL not in vocabulary:
+            vocabulary = list(vocabulary) + [OUTSIDE_LABEL]
+        self.vocabulary = intern_vocabulary(vocabulary)
+        self.outside = self.vocabulary.index(OUTSIDE_LABEL)
+        self.texts = texts
+        offsets = np.array(spans, dtype=np.int32).reshape(len(texts), 2)
+        self.starts = offsets[:, 0].copy()
+        self.stops = offsets[:, 1].copy()
+        self.label_ids = np.array(label_ids, dtype=np.int32)
+        self.confidences = None if confidences is None else np.array(confidences, dtype=np.float64)
+        self.negations = np.zeros(len(texts), dtype=np.int8)
+
+    @classmethod
+    def from_labels(cls, texts, spans, labels, confidences=None):
+        '''
+        :param labels: list of label strings, one per token
+        '''
+        vocabulary = sorted(set(labels))
+        ids = dict((label, i) for i, label in enumerate(vocabulary))
+        return cls(texts, spans, [ids[label] for label in labels], vocabulary, confidences)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def label(self, i):
+        return self.vocabulary[self.label_ids[i]]
+
+    def labels(self):
+        return [self.vocabulary[i] for i in self.label_ids.tolist()]
+
+    def is_outside(self, i):
+        return self.label_ids[i] == self.outside
+
+    def labelled(self):
+        '''
+        :return: number of tokens with a label other than O
+        '''
+        return int(np.count_nonzero(self.label_ids != self.outside))
+
+    def reset_whitespace(self):
+        '''
+        Relabels labelled whitespace tokens (newlines etc.) O with full confidence: a label on them is almost certainly
+        wrong
+        '''
+        relabel = np.array([text.isspace() for text in self.texts], dtype=bool) & (self.label_ids != self.outside)
+        if relabel.any():
+            self.label_ids[relabel] = self.outside
+            if self.confidences is not None:
+                self.confidences[relabel] = 1.0
+
+    def negate(self, i, code):
+        '''
+        Marks token i negated, unless a more certain negation already applies to it
+        :param code: index into NEGATION_LABELS
+        '''
+        if code > self.negations[i]:
+            self.negations[i] = code
+
+    def runs(self):
+        '''
+        :return: list of (label, first, last + 1) for each maximal run of tokens sharing a label, in document order
+        '''
+        if not len(self.label_ids):
+            return []
+        bounds = (np.flatnonzero(self.label_ids[1:] != self.label_ids[:-1]) + 1).tolist()
+        firsts = [0] + bounds
+        return [(self.vocabulary[self.label_ids[first]], first, last)
+                for first, last in zip(firsts, bounds + [len(self.label_ids)])]
+
+    def to_dicts(self):
+        '''
+        :return: the response's list of {"text", "label", "start", "stop"[, "confidence"][, "negation"]} token dicts
+        '''
+        columns = [self.texts, self.labels(), self.starts.tolist(), self.stops.tolist()]
+        if self.confidences is None:
+            dicts = [{"text": text, "label": label, "start": start, "stop": stop}
+                     for text, label, start, stop in zip(*columns)]
+        else:
+            dicts = [{"text": text, "label": label, "start": start, "stop": stop, "confidence": confidence}
+                     for text, label, start, stop, confidence in zip(*(columns + [self.confidences.tolist()]))]
+        for i in np.flatnonzero(self.negations).tolist():
+            dicts[i]["negation"] = NEGATION_LABELS[self.negations[i]]
+        return dicts
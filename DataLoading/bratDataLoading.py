@@ -113,12 +113,9 @@ class bratDataLoader(TextDataLoader):
     
 
     def _get_sent_idx(self, doc, start_offset, end_offset, text):
-        for sent in doc.sentences:
-            index = sent.sent_order_idx
-            offset_start = sent.span_start
-            offset_stop = sent.span_end
-            if start_offset >= sent.span_start:
-                if start_offset <= sent.span_end:
-                    return index
+        # first sentence whose span contains the annotation start
+        i = doc.sentence_index.index_containing(start_offset)
+        if i is not None:
+            return doc.sentences[i].sent_order_idx
         # default to skipping the annotation if it crosses sentence boundaries
         self.logger.error('ERROR: no sentence bounds found for ' + str(start_offset) + ' to ' + str(end_offset) + '  text: ' + doc.text[start_offset:end_offset])
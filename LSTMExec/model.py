@@ -12,7 +12,7 @@ import codecs
 import pickle
 
 from LSTMExec.utils import shared, set_values, get_name
-from LSTMExec.nn import HiddenLayer, EmbeddingLayer, DropoutLayer, LSTM, forward
+from LSTMExec.nn import HiddenLayer, EmbeddingLayer, DropoutLayer, LSTM, forward, forward_batch
 from LSTMExec.optimization import Optimization
 
 
@@ -99,18 +99,20 @@ class Model(object):
                 param_values = {name: param.get_value()}
             scipy.io.savemat(param_path, param_values)
 
-    def reload(self):
+    def reload(self, readonly=False):
         """
         Load components values from disk.
+        With readonly, parameters are stored as read-only arrays (for
+        inference only models shared between forked workers).
         """
         for name, param in self.components.items():
             param_path = os.path.join(self.model_path, "%s.mat" % name)
             param_values = scipy.io.loadmat(param_path)
             if hasattr(param, 'params'):
                 for p in param.params:
-                    set_values(p.name, p, param_values[p.name])
+                    set_values(p.name, p, param_values[p.name], readonly)
             else:
-                set_values(name, param, param_values[name])
+                set_values(name, param, param_values[name], readonly)
 
     def build(self,
               dropout,
@@ -402,3 +404,130 @@ class Model(object):
             )
 
         return f_train, f_eval
+
+    def build_batch(self,
+                    dropout,
+                    char_dim,
+                    char_bidirect,
+                    word_dim,
+                    word_lstm_dim,
+                    word_bidirect,
+                    crf,
+                    cap_dim,
+                    **kwargs
+                    ):
+        """
+        Build a batched evaluation function over the components created by
+        build(), which must be called first. Sentences are padded to the
+        same length; see utils.create_batch_input for the inputs.
+        Returns a function giving the best tag ids, shape (batch_size,
+        n_steps), with a CRF, or the tag scores, shape (batch_size, n_steps,
+        n_tags), without one.
+        """
+        n_tags = len(self.id_to_tag)
+        components = self.components
+
+        # Network variables
+        word_ids = T.imatrix(name='word_ids')
+        char_for_ids = T.imatrix(name='char_for_ids')
+        char_rev_ids = T.imatrix(name='char_rev_ids')
+        char_pos_ids = T.ivector(name='char_pos_ids')
+        cap_ids = T.imatrix(name='cap_ids')
+        rev_ids = T.ivector(name='rev_ids')
+        mask = T.imatrix(name='mask')
+
+        b_size = mask.shape[0]
+        s_len = mask.shape[1]
+        n_positions = b_size * s_len
+
+        inputs = []
+        if word_dim:
+            inputs.append(components['word_layer'].link(word_ids))
+        if char_dim:
+            # Characters of every (padded) word position of the batch, flattened
+            char_layer = components['char_layer']
+            char_lstm_for = components['char_lstm_for']
+            char_lstm_for.link(char_layer.link(char_for_ids), with_batch=True)
+            char_for_output = char_lstm_for.h.dimshuffle((1, 0, 2))[
+                T.arange(n_positions), char_pos_ids
+            ]
+            inputs.append(char_for_output.reshape(
+                (b_size, s_len, char_lstm_for.hidden_dim)))
+            if char_bidirect:
+                char_lstm_rev = components['char_lstm_rev']
+                char_lstm_rev.link(char_layer.link(char_rev_ids), with_batch=True)
+                char_rev_output = char_lstm_rev.h.dimshuffle((1, 0, 2))[
+                    T.arange(n_positions), char_pos_ids
+                ]
+                inputs.append(char_rev_output.reshape(
+                    (b_size, s_len, char_lstm_rev.hidden_dim)))
+        if cap_dim:
+            inputs.append(components['cap_layer'].link(cap_ids))
+
+        if len(inputs) != 1:
+            inputs = T.concatenate(inputs, axis=2)
+        else:
+            inputs = inputs[0]
+        if dropout:
+            inputs = (1 - dropout) * inputs
+        input_dim = inputs.shape[2]
+
+        # LSTM for words. The reverse LSTM reads each sentence backwards,
+        # with its padding still at the end: rev_ids maps every position to
+        # its mirror inside the sentence, and is its own inverse.
+        word_lstm_for = components['word_lstm_for']
+        word_lstm_for.link(inputs, with_batch=True)
+        word_for_output = word_lstm_for.h.dimshuffle((1, 0, 2))
+        if word_bidirect:
+            word_lstm_rev = components['word_lstm_rev']
+            flat_inputs = inputs.reshape((n_positions, input_dim))
+            word_lstm_rev.link(
+                flat_inputs[rev_ids].reshape((b_size, s_len, input_dim)),
+                with_batch=True
+            )
+            word_rev_output = word_lstm_rev.h.dimshuffle((1, 0, 2)).reshape(
+                (n_positions, word_lstm_dim))[rev_ids]
+            final_output = T.concatenate(
+                [word_for_output.reshape((n_positions, word_lstm_dim)),
+                 word_rev_output],
+                axis=1
+            )
+            final_output = components['tanh_layer'].link(final_output)
+        else:
+            final_output = word_for_output.reshape((n_positions, word_lstm_dim))
+
+        # Sentence to Named Entity tags - Score
+        tags_scores = components['final_layer'].link(final_output)
+        tags_scores = tags_scores.reshape((b_size, s_len, n_tags))
+
+        eval_inputs = []
+        if word_dim:
+            eval_inputs.append(word_ids)
+        if char_dim:
+            eval_inputs.append(char_for_ids)
+            if char_bidirect:
+                eval_inputs.append(char_rev_ids)
+            eval_inputs.append(char_pos_ids)
+        if cap_dim:
+            eval_inputs.append(cap_ids)
+        eval_inputs.extend([rev_ids, mask])
+
+        if not crf:
+            return theano.function(
+                inputs=eval_inputs,
+                outputs=tags_scores,
+                on_unused_input='ignore'
+            )
+        small = -1000
+        b_s = np.array([small] * n_tags + [0, small]).astype(np.float32)
+        e_s = np.array([small] * n_tags + [small, 0]).astype(np.float32)
+        observations = T.concatenate(
+            [tags_scores, small * T.ones((b_size, s_len, 2))],
+            axis=2
+        )
+        return theano.function(
+            inputs=eval_inputs,
+            outputs=forward_batch(observations, components['transitions'],
+                                  mask, T.constant(b_s), T.constant(e_s)),
+            on_unused_input='ignore'
+        )
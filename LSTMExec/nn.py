@@ -174,12 +174,18 @@ class LSTM(object):
                        self.b_i, self.b_c, self.b_o,  # self.b_f,
                        self.c_0, self.h_0]
 
-    def link(self, input):
+    def link(self, input, with_batch=None):
         """
         Propagate the input through the network and return the last hidden
         vector. The whole sequence is also accessible via self.h, but
         where self.h of shape (sequence_length, batch_size, output_dim)
+        with_batch overrides the mode the layer was created with, so the
+        same weights can be linked into both a single-sentence and a
+        batched graph.
         """
+        if with_batch is None:
+            with_batch = self.with_batch
+
         def recurrence(x_t, c_tm1, h_tm1):
             i_t = T.nnet.sigmoid(T.dot(x_t, self.w_xi) +
                                  T.dot(h_tm1, self.w_hi) +
@@ -199,7 +205,7 @@ class LSTM(object):
             return [c_t, h_t]
 
         # If we use batches, we have to permute the first and second dimension.
-        if self.with_batch:
+        if with_batch:
             self.input = input.dimshuffle(1, 0, 2)
             outputs_info = [T.alloc(x, self.input.shape[1], self.hidden_dim)
                             for x in [self.c_0, self.h_0]]
@@ -283,4 +289,63 @@ def forward(observations, transitions, viterbi=False,
         if viterbi:
             return alpha[-1].max(axis=0)
         else:
-            return log_sum_exp(alpha[-1], axis=0)
\ No newline at end of file
+            return log_sum_exp(alpha[-1], axis=0)
+
+
+def forward_batch(observations, transitions, mask, begin, end):
+    """
+    Batched Viterbi decoding over padded sentences.
+    Takes as input:
+        - observations, tensor of shape (batch_size, n_steps, n_classes),
+          the tag scores padded with the two begin/end columns
+        - transitions, matrix of shape (n_classes, n_classes)
+        - mask, matrix of shape (batch_size, n_steps), 1 for real tokens
+          and 0 for padding
+        - begin / end, vectors of shape (n_classes,), the scores of the
+          begin and end observations (b_s and e_s in Model.build)
+    Padded steps carry the previous scores forward unchanged and point
+    back to themselves, so every sentence is decoded exactly as `forward`
+    decodes it on its own.
+    Returns a matrix (batch_size, n_steps) with the best tag sequence of
+    each sentence; positions past a sentence's length repeat its last tag
+    and should be discarded.
+    """
+    n_classes = transitions.shape[0]
+    obs = observations.dimshuffle(1, 0, 2)
+    steps_mask = mask.dimshuffle(1, 0)
+
+    def recurrence(obs, m, previous, transitions):
+        scores = previous.dimshuffle(0, 1, 'x') + \
+            transitions.dimshuffle('x', 0, 1) + obs.dimshuffle(0, 'x', 1)
+        m = m.dimshuffle(0, 'x')
+        out = T.switch(m, scores.max(axis=1), previous)
+        out2 = T.switch(m, scores.argmax(axis=1),
+                        T.arange(n_classes).dimshuffle('x', 0))
+        return out, T.cast(out2, 'int32')
+
+    initial = T.zeros((obs.shape[1], n_classes)) + begin.dimshuffle('x', 0)
+    (alpha, beta), _ = theano.scan(
+        fn=recurrence,
+        outputs_info=(initial, None),
+        sequences=[obs, steps_mask],
+        non_sequences=transitions
+    )
+
+    # Transition into the end observation from the last real token
+    final = alpha[-1].dimshuffle(0, 1, 'x') + \
+        transitions.dimshuffle('x', 0, 1) + end.dimshuffle('x', 'x', 0)
+    final_beta = T.cast(final.argmax(axis=1), 'int32')
+    rows = T.arange(obs.shape[1])
+    last = final_beta[rows, T.argmax(final.max(axis=1), axis=1)]
+
+    # Follow the back pointers from the last step to the first
+    sequence, _ = theano.scan(
+        fn=lambda beta_i, following: beta_i[rows, following],
+        outputs_info=last,
+        sequences=beta[::-1]
+    )
+    # sequence[::-1] starts at the begin state, so drop it and append the last tag
+    sequence = T.concatenate(
+        [sequence[::-1][1:], last.dimshuffle('x', 0)], axis=0
+    )
+    return sequence.dimshuffle(1, 0)
@@ -4,42 +4,62 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import logging
 import os
 import time
 import optparse
 import numpy as np
 from LSTMExec.loader import prepare_sentence
-from LSTMExec.utils import create_input, iobes_iob, zero_digits
+from LSTMExec.utils import create_input, create_batch_input, iobes_iob, zero_digits
+from NERUtilities.RequestLogging import count
 
-def main(document_objs, model):
+logger = logging.getLogger(__name__)
+
+# Maximum number of sentences decoded per call of the batched evaluation function
+BATCH_SIZE = 64
+
+
+def main(document_objs, model, batch_size=BATCH_SIZE, prefilter=None, sentence_cache=None, model_name="lstm"):
     pred_tuples_by_doc_id = dict()
     start = time.time()
-    print ('Tagging...')
+    logger.debug('Tagging...')
 
     doc_count = 0
 
-    for id, doc in document_objs.items():
-        doc_count +=1
-        pred_tuples_by_doc_id[id]=tag_document(doc, model['parameters'], model['model'], model['f_eval'], model['word_to_id'], model['char_to_id'])
+    if model.get('f_eval_batch') is not None:
+        pred_tuples_by_doc_id = tag_documents_batched(document_objs, model['parameters'], model['model'],
+                                                      model['f_eval_batch'], model['word_to_id'],
+                                                      model['char_to_id'], batch_size, prefilter,
+                                                      sentence_cache, model_name)
+        doc_count = len(pred_tuples_by_doc_id)
+    else:
+        for id, doc in document_objs.items():
+            doc_count +=1
+            pred_tuples_by_doc_id[id]=tag_document(doc, model['parameters'], model['model'], model['f_eval'], model['word_to_id'], model['char_to_id'], prefilter, sentence_cache, model_name)
 
-    print ('---- %i documents tagged in %.4fs ----' % (doc_count, time.time() - start))
+    logger.info('---- %i documents tagged in %.4fs ----', doc_count, time.time() - start)
     return pred_tuples_by_doc_id
 
 
-def tag_document(doc, parameters, model, f_eval, word_to_id, char_to_id):
-    count = 0
+def tag_document(doc, parameters, model, f_eval, word_to_id, char_to_id, prefilter=None, sentence_cache=None,
+                 model_name="lstm"):
+    sentence_count = 0
     all_ypreds = list()
     all_tokens = list()
     for line in doc.sentences:
-        toks_text = [x.orth_ for x in line.tokens]
-        # line = ' '.join(toks_text)
-        if toks_text:  # WL edit: used to be 'if line', was crashing on '\n' lines
-            # Lowercase sentence
-            if parameters['lower']:
-                toks_text = [line.lower() for line in toks_text]
-            # Replace all digits with zeros
-            if parameters['zeros']:
-                toks_text = [zero_digits(line) for line in toks_text]
+        toks_text = _sentence_tokens(line, parameters)
+        rejected = toks_text and prefilter is not None and not prefilter.is_candidate(line.tokens)
+        # looked up after the prefilter, so rejected sentences don't count as cache misses
+        cached = sentence_cache.get(model_name, tuple(toks_text)) \
+            if toks_text and not rejected and sentence_cache is not None else None
+        if rejected:
+            all_ypreds.append(["O"] * len(toks_text))
+            all_tokens.append(toks_text)
+            count("prefiltered_sentences")
+        elif cached is not None:
+            all_ypreds.append(list(cached))
+            all_tokens.append(toks_text)
+        elif toks_text:  # WL edit: used to be 'if line', was crashing on '\n' lines
             # Prepare input
             sentence = prepare_sentence(toks_text, word_to_id, char_to_id,
                                             lower=parameters['lower'])
@@ -49,25 +69,108 @@ def tag_document(doc, parameters, model, f_eval, word_to_id, char_to_id):
                 y_preds = np.array(f_eval(*input))[1:-1]
             else:
                 y_preds = f_eval(*input).argmax(axis=1)
-            y_preds = [model.id_to_tag[y_pred] for y_pred in y_preds]
-            # Output tags in the IOB2 format
-            if parameters['tag_scheme'] == 'iobes':
-                y_preds = iobes_iob(y_preds)
+            y_preds = _ids_to_tags(y_preds, model, parameters)
             # Write tags
             assert len(y_preds) == len(toks_text)
-
-            # strip IOB prefixes
-            y_preds = [x.split('-')[-1] for x in y_preds]
+            if sentence_cache is not None:
+                sentence_cache.put(model_name, tuple(toks_text), tuple(y_preds))
 
             all_ypreds.append(y_preds)
             all_tokens.append(toks_text)
 
-        count += 1
-        if count % 100 == 0:
-            print (count)
+        sentence_count += 1
+        if sentence_count % 100 == 0:
+            logger.debug('%i sentences tagged', sentence_count)
+
+    count("tagged_sentences", sentence_count)
 
     return (all_ypreds,all_tokens)
 
+
+def tag_documents_batched(document_objs, parameters, model, f_eval_batch, word_to_id, char_to_id,
+                          batch_size=BATCH_SIZE, prefilter=None, sentence_cache=None, model_name="lstm"):
+    """
+    Tags the sentences of all documents together. Sentences are sorted by length and decoded batch_size at a
+    time, so each call of the batched evaluation function pads as little as possible. Sentences the prefilter
+    rejects are labelled O, and sentences in the sentence cache take their cached tags, without being decoded.
+    :return: dict of {doc_id: (all_ypreds, all_tokens)}, the same format tag_document returns for one document
+    """
+    sentences = list()
+    for doc_id, doc in document_objs.items():
+        for line in doc.sentences:
+            toks_text = _sentence_tokens(line, parameters)
+            if toks_text and prefilter is not None and not prefilter.is_candidate(line.tokens):
+                sentences.append((doc_id, toks_text, None))
+            elif toks_text:
+                sentences.append((doc_id, toks_text, prepare_sentence(toks_text, word_to_id, char_to_id,
+                                                                      lower=parameters['lower'])))
+
+    predictions = [None] * len(sentences)
+    for i, (_, toks_text, prepared) in enumerate(sentences):
+        if prepared is None:
+            predictions[i] = ["O"] * len(toks_text)
+    count("prefiltered_sentences", len(sentences) - predictions.count(None))
+    # a sentence repeated in the batch is decoded once; later copies take its tags
+    first_seen = dict()
+    duplicates = list()
+    for i, (_, toks_text, _) in enumerate(sentences):
+        if predictions[i] is not None:
+            continue
+        if sentence_cache is not None:
+            cached = sentence_cache.get(model_name, tuple(toks_text))
+            if cached is not None:
+                predictions[i] = list(cached)
+                continue
+        if tuple(toks_text) in first_seen:
+            duplicates.append((i, first_seen[tuple(toks_text)]))
+        else:
+            first_seen[tuple(toks_text)] = i
+    count("tagged_sentences", len(first_seen))
+    by_length = sorted(first_seen.values(), key=lambda i: len(sentences[i][1]))
+    for b in range(0, len(by_length), batch_size):
+        bucket = by_length[b:b + batch_size]
+        input, lengths = create_batch_input([sentences[i][2] for i in bucket], parameters)
+        output = f_eval_batch(*input)
+        for i, row, length in zip(bucket, output, lengths):
+            y_preds = row[:length] if parameters['crf'] else row[:length].argmax(axis=1)
+            predictions[i] = _ids_to_tags(y_preds, model, parameters)
+            if sentence_cache is not None:
+                sentence_cache.put(model_name, tuple(sentences[i][1]), tuple(predictions[i]))
+    for i, original in duplicates:
+        predictions[i] = list(predictions[original])
+
+    pred_tuples_by_doc_id = {doc_id: (list(), list()) for doc_id in document_objs}
+    for (doc_id, toks_text, _), y_preds in zip(sentences, predictions):
+        pred_tuples_by_doc_id[doc_id][0].append(y_preds)
+        pred_tuples_by_doc_id[doc_id][1].append(toks_text)
+    return pred_tuples_by_doc_id
+
+
+def _sentence_tokens(line, parameters):
+    """
+    Returns the token strings of a Sentence, lowercased and zeroed the way the model was trained
+    """
+    toks_text = [x.orth_ for x in line.tokens]
+    # Lowercase sentence
+    if parameters['lower']:
+        toks_text = [tok.lower() for tok in toks_text]
+    # Replace all digits with zeros
+    if parameters['zeros']:
+        toks_text = [zero_digits(tok) for tok in toks_text]
+    return toks_text
+
+
+def _ids_to_tags(y_preds, model, parameters):
+    """
+    Maps predicted tag ids to tag names, with IOB prefixes stripped
+    """
+    y_preds = [model.id_to_tag[y_pred] for y_pred in y_preds]
+    # Output tags in the IOB2 format
+    if parameters['tag_scheme'] == 'iobes':
+        y_preds = iobes_iob(y_preds)
+    # strip IOB prefixes
+    return [x.split('-')[-1] for x in y_preds]
+
 if __name__=="__main__":
     optparser = optparse.OptionParser()
     optparser.add_option(
@@ -30,20 +30,24 @@ def get_name(parameters):
     return "".join(i for i in name if i not in "\/:*?<>|")
 
 
-def set_values(name, param, pretrained):
+def set_values(name, param, pretrained, readonly=False):
     """
     Initialize a network parameter with pretrained values.
     We check that sizes are compatible.
+    If readonly, the shared variable keeps the loaded array itself, marked
+    read-only, so that forked processes never write to its pages.
     """
-    param_value = param.get_value()
+    param_value = param.get_value(borrow=True)
     if pretrained.size != param_value.size:
         raise Exception(
             "Size mismatch for parameter %s. Expected %i, found %i."
             % (name, param_value.size, pretrained.size)
         )
-    param.set_value(np.reshape(
-        pretrained, param_value.shape
-    ).astype(np.float32))
+    # cast straight to the variable's dtype so a borrowed value is kept as is
+    value = np.reshape(pretrained, param_value.shape).astype(np.float32).astype(param_value.dtype)
+    if readonly:
+        value.flags.writeable = False
+    param.set_value(value, borrow=readonly)
 
 
 def shared(shape, name):
@@ -221,6 +225,61 @@ def create_input(data, parameters, add_label, singletons=None):
     return input
 
 
+def create_batch_input(batch, parameters):
+    """
+    Take a list of sentence data (as returned by prepare_sentence) and
+    return an input for the batched evaluation function (Model.build_batch).
+    Sentences are padded to the longest one in the batch:
+        - word and cap ids, shape (batch_size, max_len)
+        - char ids of every padded word position, flattened to
+          (batch_size * max_len, max_word_len), and the index of the last
+          character of each position
+        - rev_ids, for each flattened position, the position of its mirror
+          inside its own sentence (padding maps to itself)
+        - mask, shape (batch_size, max_len), 1 for real tokens
+    """
+    lengths = [len(data['words']) for data in batch]
+    max_len = max(lengths)
+    max_chars = max([1] + [len(w) for data in batch for w in data['chars']])
+    n_positions = len(batch) * max_len
+
+    words = np.zeros((len(batch), max_len), dtype=np.int32)
+    caps = np.zeros((len(batch), max_len), dtype=np.int32)
+    mask = np.zeros((len(batch), max_len), dtype=np.int32)
+    char_for = np.zeros((n_positions, max_chars), dtype=np.int32)
+    char_rev = np.zeros((n_positions, max_chars), dtype=np.int32)
+    char_pos = np.zeros(n_positions, dtype=np.int32)
+    rev_ids = np.arange(n_positions, dtype=np.int32)
+    for i, data in enumerate(batch):
+        length = lengths[i]
+        offset = i * max_len
+        words[i, :length] = data['words']
+        mask[i, :length] = 1
+        if parameters['cap_dim']:
+            caps[i, :length] = data['caps']
+        rev_ids[offset:offset + length] = np.arange(offset + length - 1, offset - 1, -1)
+        # pad_word_chars points words without known characters at the last
+        # padded character of their own sentence; keep that behaviour here
+        sentence_chars = max([1] + [len(w) for w in data['chars']])
+        for j, word in enumerate(data['chars']):
+            char_for[offset + j, :len(word)] = word
+            char_rev[offset + j, :len(word)] = word[::-1]
+            char_pos[offset + j] = (len(word) or sentence_chars) - 1
+
+    input = []
+    if parameters['word_dim']:
+        input.append(words)
+    if parameters['char_dim']:
+        input.append(char_for)
+        if parameters['char_bidirect']:
+            input.append(char_rev)
+        input.append(char_pos)
+    if parameters['cap_dim']:
+        input.append(caps)
+    input.extend([rev_ids, mask])
+    return input, lengths
+
+
 def evaluate(parameters, f_eval, raw_sentences, parsed_sentences,
              id_to_tag, dictionary_tags):
     """
@@ -4,6 +4,8 @@
 #
 import os, io
 import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from functools import reduce
 
 from DataLoading.DataClasses import PredictedAnnotation
@@ -14,8 +16,8 @@ class NEREvaluator:
         print ("initializing evaluation parameters ...")
         self.tagged_documents = tagged_documents #self._dictify_document_list(tagged_documents)
         self.labels = labels
-        self.tp_fp_fn_counts_by_tag_exact = self._count_tp_fp_fn_exact(self.tagged_documents)
-        self.tp_fp_fn_counts_by_tag_overlap = self._count_tp_fp_fn_overlap(self.tagged_documents)
+        self.tp_fp_fn_counts_by_tag_exact, self.tp_fp_fn_counts_by_tag_overlap = \
+            self._count_tp_fp_fn(self.tagged_documents)
         self.precision_recall_f1_by_tag_exact = self._calculate_precision_recall_f1(self.tp_fp_fn_counts_by_tag_exact)
         self.precision_recall_f1_by_tag_overlap = self._calculate_precision_recall_f1(self.tp_fp_fn_counts_by_tag_overlap)
 
@@ -60,128 +62,92 @@ class NEREvaluator:
             p_r_f1_by_tag[tag] = (precision, recall, f1)
         return p_r_f1_by_tag
 
-    def _count_tp_fp_fn_exact(self, annotated_data):
-        tp_fp_fn_counts_by_tag = dict()
-        for label in self.labels:
-            tp_fp_fn_counts_by_tag[label] = dict()
-            tp_fp_fn_counts_by_tag[label]["tp"] = self._count_tp(annotated_data, label, "exact")
-            tp_fp_fn_counts_by_tag[label]["fp"] = self._count_fp(annotated_data, label, "exact")
-            tp_fp_fn_counts_by_tag[label]["fn"] = self._count_fn(annotated_data, label, "exact")
-        return tp_fp_fn_counts_by_tag
+    def _count_tp_fp_fn(self, annotated_data):
+        '''
+        Scores every label at both strictness levels in one pass: each document is chunked once, then its gold and
+        predicted spans are matched label by label
+        :return: (exact counts, overlap counts), each a dict of {label: {"tp", "fp", "fn"}}
+        '''
+        exact = dict((label, {"tp": 0, "fp": 0, "fn": 0}) for label in self.labels)
+        overlap = dict((label, {"tp": 0, "fp": 0, "fn": 0}) for label in self.labels)
+        for doc_id, doc in annotated_data.items():
+            predicted_by_label = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)
+            for label in self.labels:
+                gold_concepts = doc.concepts_gold[label] if label in doc.concepts_gold else []
+                predicted_concepts = predicted_by_label[label]
+                self._add_counts(exact[label], self._match_exact(gold_concepts, predicted_concepts))
+                self._add_counts(overlap[label], self._match_overlap(gold_concepts, predicted_concepts))
+        return exact, overlap
+
+    def _add_counts(self, counts, tp_fp_fn):
+        counts["tp"] += tp_fp_fn[0]
+        counts["fp"] += tp_fp_fn[1]
+        counts["fn"] += tp_fp_fn[2]
+
+    def _match_exact(self, gold_concepts, predicted_concepts):
+        '''
+        A gold and a predicted span match when their offsets are equal and the gold text is in the predicted text.
+        tp counts matching pairs, fp predicted spans without a match and fn gold spans without a match
+        :return: (tp, fp, fn)
+        '''
+        gold_by_span = defaultdict(list)
+        for g, gold in enumerate(gold_concepts):
+            gold_by_span[(gold.start, gold.stop)].append(g)
+        tp = fp = 0
+        matched_gold = set()
+        for predicted in predicted_concepts:
+            matches = [g for g in gold_by_span.get((predicted.start, predicted.stop), ())
+                       if gold_concepts[g].text in predicted.text]
+            tp += len(matches)
+            if not matches:
+                fp += 1
+            matched_gold.update(matches)
+        return tp, fp, len(gold_concepts) - len(matched_gold)
+
+    def _match_overlap(self, gold_concepts, predicted_concepts):
+        '''
+        A gold and a predicted span match when they overlap (offsets compared inclusively). tp counts matching pairs,
+        fp predicted spans without a match and fn gold spans without a match. Spans are sorted by start: a span
+        overlaps some span of the other side iff the largest stop among those starting no later than its own stop
+        reaches its start
+        :return: (tp, fp, fn)
+        '''
+        if not gold_concepts or not predicted_concepts:
+            return 0, len(predicted_concepts), len(gold_concepts)
+        gold_spans = sorted((gold.start, gold.stop) for gold in gold_concepts)
+        predicted_spans = sorted((predicted.start, predicted.stop) for predicted in predicted_concepts)
+        gold_starts, gold_max_stops = self._starts_and_prefix_max_stops(gold_spans)
+        predicted_starts, predicted_max_stops = self._starts_and_prefix_max_stops(predicted_spans)
 
-    def _count_tp_fp_fn_overlap(self, annotated_data):
-        tp_fp_fn_counts_by_tag = dict()
-        for label in self.labels:
-            tp_fp_fn_counts_by_tag[label] = dict()
-            tp_fp_fn_counts_by_tag[label]["tp"] = self._count_tp(annotated_data, label, "overlap")
-            tp_fp_fn_counts_by_tag[label]["fp"] = self._count_fp(annotated_data, label, "overlap")
-            tp_fp_fn_counts_by_tag[label]["fn"] = self._count_fn(annotated_data, label, "overlap")
-        return tp_fp_fn_counts_by_tag
-
-    def _count_tp(self, documents, label, strictness):
-        tp = 0
-        if strictness == "exact":
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for gold in gold_concepts:
-                    for predicted in predicted_concepts:
-                        if predicted.label == label and \
-                            gold.stop == predicted.stop and \
-                            gold.start == predicted.start and \
-                            gold.text in predicted.text:
-                            tp += 1
-        else:
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for gold in gold_concepts:
-                    for predicted in predicted_concepts:
-                        if predicted.label == label and \
-                            gold.start <= predicted.stop and  \
-                            predicted.start <= gold.stop:
-                            tp += 1
-        return tp
-
-    def _count_fp(self, documents, label, strictness):
         fp = 0
-        if strictness == "exact":
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for predicted in predicted_concepts:
-                    found = False
-                    for gold in gold_concepts:
-                        if predicted.label == label and \
-                            gold.stop == predicted.stop and \
-                            gold.start == predicted.start and \
-                            gold.text in predicted.text:
-                            found = True
-                    if not found:
-                        fp += 1
-        else:
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for predicted in predicted_concepts:
-                    found = False
-                    for gold in gold_concepts:
-                        if predicted.label == label and \
-                            gold.start <= predicted.stop and \
-                            predicted.start <= gold.stop:
-                            found = True
-                    if not found:
-                        fp += 1
-        return fp
-
-    def _count_fn(self, documents, label, strictness):
+        for start, stop in predicted_spans:
+            i = bisect_right(gold_starts, stop)
+            if i == 0 or gold_max_stops[i - 1] < start:
+                fp += 1
         fn = 0
-        if strictness == "exact":
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for gold in gold_concepts:
-                    found = False
-                    for predicted in predicted_concepts:
-                        if predicted.label == label and \
-                            gold.stop == predicted.stop and \
-                            gold.start == predicted.start and \
-                            gold.text in predicted.text:
-                            found = True
-                    if not found:
-                        fn +=1
+        for start, stop in gold_spans:
+            i = bisect_right(predicted_starts, stop)
+            if i == 0 or predicted_max_stops[i - 1] < start:
+                fn += 1
+
+        predicted_stops = [stop for _, stop in predicted_spans]
+        if predicted_stops == predicted_max_stops:
+            # predicted chunks don't nest, so both starts and stops are sorted and the pairs are counted by bisection
+            tp = 0
+            for start, stop in gold_spans:
+                hi = bisect_right(predicted_starts, stop)
+                tp += hi - bisect_left(predicted_stops, start, 0, hi)
         else:
-            for doc_id, doc in documents.items():
-                gold_concepts = []
-                predicted_concepts = []
-                if label in doc.concepts_gold:
-                    gold_concepts = doc.concepts_gold[label]
-                predicted_concepts = self.chunk_by_label(doc_id, doc.NER_token_labels, self.labels)[label]
-                for gold in gold_concepts:
-                    found = False
-                    for predicted in predicted_concepts:
-                        if predicted.label == label and \
-                            gold.start <= predicted.stop and \
-                            predicted.start <= gold.stop:
-                            found = True
-                    if not found:
-                        fn +=1
-        return fn
+            tp = sum(1 for g_start, g_stop in gold_spans for p_start, p_stop in predicted_spans
+                     if g_start <= p_stop and p_start <= g_stop)
+        return tp, fp, fn
+
+    def _starts_and_prefix_max_stops(self, spans):
+        starts = [start for start, _ in spans]
+        max_stops = list()
+        for _, stop in spans:
+            max_stops.append(stop if not max_stops or stop > max_stops[-1] else max_stops[-1])
+        return starts, max_stops
 
     def write_results(self, out_dir, strictness, model_name, string_timestamp):
         
@@ -224,47 +190,33 @@ class NEREvaluator:
 
 
     def chunk_by_label(self, doc_id, NER_token_labels, labels):
+        '''
+        Groups each maximal run of tokens sharing one of the given labels into a PredictedAnnotation
+        :param NER_token_labels: the document's TokenLabels
+        :return: dict of {label: [PredictedAnnotation, ...]} in document order
+        '''
         label_annot_dict = dict()
         # initialize dict with {key=label:value=list()}
         for label in labels:
             label_annot_dict[label] = list()
 
-        for label in labels:
-            i=0
-            while i < len(NER_token_labels):
-                chunk = list()
-                try:
-                    while NER_token_labels[i]['label'] == label:
-                        chunk.append(NER_token_labels[i])
-                        i +=1
-                except:
-                    print ("WARNING - passing on out of range index " + str(i) + \
-                        " in document " + str(doc_id) + ". Last token " + \
-                        str(NER_token_labels[i-1]) + " added to chunk " + str(chunk[-1].get('label', 'UNK')))
-                annotation = self.create_annot_from_chunk(chunk, label)
-                if annotation:
-                    label_annot_dict[label].append(annotation)
-                i += 1
+        for label, first, last in NER_token_labels.runs():
+            if label in label_annot_dict:
+                label_annot_dict[label].append(self.create_annot_from_chunk(NER_token_labels, first, last, label))
         return label_annot_dict
 
 
-    def create_annot_from_chunk(self, chunk, label):
-        if len(chunk)==0:
+    def create_annot_from_chunk(self, token_labels, first, last, label):
+        if last <= first:
             return None
 
-        global_begin =float('inf')
-        global_end = float('-inf')
-        full_string = ' '.join([x['text'] for x in chunk])
-        confidence = list()
-
-        for token in chunk:
-            if token['start'] <= global_begin:
-                global_begin=token['start']
-            if token['stop'] >= global_end:
-                global_end = token['stop']
-            confidence.append(token['confidence'])
-
-        confidence_avg = reduce(lambda x, y: x + y, confidence) / len(confidence) # calculate avg
+        full_string = ' '.join(token_labels.texts[first:last])
+        global_begin = int(token_labels.starts[first:last].min())
+        global_end = int(token_labels.stops[first:last].max())
+        confidence_avg = None
+        if token_labels.confidences is not None:
+            confidence = token_labels.confidences[first:last].tolist()
+            confidence_avg = reduce(lambda x, y: x + y, confidence) / len(confidence) # calculate avg
 
         return PredictedAnnotation(label,
                                    global_begin,
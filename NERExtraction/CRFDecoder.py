@@ -0,0 +1,198 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+import os
+import re
+import tempfile
+import threading
+import weakref
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger(__name__)
+
+# Number of documents decoded together; bounds the padded (documents x tokens x labels) work arrays
+DECODE_BATCH_SIZE = 32
+
+# Decoding of one document: the Viterbi label index of every token, the marginal probability of that label and the
+# full (tokens x labels) marginal matrix; indices are into CRFDecoder.classes
+CRFDecoding = namedtuple("CRFDecoding", ["label_ids", "confidences", "marginals"])
+
+_decoders = weakref.WeakKeyDictionary()
+_decoders_lock = threading.Lock()
+
+# One weight in crfsuite's model dump: "(type) attribute or label --> label: weight"
+_WEIGHT_RE = re.compile(r"\(\d+\) (.+) --> (.+): ([+-]?\d+\.\d+)$", re.DOTALL)
+
+
+def _read_weights(tagger):
+    '''
+    Reads the state-feature and transition weights out of crfsuite's text dump of a model. pycrfsuite's Tagger.info(),
+    and so sklearn_crfsuite's state_features_, parses the dump line by line and fails on attributes containing a
+    newline (the word features of whitespace tokens); here a weight may span several lines
+    :param tagger: pycrfsuite.Tagger with the model open
+    :return: (dict of (attribute, label) -> weight, dict of (label from, label to) -> weight)
+    '''
+    fd, path = tempfile.mkstemp(suffix=".dump")
+    os.close(fd)
+    try:
+        tagger.dump(path)
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().split("\n")
+    finally:
+        os.remove(path)
+    weights = {"STATE_FEATURES": dict(), "TRANSITIONS": dict()}
+    section, record = None, ""
+    for line in lines:
+        if not record and line.endswith(" = {"):
+            section = weights.get(line[:-len(" = {")])
+        elif not record and line == "}":
+            section = None
+        elif section is not None:
+            # records are indented by two spaces; lines after the first continue an attribute's text
+            record = record + "\n" + line if record else line[2:]
+            m = _WEIGHT_RE.match(record)
+            if m:
+                section[(m.group(1), m.group(2))] = float(m.group(3))
+                record = ""
+    return weights["STATE_FEATURES"], weights["TRANSITIONS"]
+
+
+def _logsumexp(a, axis):
+    peak = a.max(axis=axis)
+    return peak + np.log(np.exp(a - np.expand_dims(peak, axis)).sum(axis=axis))
+
+
+class CRFDecoder(object):
+    """
+    Linear-chain CRF inference in NumPy over the weights of a trained crfsuite model. The state-feature weights are
+    exported into an (attributes x labels) matrix and the transition weights into a (labels x labels) matrix; a
+    document's token scores are then one sparse product, and Viterbi and forward-backward run over a whole batch of
+    documents at a time, padded to the longest. Matches crfsuite's predict and predict_marginals up to floating point.
+    """
+    def __init__(self, classes, state_features, transition_features):
+        '''
+        :param classes: list of label strings
+        :param state_features: dict of (attribute, label) -> weight
+        :param transition_features: dict of (label from, label to) -> weight
+        '''
+        self.classes = list(classes)
+        label_ids = dict((label, i) for i, label in enumerate(self.classes))
+        self.attribute_ids = dict()
+        rows, cols, weights = list(), list(), list()
+        for (attribute, label), weight in state_features.items():
+            rows.append(self.attribute_ids.setdefault(attribute, len(self.attribute_ids)))
+            cols.append(label_ids[label])
+            weights.append(weight)
+        self.state_weights = np.zeros((len(self.attribute_ids), len(self.classes)))
+        self.state_weights[rows, cols] = weights
+        self.transitions = np.zeros((len(self.classes), len(self.classes)))
+        for (label_from, label_to), weight in transition_features.items():
+            self.transitions[label_ids[label_from], label_ids[label_to]] = weight
+        logger.debug("Exported %d attributes x %d labels of CRF weights", len(self.attribute_ids), len(self.classes))
+
+    @classmethod
+    def from_tagger(cls, tagger):
+        '''
+        :param tagger: pycrfsuite.Tagger with a model open
+        :return: CRFDecoder over the model's weights
+        '''
+        state_features, transition_features = _read_weights(tagger)
+        return cls(tagger.labels(), state_features, transition_features)
+
+    @classmethod
+    def for_model(cls, model):
+        '''
+        Returns the decoder of a fitted sklearn_crfsuite CRF, exporting its weights on first use
+        '''
+        with _decoders_lock:
+            decoder = _decoders.get(model)
+            if decoder is None:
+                decoder = _decoders[model] = cls.from_tagger(model.tagger_)
+            return decoder
+
+    def state_scores(self, feature_lists):
+        '''
+        :param feature_lists: list of feature string lists, one per token (sent2features output)
+        :return: (tokens x labels) array of summed state-feature weights; attributes unknown to the model score 0
+        '''
+        attribute_ids = self.attribute_ids
+        indptr, indices = [0], list()
+        for features in feature_lists:
+            for feature in features:
+                a = attribute_ids.get(feature)
+                if a is not None:
+                    indices.append(a)
+            indptr.append(len(indices))
+        counts = csr_matrix((np.ones(len(indices)), indices, indptr),
+                            shape=(len(feature_lists), len(attribute_ids)))
+        return np.asarray(counts.dot(self.state_weights))
+
+    def decode(self, feature_sequences):
+        '''
+        Decodes documents in batches of DECODE_BATCH_SIZE
+        :param feature_sequences: list of per-document feature lists
+        :return: list of CRFDecoding, one per document
+        '''
+        decodings = list()
+        for start in range(0, len(feature_sequences), DECODE_BATCH_SIZE):
+            batch = feature_sequences[start:start + DECODE_BATCH_SIZE]
+            decodings.extend(self.decode_scores([self.state_scores(features) for features in batch]))
+        return decodings
+
+    def decode_scores(self, scores):
+        '''
+        Runs Viterbi and forward-backward over a batch of documents
+        :param scores: list of (tokens x labels) state score arrays
+        :return: list of CRFDecoding
+        '''
+        n_labels = len(self.classes)
+        lengths = np.array([len(s) for s in scores], dtype=int)
+        n_docs, max_len = len(scores), (lengths.max() if len(scores) else 0)
+        if max_len == 0:
+            return [CRFDecoding(np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, n_labels))) for _ in scores]
+        padded = np.zeros((n_docs, max_len, n_labels))
+        for d, s in enumerate(scores):
+            padded[d, :len(s)] = s
+        # position t is real for a document while t < its length; padding carries scores through unchanged
+        active = (np.arange(max_len)[None, :] < lengths[:, None])[:, :, None]
+        transitions = self.transitions[None, :, :]
+
+        # Viterbi
+        best = padded[:, 0]
+        backpointers = np.zeros((n_docs, max_len, n_labels), dtype=int)
+        for t in range(1, max_len):
+            candidates = best[:, :, None] + transitions
+            backpointers[:, t] = candidates.argmax(axis=1)
+            best = np.where(active[:, t], candidates.max(axis=1) + padded[:, t], best)
+
+        # forward-backward in log space
+        alpha = np.zeros((n_docs, max_len, n_labels))
+        alpha[:, 0] = padded[:, 0]
+        for t in range(1, max_len):
+            step = _logsumexp(alpha[:, t - 1, :, None] + transitions, axis=1) + padded[:, t]
+            alpha[:, t] = np.where(active[:, t], step, alpha[:, t - 1])
+        beta = np.zeros((n_docs, max_len, n_labels))
+        for t in range(max_len - 2, -1, -1):
+            step = _logsumexp(transitions + (padded[:, t + 1] + beta[:, t + 1])[:, None, :], axis=2)
+            beta[:, t] = np.where(active[:, t + 1], step, 0.0)
+        log_z = _logsumexp(alpha[np.arange(n_docs), lengths - 1], axis=1)
+        marginals = np.exp(alpha + beta - log_z[:, None, None])
+
+        decodings = list()
+        for d in range(n_docs):
+            n = lengths[d]
+            if n == 0:
+                decodings.append(CRFDecoding(np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, n_labels))))
+                continue
+            path = np.zeros(n, dtype=int)
+            path[-1] = best[d].argmax()
+            for t in range(n - 1, 0, -1):
+                path[t - 1] = backpointers[d, t, path[t]]
+            doc_marginals = marginals[d, :n]
+            decodings.append(CRFDecoding(path, doc_marginals[np.arange(n), path], doc_marginals))
+        return decodings
@@ -3,32 +3,42 @@
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
 import json
+import logging
 import os
 from os.path import isfile, join
 
-import re
+import numpy as np
 from flask.json import jsonify
 from sklearn.externals import joblib
 
+from DataLoading.TokenLabels import TokenLabels
 from LSTMExec import predict_lstm
-from NERNegation.NegEx.HutchNegEx import HutchNegEx
 
+from NERExtraction.CRFDecoder import CRFDecoder, DECODE_BATCH_SIZE
 from NERExtraction.FeatureProcessing import sent2features
-from NERUtilities.Clusters import Clusters
+from NERExtraction.SentenceCache import crf_sentence_key
+from NERExtraction import ParallelExtraction
+from NERUtilities.RequestLogging import TRACE, count, observe, timed
+from NERUtilities.ResourceRegistry import registry
 
 
 class NERExtraction:
     """
     The object driving the clinical concept extraction testing pipeline
     """
-    def __init__(self, documents, model_name, algo_type):
+    def __init__(self, documents, model_name, algo_type, n_workers=1, prefilter=None, sentence_cache=None):
+        self.logger = logging.getLogger(__name__)
         self.model_name = model_name
         self.documents = documents
         self.algo_type = algo_type
-        self.clusters = Clusters(os.path.join(os.path.dirname(__file__),os.path.join("..",
-                                "NERResources","Cluster_Files",
-                                "MMC867k_FH255k.600.cbow.model.bin_k=800minibatch=False.kmeans")))
-        self.negexer = HutchNegEx()
+        self.n_workers = n_workers
+        # optional SentencePrefilter: sentences it rejects are labelled O without running the tagger
+        self.prefilter = prefilter
+        # shared across requests; loaded on first use
+        self.clusters = registry.get("clusters")
+        self.negexer = registry.get("negex")
+        # results of previously tagged sentences, shared across requests (None unless HUTCHNER_SENTENCE_CACHE_TOKENS)
+        self.sentence_cache = sentence_cache or registry.get("sentence_cache")
         self.possible_labels = []
         self.model_paths_by_concepts= None
         self.model_dir = None
@@ -38,39 +48,153 @@ class NERExtraction:
         Initiates concept extraction testing pipeline over all files in self.data_dir
         :return: list of Document objects where Document.predicted has been populated with CRF predictions
         """
+        count("documents", len(self.documents))
         if self.algo_type and self.algo_type == "lstm": # Use the LSTM model and decoder
             docs = self.documents
-            tags_and_toks_by_doc_id = predict_lstm.main(docs, models[self.model_name.lower()])
+            with timed("decode"):
+                tags_and_toks_by_doc_id = predict_lstm.main(docs, models[self.model_name.lower()],
+                                                            prefilter=self.prefilter,
+                                                            sentence_cache=self.sentence_cache,
+                                                            model_name=self.model_name.lower())
             docs = self._combine_docs_and_predictions(docs, tags_and_toks_by_doc_id)
-            print ("Finished LSTM classification")
+            self.logger.info("Finished LSTM classification")
             return docs
 
         else: # default to CRF model and decoder
             docs = self.documents
             self._extract(docs, models[self.model_name.lower()],  self.model_name.lower())
-            print("Finished CRF classification")
+            self.logger.info("Finished CRF classification")
             return docs
 
     def _extract(self, doc_objs_dict, model, model_name):
-        print ("Pulling out " + model_name + " information ...")
+        self.logger.info("Pulling out %s information ...", model_name)
         self.possible_labels = list(model.classes_)
         self.possible_labels.remove("O")
 
-        for i, current_doc in enumerate(doc_objs_dict.values()):
+        docs = list(doc_objs_dict.values())
+        segments = self._segments(docs)
+        token_lists = [docs[d].tokens[first:last] for d, first, last in segments]
+        if self.sentence_cache is not None:
+            decodings = self._decode_cached(token_lists, model, model_name)
+        else:
+            decodings = self._decode_any(token_lists, model, model_name)
+        self._set_decodings(docs, segments, decodings, list(model.classes_))
+
+    def _decode_any(self, token_lists, model, model_name):
+        if self.n_workers and self.n_workers > 1:
+            return self._decode_parallel(token_lists, model, model_name)
+        return self._decode(token_lists, model)
+
+    def _decode_cached(self, token_lists, model, model_name):
+        """
+        Takes the decodings of sentences seen before from the sentence cache and decodes the rest once per distinct
+        sentence
+        """
+        keys = [crf_sentence_key(tokens) for tokens in token_lists]
+        decodings = [self.sentence_cache.get(model_name, key) for key in keys]
+        missing = dict()  # key -> positions still to decode
+        for i, decoding in enumerate(decodings):
+            if decoding is None:
+                missing.setdefault(keys[i], list()).append(i)
+        positions = list(missing.values())
+        decoded = self._decode_any([token_lists[p[0]] for p in positions], model, model_name)
+        for p, decoding in zip(positions, decoded):
+            self.sentence_cache.put(model_name, keys[p[0]], decoding)
+            for i in p:
+                decodings[i] = decoding
+        return decodings
+
+    def _segments(self, docs):
+        """
+        The token ranges to tag: whole documents, or sentences when results are cached per sentence, and only the
+        candidate sentences when a prefilter is set
+        :return: list of (document position, first token, last token + 1)
+        """
+        if self.prefilter is None and self.sentence_cache is not None:
+            return [(d, first, last) for d, doc in enumerate(docs) for first, last in self._sentence_ranges(doc)]
+        if self.prefilter is None:
+            return [(d, 0, len(doc.tokens)) for d, doc in enumerate(docs)]
+        segments = list()
+        sentences = 0  # non-empty ones only, as candidate_ranges never returns empty sentences
+        for d, doc in enumerate(docs):
+            for sentence in doc.sentences:
+                first, last = doc.token_index.range_starting_in(sentence.span_start, sentence.span_end)
+                if first < last:
+                    sentences += 1
+            segments.extend((d, first, last) for first, last in self.prefilter.candidate_ranges(doc))
+        count("prefiltered_sentences", sentences - len(segments))
+        return segments
+
+    def _sentence_ranges(self, doc):
+        """
+        :return: list of (first, last + 1) token ranges of the document's sentences, plus any tokens between them
+        """
+        ranges = list()
+        previous = 0
+        for sentence in doc.sentences:
+            first, last = doc.token_index.range_starting_in(sentence.span_start, sentence.span_end)
+            if first > previous:
+                ranges.append((previous, first))
+            if last > max(first, previous):
+                ranges.append((max(first, previous), last))
+                previous = last
+        if previous < len(doc.tokens):
+            ranges.append((previous, len(doc.tokens)))
+        return ranges
+
+    def _decode(self, token_lists, model):
+        """
+        Viterbi labels and marginal confidences, decoded in NumPy from the model's exported weights
+        :return: list of (label index array, confidence array), one per token list
+        """
+        decoder = CRFDecoder.for_model(model)
+        decodings = list()
+        for start in range(0, len(token_lists), DECODE_BATCH_SIZE):
             # generate feature vectors
-            feature_vectors = sent2features(current_doc.tokens, clusters=self.clusters)
-            # Predict type sequence
+            with timed("featurize"):
+                batch = [sent2features(tokens, clusters=self.clusters)
+                         for tokens in token_lists[start:start + DECODE_BATCH_SIZE]]
+            with timed("decode"):
+                decodings.extend((decoding.label_ids, decoding.confidences) for decoding in decoder.decode(batch))
+        return decodings
 
-            result_probabilities = model.predict_marginals_single(feature_vectors)
+    def _decode_parallel(self, token_lists, model, model_name):
+        """
+        Shards token lists across a pool of worker processes, each holding its own copy of the model and clusters,
+        and returns their decodings in order. The workers featurize too, so it is all timed as decoding
+        """
+        with timed("decode"):
+            pool = ParallelExtraction.get_pool(model_name, model, self.clusters.cluster_dir, self.n_workers)
+            try:
+                return pool.tag(token_lists)
+            except ValueError:
+                if not pool.closed:
+                    raise
+                # the model was evicted (and its pool closed) after this request took it: start a pool again
+                pool = ParallelExtraction.get_pool(model_name, model, self.clusters.cluster_dir, self.n_workers)
+                return pool.tag(token_lists)
+
+    def _set_decodings(self, docs, segments, decodings, classes):
+        """
+        Sets each document's predictions; tokens outside the decoded segments are labelled O
+        """
+        outside = classes.index("O")
+        label_ids = [np.full(len(doc.tokens), outside, dtype=int) for doc in docs]
+        confidences = [np.ones(len(doc.tokens)) for doc in docs]
+        for (d, first, last), (segment_labels, segment_confidences) in zip(segments, decodings):
+            label_ids[d][first:last] = segment_labels
+            confidences[d][first:last] = segment_confidences
+        for current_doc, doc_label_ids, doc_confidences in zip(docs, label_ids, confidences):
             # Set prediction in document object
-            current_doc.set_NER_predictions(result_probabilities, model_name)
+            current_doc.set_NER_decoding(doc_label_ids, doc_confidences, classes)
 
     def _print_marginal_sequences(self, tagger, predictions, label, tokens):
+        if not self.logger.isEnabledFor(TRACE):
+            return
         for i, p in enumerate(predictions):
             if p != "O":
-                print ("Marginal for [" + tokens[i].string + "] as \'" + label + "\': " + \
-                    str(tagger.marginal(label, i)) + " and for O: " + str(
-                    tagger.marginal("O", i)))
+                self.logger.log(TRACE, "Marginal for [%s] as '%s': %s and for O: %s", tokens[i].string, label,
+                                tagger.marginal(label, i), tagger.marginal("O", i))
 
     def _modeldir2concepts(self, dir):
         """
@@ -103,47 +227,53 @@ class NERExtraction:
             toks = tags_tuple[1]
             taglist=[item for sublist in tags for item in sublist]
             tokslist = [item for sublist in toks for item in sublist]
-            documents[docid].NER_token_labels = self._transform_to_dict(taglist, tokslist, documents[docid].token_spans)
+            documents[docid].NER_token_labels = self._token_labels(taglist, tokslist, documents[docid].token_spans)
             documents[docid].tokens = tokslist
             alllabels = alllabels.union(set(taglist))
         alllabels.remove("O")
         self.possible_labels = list(alllabels)
         return documents
 
-    def _transform_to_dict(self, taglist, toklist, spans):
+    def _token_labels(self, taglist, toklist, spans):
         '''
-        Transfors a list of tokens and a list of tags into a dict{tag_type:[tuple(token1Text,token1Tag), ...]}
+        Collects a list of tokens and a list of tags into the document's TokenLabels
         :param taglist: The list of tags representing a single doc
         :param toklist: The list of tokens representing a single doc
-        :return:
+        :return: TokenLabels, without confidences
         '''
         assert(len(taglist) == len(toklist))
         assert(len(spans) == len(taglist))
-        token_dicts=list()
-        for i, tag in enumerate(taglist):
-            tok = toklist[i]
-            begin = spans[i][0]
-            end = spans[i][1]
-            d = dict()
-
-            if re.match('^\s+$', tok) and tag != "O":
-                tag = "O" # If the algo tagged whitespace as non "O", reset to "O"
-
-            d['text'] = tok
-            d['label'] = tag
-            d['start'] = begin
-            d['stop'] = end
-            token_dicts.append(d)
-        return token_dicts
+        token_labels = TokenLabels.from_labels(toklist, spans, taglist)
+        token_labels.reset_whitespace() # If the algo tagged whitespace as non "O", reset to "O"
+        count("tokens", len(token_labels))
+        count("labelled_tokens", token_labels.labelled())
+        observe("document_tokens", len(token_labels))
+        return token_labels
 
     def remove_negated_concepts(self, tagged_docs):
-        print ("Finding negated concepts...")
-        for docid, doc in tagged_docs.items():
-            self.negexer.negate(doc)
+        self.logger.info("Finding negated concepts...")
+        with timed("negation"):
+            for docid, doc in tagged_docs.items():
+                self.negexer.negate(doc)
         return tagged_docs
 
-    def docs2json(self, tagged_documents):
-        doc_dict = dict()
+    def docs2dicts(self, tagged_documents):
+        '''
+        :return: generator of (doc_id, {"NER_labels": ..., "text": ...}) pairs, the per-document response records
+        '''
         for id, doc in tagged_documents.items():
-            doc_dict[id] = dict({"NER_labels": doc.NER_token_labels, "text": doc.text})
-        return json.dumps(doc_dict, ensure_ascii=False)
+            yield id, dict({"NER_labels": doc.NER_token_labels.to_dicts(), "text": doc.text})
+
+    def docs2json(self, tagged_documents):
+        with timed("serialize"):
+            return json.dumps(dict(self.docs2dicts(tagged_documents)), ensure_ascii=False)
+
+    def docs2ndjson(self, tagged_documents):
+        '''
+        Serializes tagged documents one at a time for streaming responses
+        :return: generator of newline-terminated JSON lines, each {doc_id: {"NER_labels": ..., "text": ...}}
+        '''
+        for id, doc_dict in self.docs2dicts(tagged_documents):
+            with timed("serialize"):
+                line = json.dumps({id: doc_dict}, ensure_ascii=False) + "\n"
+            yield line
@@ -2,67 +2,99 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import logging
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 from nltk.stem.porter import *
 
+logger = logging.getLogger(__name__)
+
+# Upper bound on the number of distinct word forms whose lexical features are kept between documents
+LEXICAL_CACHE_SIZE = 200000
+
+# PorterStemmer.stem keeps no state between calls, so one instance serves every token
+_stemmer = PorterStemmer()
+
+# The features of a token that depend only on its text, already rendered as feature value strings
+LexicalFeatures = namedtuple("LexicalFeatures", ["def_class", "stem", "lower", "suffix3", "suffix2", "is_measurement",
+                                                 "has_problem_form", "metric_unit"])
+
 
-def word2features(sent, i, w2v_clusters=None): 
-    word = sent[i].orth_
-    postag = sent[i].tag_
-    shape = sent[i].shape_
-    dep = sent[i].dep_
-    cluster = sent[i].cluster
-    stemmer = PorterStemmer()
+@lru_cache(maxsize=LEXICAL_CACHE_SIZE)
+def lexical_features(word):
+    '''
+    Computes the word-level features of a token. Results are cached by word form, so repeated words across sentences,
+    documents and requests are only stemmed and classified once
+    :param word: the token text
+    :return: LexicalFeatures
+    '''
+    return LexicalFeatures(def_class=str(get_def_class(word)),
+                           stem=_stemmer.stem(word),
+                           lower=word.lower(),
+                           suffix3=word[-3:],
+                           suffix2=word[-2:],
+                           is_measurement=str(is_measurement(word)),
+                           has_problem_form=str(has_problem_form(word)),
+                           metric_unit=str(feature_metric_unit(word)))
 
+
+def _token_features(lex, token, w2v_clusters):
     features = [
         'bias',
-        'def_class=' + str(get_def_class(word)),
-        'stem=' + stemmer.stem(word),
-        'word.lower=' + word.lower(),
-        'word[-3:]=' + word[-3:],
-        'word[-2:]=' + word[-2:],
-        'postag=' + postag,
-        'postag[:2]=' + postag[:2],
-        'shape=' + shape,
-        'dep=' + dep,
-        'browncluster=' + str(cluster),
-        'isMeasurement=' + str(is_measurement(word)),
-        'hasProblemForm=' + str(has_problem_form(word))
+        'def_class=' + lex.def_class,
+        'stem=' + lex.stem,
+        'word.lower=' + lex.lower,
+        'word[-3:]=' + lex.suffix3,
+        'word[-2:]=' + lex.suffix2,
+        'postag=' + token.tag_,
+        'postag[:2]=' + token.tag_[:2],
+        'shape=' + token.shape_,
+        'dep=' + token.dep_,
+        'browncluster=' + str(token.cluster),
+        'isMeasurement=' + lex.is_measurement,
+        'hasProblemForm=' + lex.has_problem_form
     ]
     if w2v_clusters:
-        wvc_cluster_id = w2v_clusters.cluster_lookup(word)
-        features.append('w2vcluster'+ str(wvc_cluster_id))
-    else:
-        print ("WARNING: Not using word2vec cluster features. Does your model support this?")
+        features.append('w2vcluster' + str(w2v_clusters.cluster_lookup(token.orth_)))
+    return features
+
 
+def _prev_features(lex, token):
+    return [
+        '-1:featureMetricUnit=' + lex.metric_unit,
+        '-1:word.lower=' + lex.lower,
+        '-1:stem=' + lex.stem,
+        '-1:postag=' + token.tag_,
+        '-1:dep=' + token.dep_,
+        '-1:isMeasurement=' + lex.is_measurement,
+        '-1:hasProblemForm=' + lex.has_problem_form
+    ]
+
+
+def _next_features(lex, token):
+    return [
+        '+1:featureMetricUnit=' + lex.metric_unit,
+        '+1:word.lower=' + lex.lower,
+        '+1stem=' + lex.stem,
+        '+1:postag=' + token.tag_,
+        '+1:dep=' + token.dep_,
+        '+1:isMeasurement=' + lex.is_measurement,
+        '+1:hasProblemForm=' + lex.has_problem_form
+    ]
+
+
+def word2features(sent, i, w2v_clusters=None):
+    if not w2v_clusters:
+        logger.warning("Not using word2vec cluster features. Does your model support this?")
+    features = _token_features(lexical_features(sent[i].orth_), sent[i], w2v_clusters)
     if i > 0:
-        word1 = sent[i - 1].orth_
-        postag1 = sent[i - 1].tag_
-        dep1 = sent[i - 1].dep_
-        features.extend([
-            '-1:featureMetricUnit=' + str(feature_metric_unit(word1)),
-            '-1:word.lower=' + word1.lower(),
-            '-1:stem=' + stemmer.stem(word1),
-            '-1:postag=' + postag1,
-            '-1:dep=' + dep1,
-            '-1:isMeasurement=' + str(is_measurement(word1)),
-            '-1:hasProblemForm=' + str(has_problem_form(word1))
-        ])
+        features.extend(_prev_features(lexical_features(sent[i - 1].orth_), sent[i - 1]))
     else:
         features.append('BOS')
-
     if i < len(sent) - 1:
-        word1 = sent[i + 1].orth_
-        postag1 = sent[i + 1].tag_
-        dep1 = sent[i + 1].dep_
-        features.extend([
-            '+1:featureMetricUnit=' + str(feature_metric_unit(word1)),
-            '+1:word.lower=' + word1.lower(),
-            '+1stem=' + stemmer.stem(word1),
-            '+1:postag=' + postag1,
-            '+1:dep=' + dep1,
-            '+1:isMeasurement=' + str(is_measurement(word1)),
-            '+1:hasProblemForm=' + str(has_problem_form(word1))
-        ])
+        features.extend(_next_features(lexical_features(sent[i + 1].orth_), sent[i + 1]))
     else:
         features.append('EOS')
     return features
@@ -88,7 +120,31 @@ def get_sentences_from_patients(patients):
 
 
 def sent2features(sent, clusters=None):
-    return [word2features(sent, i, clusters) for i in range(len(sent))]
+    '''
+    Builds the CRF feature vectors of a sentence or document. Each token's lexical features are looked up once and
+    reused for its own features and as the -1/+1 context of its neighbours; the output is the same as calling
+    word2features on every position
+    :param sent: list of tokens
+    :param clusters: Clusters object for the word2vec cluster feature, or None
+    :return: list of feature lists, one per token
+    '''
+    if not clusters and len(sent) > 0:
+        logger.warning("Not using word2vec cluster features. Does your model support this?")
+    lexicals = [lexical_features(token.orth_) for token in sent]
+    last = len(sent) - 1
+    feature_vectors = list()
+    for i, token in enumerate(sent):
+        features = _token_features(lexicals[i], token, clusters)
+        if i > 0:
+            features.extend(_prev_features(lexicals[i - 1], sent[i - 1]))
+        else:
+            features.append('BOS')
+        if i < last:
+            features.extend(_next_features(lexicals[i + 1], sent[i + 1]))
+        else:
+            features.append('EOS')
+        feature_vectors.append(features)
+    return feature_vectors
 
 
 def sent2labels(sent):
@@ -254,6 +310,50 @@ def is_size(word):
         return False
 
 
+# Term lists for get_def_class, built once at import
+_TEST_TERMS = {
+    "eval", "evaluation", "evaluations",
+    "sat", "sats", "saturation",
+    "exam", "exams",
+    "rate", "rates",
+    "test", "tests",
+    "xray", "xrays",
+    "screen", "screens",
+    "level", "levels",
+    "tox", "biopsy"
+}
+_PROBLEM_TERMS = {
+    "swelling",
+    "wound", "wounds",
+    "symptom", "symptoms",
+    "shifts", "failure",
+    "insufficiency", "insufficiencies",
+    "mass", "masses",
+    "aneurysm", "aneurysms",
+    "ulcer", "ulcers",
+    "trauma", "cancer",
+    "disease", "diseased",
+    "bacterial", "viral",
+    "syndrome", "syndromes",
+    "pain", "pains"
+    "burns", "burned",
+    "broken", "fractured",
+    "bruising", "bleeding",
+    "diarrhea"
+}
+_TREATMENT_TERMS = {
+    "therapy",
+    "replacement",
+    "anesthesia",
+    "supplement", "supplemental",
+    "vaccine", "vaccines"
+    "dose", "doses",
+    "shot", "shots",
+    "medication", "medicine",
+    "treatment", "treatments"
+}
+
+
 def get_def_class(word):
     """
     get_def_class()
@@ -284,52 +384,12 @@ def get_def_class(word):
     # >>> get_def_class('unrelated')
     # 0
     # """
-    test_terms = {
-        "eval", "evaluation", "evaluations",
-        "sat", "sats", "saturation",
-        "exam", "exams",
-        "rate", "rates",
-        "test", "tests",
-        "xray", "xrays",
-        "screen", "screens",
-        "level", "levels",
-        "tox", "biopsy"
-    }
-    problem_terms = {
-        "swelling",
-        "wound", "wounds",
-        "symptom", "symptoms",
-        "shifts", "failure",
-        "insufficiency", "insufficiencies",
-        "mass", "masses",
-        "aneurysm", "aneurysms",
-        "ulcer", "ulcers",
-        "trauma", "cancer",
-        "disease", "diseased",
-        "bacterial", "viral",
-        "syndrome", "syndromes",
-        "pain", "pains"
-        "burns", "burned",
-        "broken", "fractured",
-        "bruising", "bleeding",
-        "diarrhea"
-    }
-    treatment_terms = {
-        "therapy",
-        "replacement",
-        "anesthesia",
-        "supplement", "supplemental",
-        "vaccine", "vaccines"
-        "dose", "doses",
-        "shot", "shots",
-        "medication", "medicine",
-        "treatment", "treatments"
-    }
-    if word.lower() in test_terms:
+    lower = word.lower()
+    if lower in _TEST_TERMS:
         return 1
-    elif word.lower() in problem_terms:
+    elif lower in _PROBLEM_TERMS:
         return 2
-    elif word.lower() in treatment_terms:
+    elif lower in _TREATMENT_TERMS:
         return 3
     return 0
 
@@ -0,0 +1,223 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import hashlib
+import json
+import logging
+import os
+import threading
+from array import array
+
+import numpy as np
+
+from NERExtraction.FeatureProcessing import sent2features
+
+logger = logging.getLogger(__name__)
+
+# Bump when sent2features changes, so stores built by older code are rebuilt
+FEATURE_STORE_VERSION = 1
+
+_META_FILE = "meta.json"
+_VOCAB_FILE = "vocab.json"
+_ARRAYS = ("feature_ids", "token_offsets", "doc_offsets", "label_ids")
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def fingerprint(docs, label_lists, clusters=None):
+    '''
+    Hashes everything the CRF features and labels of a training set are computed from, so a stored copy is only
+    reused for the same documents, parses, gold labels and cluster table
+    :param docs: list of Document objects
+    :param label_lists: list of tag lists, one per document
+    :param clusters: Clusters object used for the word2vec cluster feature, or None
+    :return: hex digest
+    '''
+    h = hashlib.sha1(("v%d" % FEATURE_STORE_VERSION).encode("utf-8"))
+    if clusters and clusters.cluster_dir:
+        stat = os.stat(clusters.cluster_dir)
+        h.update(("clusters %s %d %d" % (os.path.abspath(clusters.cluster_dir), stat.st_size,
+                                         stat.st_mtime)).encode("utf-8"))
+    for doc, labels in zip(docs, label_lists):
+        for token in doc.tokens:
+            h.update("\t".join((token.orth_, token.tag_, token.dep_, token.shape_,
+                                str(token.cluster))).encode("utf-8"))
+            h.update(b"\n")
+        h.update("\t".join(labels).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class StoredSequences(object):
+    """
+    Read-only list of per-document sequences (feature lists or labels) decoded from a FeatureStore on access. Pickles
+    as the store's path, so handing it to worker processes copies no feature data; each worker maps the files itself.
+    """
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("document index out of range")
+        if self.kind == "features":
+            return self.store.doc_features(i)
+        return self.store.doc_labels(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self):
+        return _open_sequences, (self.store.path, self.kind)
+
+
+class FeatureStore(object):
+    """
+    CRF training features and labels saved once and memory mapped on use. Feature strings are interned: the store
+    keeps each distinct string once in its vocabulary and the documents as arrays of vocabulary ids, delimited by
+    token and document offsets. Decoded feature lists share the vocabulary's string objects.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(path, _META_FILE)) as f:
+            meta = json.load(f)
+        self.fingerprint = meta["fingerprint"]
+        with open(os.path.join(path, _VOCAB_FILE), encoding="utf-8") as f:
+            vocab = json.load(f)
+        self.vocab = vocab["features"]
+        self.label_vocab = vocab["labels"]
+        self.feature_ids, self.token_offsets, self.doc_offsets, self.label_ids = \
+            [np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in _ARRAYS]
+        self.features = StoredSequences(self, "features")
+        self.labels = StoredSequences(self, "labels")
+
+    def __len__(self):
+        return len(self.doc_offsets) - 1
+
+    def doc_features(self, i):
+        '''
+        :param i: document position
+        :return: list of feature string lists, one per token, as sent2features returns them
+        '''
+        first, last = int(self.doc_offsets[i]), int(self.doc_offsets[i + 1])
+        offsets = self.token_offsets[first:last + 1].tolist()
+        if not offsets:
+            return list()
+        base = offsets[0]
+        ids = self.feature_ids[base:offsets[-1]].tolist()
+        vocab = self.vocab
+        return [[vocab[f] for f in ids[start - base:stop - base]] for start, stop in zip(offsets, offsets[1:])]
+
+    def doc_labels(self, i):
+        '''
+        :param i: document position
+        :return: list of tags, one per token
+        '''
+        first, last = int(self.doc_offsets[i]), int(self.doc_offsets[i + 1])
+        label_vocab = self.label_vocab
+        return [label_vocab[l] for l in self.label_ids[first:last].tolist()]
+
+    @classmethod
+    def build(cls, path, docs, label_lists, clusters=None, key=None):
+        '''
+        Featurizes documents and writes their features and labels to path
+        :param path: directory for the store; created if needed, existing store files are replaced
+        :param docs: list of Document objects
+        :param label_lists: list of tag lists, one per document
+        :param clusters: Clusters object for the word2vec cluster feature, or None
+        :param key: fingerprint to record, defaults to fingerprint(docs, label_lists, clusters)
+        :return: the opened FeatureStore
+        '''
+        key = key or fingerprint(docs, label_lists, clusters)
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, _META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)  # an interrupted rebuild must not look like a complete store
+
+        vocab, vocab_ids = list(), dict()
+        label_vocab, label_vocab_ids = list(), dict()
+        feature_ids, token_offsets, doc_offsets, label_ids = array("I"), array("Q", [0]), array("Q", [0]), array("I")
+        for doc, labels in zip(docs, label_lists):
+            feature_lists = sent2features(doc.tokens, clusters)
+            if len(feature_lists) != len(labels):
+                raise ValueError("Document " + str(doc.document_id) + " has " + str(len(feature_lists)) +
+                                 " tokens but " + str(len(labels)) + " labels")
+            for features, label in zip(feature_lists, labels):
+                for feature in features:
+                    fid = vocab_ids.get(feature)
+                    if fid is None:
+                        fid = vocab_ids[feature] = len(vocab)
+                        vocab.append(feature)
+                    feature_ids.append(fid)
+                token_offsets.append(len(feature_ids))
+                lid = label_vocab_ids.get(label)
+                if lid is None:
+                    lid = label_vocab_ids[label] = len(label_vocab)
+                    label_vocab.append(label)
+                label_ids.append(lid)
+            doc_offsets.append(len(token_offsets) - 1)
+
+        # files are written aside and renamed into place: truncating a file another store still maps would crash it
+        for name, values, dtype in (("feature_ids", feature_ids, np.uint32), ("token_offsets", token_offsets, np.uint64),
+                                    ("doc_offsets", doc_offsets, np.uint64), ("label_ids", label_ids, np.uint32)):
+            with open(os.path.join(path, name + ".npy.tmp"), "wb") as f:
+                np.save(f, np.array(values, dtype=dtype))
+            os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+        with open(os.path.join(path, _VOCAB_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump({"features": vocab, "labels": label_vocab}, f)
+        os.replace(os.path.join(path, _VOCAB_FILE + ".tmp"), os.path.join(path, _VOCAB_FILE))
+        with open(meta_path, "w") as f:
+            json.dump({"fingerprint": key, "version": FEATURE_STORE_VERSION, "documents": len(doc_offsets) - 1,
+                       "tokens": len(label_ids), "features": len(feature_ids), "vocab_size": len(vocab)}, f)
+        logger.info("Stored %d feature ids (%d distinct features) for %d tokens in %s", len(feature_ids), len(vocab),
+                    len(label_ids), path)
+        with _stores_lock:
+            _stores.pop(os.path.abspath(path), None)
+        return open_store(path)
+
+
+def open_store(path):
+    '''
+    Opens a store, sharing one instance per path within a process
+    :param path: directory written by FeatureStore.build
+    :return: FeatureStore
+    '''
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = FeatureStore(path)
+        return _stores[path]
+
+
+def _open_sequences(path, kind):
+    store = open_store(path)
+    return store.features if kind == "features" else store.labels
+
+
+def get_or_build(path, docs, label_lists, clusters=None):
+    '''
+    Returns the store at path if it was built from the same inputs, otherwise (re)builds it
+    :param path: store directory
+    :param docs: list of Document objects
+    :param label_lists: list of tag lists, one per document
+    :param clusters: Clusters object for the word2vec cluster feature, or None
+    :return: FeatureStore
+    '''
+    key = fingerprint(docs, label_lists, clusters)
+    if os.path.exists(os.path.join(path, _META_FILE)):
+        store = open_store(path)
+        if store.fingerprint == key:
+            logger.info("Reusing stored features in %s", path)
+            return store
+        logger.info("Stored features in %s are out of date, rebuilding", path)
+    return FeatureStore.build(path, docs, label_lists, clusters, key=key)
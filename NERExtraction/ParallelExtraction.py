@@ -0,0 +1,139 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import atexit
+import multiprocessing
+import threading
+from collections import namedtuple
+
+from sklearn.externals import joblib
+
+from NERExtraction.CRFDecoder import CRFDecoder
+from NERExtraction.FeatureProcessing import sent2features
+from NERUtilities.Clusters import Clusters
+
+# The token attributes read by FeatureProcessing.word2features. spaCy tokens can't be pickled on their own, so
+# documents are shipped to the workers as lists of these instead
+FeatureToken = namedtuple("FeatureToken", ["orth_", "tag_", "shape_", "dep_", "cluster"])
+
+# Per-worker state, set once by _init_worker when the pool process starts
+_worker_model = None
+_worker_clusters = None
+
+# Pools are kept alive between calls so workers only load the model and clusters once; one per model name
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def _init_worker(model, cluster_path):
+    '''
+    Pool initializer: loads the CRF model and the word2vec clusters into this worker process
+    :param model: a fitted sklearn_crfsuite CRF, or the path to its joblib pickle
+    :param cluster_path: path to the k-means cluster file
+    '''
+    global _worker_model, _worker_clusters
+    _worker_model = joblib.load(model) if isinstance(model, str) else model
+    _worker_clusters = Clusters(cluster_path)
+
+
+def _tag_tokens(feature_tokens):
+    '''
+    Featurizes and tags a single document inside a worker
+    :param feature_tokens: list of FeatureToken for one document
+    :return: (label index array, confidence array) of the document's CRF decoding, indices into the model's classes_
+    '''
+    feature_vectors = sent2features(feature_tokens, clusters=_worker_clusters)
+    decoding = CRFDecoder.for_model(_worker_model).decode([feature_vectors])[0]
+    return decoding.label_ids, decoding.confidences
+
+
+def to_feature_tokens(tokens):
+    '''
+    Converts spaCy tokens into picklable FeatureToken tuples
+    :param tokens: list of spaCy tokens
+    :return: list of FeatureToken
+    '''
+    return [FeatureToken(t.orth_, t.tag_, t.shape_, t.dep_, t.cluster) for t in tokens]
+
+
+class CRFTaggingPool(object):
+    """
+    A process pool whose workers each hold their own copy of one CRF model and the cluster table. Documents are
+    sharded across the workers and results come back in submission order.
+    """
+    def __init__(self, model, cluster_path, n_workers):
+        self.model = model
+        self.cluster_path = cluster_path
+        self.n_workers = n_workers
+        self.closed = False
+        self.pool = multiprocessing.Pool(processes=n_workers, initializer=_init_worker,
+                                         initargs=(model, cluster_path))
+
+    def serves(self, model, cluster_path, n_workers):
+        return not self.closed and self.model is model and self.cluster_path == cluster_path \
+            and self.n_workers == n_workers
+
+    def tag(self, token_lists, chunksize=None):
+        '''
+        Tags a list of documents
+        :param token_lists: list of token lists (spaCy tokens or FeatureToken), one per document
+        :param chunksize: number of documents sent to a worker at a time
+        :return: list of (label index array, confidence array) pairs, in the same order as token_lists
+        '''
+        payload = [to_feature_tokens(tokens) for tokens in token_lists]
+        if chunksize is None:
+            chunksize = max(1, len(payload) // (self.n_workers * 4))
+        return self.pool.map(_tag_tokens, payload, chunksize=chunksize)
+
+    def close(self, wait=True):
+        '''
+        Stops the workers once the documents already submitted are tagged
+        :param wait: block until they have exited, rather than reaping them in a background thread
+        '''
+        self.closed = True
+        self.pool.close()
+        if wait:
+            self.pool.join()
+        else:
+            thread = threading.Thread(target=self.pool.join, name="hutchner-pool-close")
+            thread.daemon = True
+            thread.start()
+
+
+def get_pool(model_name, model, cluster_path, n_workers):
+    '''
+    Returns the shared tagging pool for a model, starting it on first use. A pool started for another copy of the
+    model (e.g. before it was evicted and reloaded) or other settings is closed and replaced
+    :param model_name: key of the model in the models dict
+    :param model: the fitted CRF (or path to its pickle) the workers should load
+    :param cluster_path: path to the k-means cluster file
+    :param n_workers: number of worker processes
+    :return: CRFTaggingPool
+    '''
+    with _pools_lock:
+        pool = _pools.get(model_name)
+        if pool is None or not pool.serves(model, cluster_path, n_workers):
+            if pool is not None:
+                pool.close(wait=False)
+            pool = _pools[model_name] = CRFTaggingPool(model, cluster_path, n_workers)
+        return pool
+
+
+def close_pool(model_name):
+    '''
+    Shuts down a model's tagging pool, if it has one, so its workers and their copy of the model are freed. Called
+    when the model is unloaded; tagging already under way finishes first
+    '''
+    with _pools_lock:
+        pool = _pools.pop(model_name, None)
+    if pool is not None:
+        pool.close(wait=False)
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,104 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from NERUtilities.RequestLogging import count
+
+logger = logging.getLogger(__name__)
+
+# Token budget of the process-wide cache; HUTCHNER_SENTENCE_CACHE_TOKENS=0 (the default) turns caching off
+SENTENCE_CACHE_TOKENS = int(os.environ.get("HUTCHNER_SENTENCE_CACHE_TOKENS", "0"))
+
+
+class SentenceCache(object):
+    """
+    LRU cache of tagging results per sentence, for the templated text (headers, disclaimers, copied-forward history)
+    that repeats across notes. Entries are keyed by model name and the sentence's normalized token sequence. Memory is
+    bounded by the total number of cached tokens: past max_tokens the least recently used sentences are dropped.
+    Safe to share between request threads.
+    """
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_name, key):
+        '''
+        :param model_name: the tagging model's name
+        :param key: tuple identifying the sentence's tokens as the model sees them
+        :return: the cached result, or None
+        '''
+        with self._lock:
+            entry = self._entries.get((model_name, key))
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end((model_name, key))
+                self.hits += 1
+        count("sentence_cache_hits" if entry is not None else "sentence_cache_misses")
+        return entry
+
+    def put(self, model_name, key, result):
+        '''
+        :param model_name: the tagging model's name
+        :param key: tuple identifying the sentence's tokens, one item per token
+        :param result: the sentence's tagging result; must not be modified afterwards
+        '''
+        if len(key) > self.max_tokens:
+            return
+        with self._lock:
+            if (model_name, key) in self._entries:
+                return
+            self._entries[(model_name, key)] = result
+            self.tokens += len(key)
+            while self.tokens > self.max_tokens:
+                (_, evicted), _ = self._entries.popitem(last=False)
+                self.tokens -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.tokens = 0
+
+    def stats(self):
+        '''
+        :return: {"sentences", "tokens", "max_tokens", "hits", "misses", "hit_rate", "evictions"}
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"sentences": len(self._entries),
+                    "tokens": self.tokens,
+                    "max_tokens": self.max_tokens,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / float(lookups) if lookups else 0.0,
+                    "evictions": self.evictions}
+
+
+def crf_sentence_key(tokens):
+    '''
+    The CRF features of a sentence depend on each token's text, part of speech and dependency label
+    :param tokens: spaCy tokens of the sentence
+    :return: tuple of (orth, tag, dep) per token
+    '''
+    return tuple((token.orth_, token.tag_, token.dep_) for token in tokens)
+
+
+def load_sentence_cache():
+    '''
+    Registry loader: the process-wide cache, or None when HUTCHNER_SENTENCE_CACHE_TOKENS is 0
+    '''
+    if SENTENCE_CACHE_TOKENS <= 0:
+        return None
+    logger.info("Caching sentence results for up to %d tokens", SENTENCE_CACHE_TOKENS)
+    return SentenceCache(SENTENCE_CACHE_TOKENS)
@@ -0,0 +1,186 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import json
+import logging
+import os
+from collections import Counter
+
+from NERUtilities.ResourceRegistry import registry
+
+logger = logging.getLogger(__name__)
+
+# Sentences whose best token rate is below this are labelled O without running the tagger
+DEFAULT_THRESHOLD = 0.01
+
+# Word forms seen fewer times than this in training are scored by their cluster instead of their own counts
+MIN_WORD_COUNT = 2
+
+# File a model's prefilter is saved to, next to its pickle
+PREFILTER_SUFFIX = ".prefilter.json"
+
+# Key of a model's prefilter in the resource registry: "crf_ner" -> "crf_ner_prefilter". Prefilters are kept there
+# rather than with the models, so they are never evicted with (or instead of) their model
+PREFILTER_KEY_SUFFIX = "_prefilter"
+
+
+def prefilter_file(model_file):
+    '''
+    :return: the path of the prefilter saved with a model pickle
+    '''
+    return os.path.splitext(model_file)[0] + PREFILTER_SUFFIX
+
+
+def get_prefilter(model_type, resources=None):
+    '''
+    :param model_type: key of the tagging model
+    :param resources: ResourceRegistry the prefilter is registered in, defaults to the process-wide registry
+    :return: the model's SentencePrefilter if one is registered, else None
+    '''
+    resources = registry if resources is None else resources
+    key = model_type.lower() + PREFILTER_KEY_SUFFIX
+    return resources.get(key) if resources.is_registered(key) else None
+
+
+class SentencePrefilter(object):
+    """
+    Cheap sentence classifier run before the CRF/LSTM tagger. A token's rate is the fraction of its word form's
+    training occurrences that were inside a gold concept; forms seen too rarely fall back to the rate of their word2vec
+    cluster and then to the rate of all rare forms. A sentence is sent to the tagger when one of its tokens has a rate
+    of at least threshold; every other sentence is labelled O.
+    """
+    def __init__(self, labels, word_rates, cluster_rates, unseen_rate, threshold=DEFAULT_THRESHOLD, clusters=None):
+        '''
+        :param labels: the concept labels the rates were counted for
+        :param word_rates: dict of lowercased word -> rate
+        :param cluster_rates: dict of cluster id -> rate
+        :param unseen_rate: rate of words in neither table
+        :param threshold: minimum token rate for a sentence to be tagged
+        :param clusters: Clusters object to look up the clusters of words not in word_rates
+        '''
+        self.labels = list(labels)
+        self.word_rates = word_rates
+        self.cluster_rates = cluster_rates
+        self.unseen_rate = unseen_rate
+        self.threshold = threshold
+        self.clusters = clusters
+
+    @classmethod
+    def fit(cls, docs, labels, clusters=None, threshold=DEFAULT_THRESHOLD):
+        '''
+        Counts the rates on annotated documents
+        :param docs: list of Document objects with gold annotations joined
+        :param labels: the concept labels the tagger is trained for
+        :param clusters: Clusters object, or None to skip the cluster fallback
+        :return: SentencePrefilter
+        '''
+        words, labelled_words = Counter(), Counter()
+        for doc in docs:
+            for token, tag in zip(doc.tokens, doc.get_crf_training_vectors(labels)):
+                word = token.orth_.lower()
+                words[word] += 1
+                if tag != "O":
+                    labelled_words[word] += 1
+
+        word_rates = dict()
+        cluster_counts, labelled_clusters = Counter(), Counter()
+        rare, labelled_rare = 0, 0
+        for word, n in words.items():
+            if n >= MIN_WORD_COUNT:
+                word_rates[word] = labelled_words[word] / float(n)
+            else:
+                rare += n
+                labelled_rare += labelled_words[word]
+            if clusters:
+                cluster = clusters.cluster_lookup(word)
+                if cluster is not None:
+                    cluster_counts[cluster] += n
+                    labelled_clusters[cluster] += labelled_words[word]
+        cluster_rates = dict((cluster, labelled_clusters[cluster] / float(n)) for cluster, n in cluster_counts.items())
+        unseen_rate = labelled_rare / float(rare) if rare else 0.0
+        logger.info("Prefilter fit on %d word forms (%d clusters), unseen rate %.4f", len(word_rates),
+                    len(cluster_rates), unseen_rate)
+        return cls(labels, word_rates, cluster_rates, unseen_rate, threshold, clusters)
+
+    def token_rate(self, word):
+        word = word.lower()
+        rate = self.word_rates.get(word)
+        if rate is not None:
+            return rate
+        if self.clusters:
+            rate = self.cluster_rates.get(self.clusters.cluster_lookup(word))
+            if rate is not None:
+                return rate
+        return self.unseen_rate
+
+    def score(self, tokens):
+        '''
+        :param tokens: the tokens of one sentence (anything with orth_)
+        :return: the highest token rate in the sentence, 0 for an empty one
+        '''
+        return max([self.token_rate(token.orth_) for token in tokens] or [0.0])
+
+    def is_candidate(self, tokens):
+        return self.score(tokens) >= self.threshold
+
+    def candidate_ranges(self, doc):
+        '''
+        :param doc: a preprocessed Document
+        :return: list of (first, last + 1) indexes into doc.tokens of the sentences to tag
+        '''
+        ranges = list()
+        for sentence in doc.sentences:
+            first, last = doc.token_index.range_starting_in(sentence.span_start, sentence.span_end)
+            if first < last and self.is_candidate(doc.tokens[first:last]):
+                ranges.append((first, last))
+        return ranges
+
+    def measure_recall(self, docs, thresholds=None):
+        '''
+        Measures what the prefilter costs on annotated (evaluation) documents: the share of gold concept tokens that
+        are in sentences it would skip, against the share of sentences skipped
+        :param docs: list of Document objects with gold annotations joined
+        :param thresholds: thresholds to report on, defaults to the prefilter's own
+        :return: list of {"threshold", "sentences", "skipped_sentences", "gold_tokens", "recall"} dicts, one per
+                 threshold; recall is the fraction of gold concept tokens still sent to the tagger
+        '''
+        thresholds = thresholds or [self.threshold]
+        sentence_scores = list()  # (score, gold tokens in the sentence) per sentence
+        for doc in docs:
+            tags = doc.get_crf_training_vectors(self.labels)
+            for sentence in doc.sentences:
+                first, last = doc.token_index.range_starting_in(sentence.span_start, sentence.span_end)
+                gold = sum(1 for tag in tags[first:last] if tag != "O")
+                sentence_scores.append((self.score(doc.tokens[first:last]), gold))
+        gold_tokens = sum(gold for _, gold in sentence_scores)
+        report = list()
+        for threshold in thresholds:
+            kept = [(score, gold) for score, gold in sentence_scores if score >= threshold]
+            report.append({"threshold": threshold,
+                           "sentences": len(sentence_scores),
+                           "skipped_sentences": len(sentence_scores) - len(kept),
+                           "gold_tokens": gold_tokens,
+                           "recall": sum(gold for _, gold in kept) / float(gold_tokens) if gold_tokens else 1.0})
+        return report
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"labels": self.labels,
+                       "threshold": self.threshold,
+                       "unseen_rate": self.unseen_rate,
+                       "word_rates": self.word_rates,
+                       "cluster_rates": self.cluster_rates}, f)
+
+    @classmethod
+    def load(cls, path, clusters=None, threshold=None):
+        '''
+        :param path: file written by save()
+        :param clusters: Clusters object for the cluster fallback
+        :param threshold: overrides the saved threshold
+        :return: SentencePrefilter
+        '''
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(saved["labels"], saved["word_rates"], saved["cluster_rates"], saved["unseen_rate"],
+                   saved["threshold"] if threshold is None else threshold, clusters)
@@ -11,22 +11,66 @@ import sklearn_crfsuite
 from sklearn_crfsuite import metrics
 from sklearn.metrics import make_scorer
 from sklearn.model_selection import RandomizedSearchCV
-from NERUtilities.MiscFunctions import CLUSTER_PATH
 
-from NERExtraction.FeatureProcessing import sent2features
-from NERUtilities.Clusters import Clusters
+from NERExtraction import FeatureStore
+from NERExtraction.SentencePrefilter import SentencePrefilter, prefilter_file
+from NERUtilities.ResourceRegistry import registry
 from sklearn.externals import joblib
 
+# Settings of the production CRF models
+CRF_PARAMS = {
+    'c1': 1.0,  # coefficient for L1 penalty
+    'c2': 1e-3,  # coefficient for L2 penalty
+    'max_iterations': 200,  # stop earlier
+    # include transitions that are possible, but not observed
+    'all_possible_transitions': True
+}
+
+
+def model_files(model_path, model_name, labels):
+    '''
+    :return: (pickled model path, JSON config path or None) for a model
+    '''
+    if model_name:
+        return os.path.join(model_path, model_name + ".pkl"), os.path.join(model_path, model_name + ".json")
+    # revert to old version where model files are named for all possible tags
+    return os.path.join(model_path, "model-" + "_".join(labels) + ".pk1"), None
+
+
+def write_model_config(config_file, model_name, model_file, algo_type, labels):
+    with open(config_file, 'w') as outfile:
+        json.dump({ 'model_name': model_name,
+                    'model_file': model_file,
+                    'algorithm_type': algo_type,
+                    'training_date': str(datetime.now()),
+                    'labels': list(labels)}, outfile)
+
+
+def fit_crf(x_train, y_train, model_file):
+    '''
+    Trains a CRF with CRF_PARAMS and pickles it to model_file
+    :param x_train: sequence of per-document feature lists
+    :param y_train: sequence of per-document tag lists
+    :param model_file: path the joblib pickle is written to
+    '''
+    print ("Setting CRF Params for training " + model_file)
+    crf = sklearn_crfsuite.CRF(**CRF_PARAMS)
+    print ("Training " + model_file)
+    crf.fit(x_train, y_train)  # produces model file with this name
+    joblib.dump(crf, model_file)
+
 
 class NERTrainer(object):
     """
     The Object driving the clinical concept extraction Training pipeline.
     """
-    def __init__(self, docs, detected_labels, model_name, algo_type, optimize_hyperparams=False):
+    def __init__(self, docs, detected_labels, model_name, algo_type, optimize_hyperparams=False, feature_dir=None):
         self.detected_labels = detected_labels
         self.annotated_data = docs
-        self.clusters = Clusters(CLUSTER_PATH)
+        self.clusters = registry.get("clusters")
         self.model_path = os.path.join("NERResources", "Models")
+        # features are stored here once per training set and reused by later runs and the hyperparameter search
+        self.feature_path = feature_dir or os.path.join("NERResources", "Features")
         self.optimize_hyperparams = optimize_hyperparams
         self.model_name = model_name
         self.algo_type = algo_type
@@ -41,28 +85,20 @@ class NERTrainer(object):
         
         if not os.path.exists(self.model_path):
             os.makedirs(self.model_path)
-        if self.model_name:
-            model_file = os.path.join(self.model_path, self.model_name + ".pkl")
-            config_info = os.path.join(self.model_path, self.model_name + ".json")
+        model_file, config_info = model_files(self.model_path, self.model_name, self.detected_labels)
+        if config_info:
             print (config_info)
-            with open(config_info, 'w') as outfile:
-                json.dump({ 'model_name': self.model_name,
-                            'model_file': model_file,
-                            'algorithm_type': self.algo_type,
-                            'training_date': str(datetime.now()),
-                            'labels': list(self.detected_labels)}, outfile)
-        else:
-            # revert to old version where model files are named for all possible tags 
-            model_name = "_".join(self.detected_labels)
-            model_file = os.path.join(self.model_path, "model-" + model_name + ".pk1")
-        
+            write_model_config(config_info, self.model_name, model_file, self.algo_type, self.detected_labels)
+
         training_labels = self._get_training_labels(training_docs, self.detected_labels)
-        x_train_list, y_train_list = self._get_features_and_labels(training_docs, training_labels)
+        store_name = self.model_name or "model-" + "_".join(self.detected_labels)
+        x_train_list, y_train_list = self._get_features_and_labels(training_docs, training_labels, store_name)
         if self.optimize_hyperparams:
             self._tune_hyperparams(x_train_list, y_train_list, self.detected_labels)
         else:
             self._run_training(x_train_list, y_train_list, model_file)
             print("CRF model written to: " + model_file)
+            SentencePrefilter.fit(training_docs, self.detected_labels, self.clusters).save(prefilter_file(model_file))
 
         return self.model_name
 
@@ -95,33 +131,18 @@ class NERTrainer(object):
         print('model size: {:0.2f}M'.format(rs.best_estimator_.size_ / 1000000))
 
     def _run_training(self, x_train, y_train, model_name):
-        print ("Setting CRF Params for training " + model_name)
-        crf = sklearn_crfsuite.CRF(
-            c1= 1.0,  # coefficient for L1 penalty
-            c2= 1e-3,  # coefficient for L2 penalty
-            max_iterations= 200,  # stop earlier
-            # include transitions that are possible, but not observed
-            all_possible_transitions= True
-        )
-        print ("Training " + model_name)
-        crf.fit(x_train,y_train)  # produces model file with this name
-        joblib.dump(crf, model_name)
+        fit_crf(x_train, y_train, model_name)
 
 
-    def _get_features_and_labels(self, docs, labels):
+    def _get_features_and_labels(self, docs, labels, store_name):
+        '''
+        Featurizes the training documents, or reuses the stored features of an identical earlier run
+        :return: lazy, memory mapped feature and label sequences; they pickle as a file path, so the search's worker
+                 processes read the store instead of receiving a copy of the features
+        '''
         print ("Fetching feature vectors ...")
-        # Grab all Spacy preprocessed features
-        tagged_sents = list()
-        for doc in docs:
-            try:
-                tokens = doc.tokens
-                tagged_sents.append(tokens)
-            except Exception as e:
-                print (str(e))
-
-        x = [sent2features(s, self.clusters) for s in tagged_sents]
-        y = labels  # labels in doesn't change
-        return x, y
+        store = FeatureStore.get_or_build(os.path.join(self.feature_path, store_name), docs, labels, self.clusters)
+        return store.features, store.labels
 
     def _get_training_labels(self, training_docs, labels):
         print ("Fetching training labels")
@@ -0,0 +1,125 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import namedtuple
+
+from NERExtraction import FeatureStore
+from NERExtraction.SentencePrefilter import SentencePrefilter, prefilter_file
+from NERExtraction.Training import fit_crf, model_files, write_model_config
+from NERUtilities.ResourceRegistry import registry
+
+logger = logging.getLogger(__name__)
+
+# One model to train: its name (used for the .pkl/.json files) and the labels it tags
+ModelSpec = namedtuple("ModelSpec", ["model_name", "labels"])
+
+# What a worker sends back for each model. peak_rss_growth_mb is how far the worker's peak memory rose above what it
+# inherited from the parent at fork time (the featurized corpus etc.), i.e. what fitting the model took
+TrainingResult = namedtuple("TrainingResult", ["model_name", "model_file", "seconds", "peak_rss_growth_mb"])
+
+# Peak memory of this worker process when it started, set by _init_worker
+_start_rss_mb = 0.0
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _init_worker():
+    '''
+    Pool initializer: a forked worker's peak memory starts out at the parent's, so it is recorded as the baseline
+    '''
+    global _start_rss_mb
+    _start_rss_mb = _peak_rss_mb()
+
+
+def _train_model(job):
+    '''
+    Pool task: fits and saves one CRF model
+    :param job: (store path, tag lists, model name, model file, config file, algorithm type, labels)
+    :return: TrainingResult
+    '''
+    store_path, tag_lists, model_name, model_file, config_file, algo_type, labels = job
+    start = time.time()
+    store = FeatureStore.open_store(store_path)
+    if config_file:
+        write_model_config(config_file, model_name, model_file, algo_type, labels)
+    fit_crf(store.features, tag_lists, model_file)
+    return TrainingResult(model_name, model_file, time.time() - start, _peak_rss_mb() - _start_rss_mb)
+
+
+class TrainingOrchestrator(object):
+    """
+    Trains several CRF models over one corpus, e.g. the per-concept pathology models, the PHI model and the
+    problem/treatment/test model of a monthly retrain. The documents are featurized once into a shared FeatureStore;
+    every model is then fitted in its own worker process against that store with its own tag sequences. Each worker
+    runs a single model (maxtasksperchild=1), so the reported peak memory growth is that model's.
+    """
+    def __init__(self, docs, specs, algo_type="crf", n_workers=None, model_dir=None, feature_dir=None):
+        '''
+        :param docs: dict of document id -> preprocessed Document with gold annotations joined
+        :param specs: list of ModelSpec
+        :param algo_type: algorithm recorded in each model's JSON config
+        :param n_workers: number of models trained at once, defaults to the number of CPUs
+        :param model_dir: where models and configs are written, defaults to NERResources/Models
+        :param feature_dir: where the shared feature store is kept, defaults to NERResources/Features
+        '''
+        self.docs = [docs[doc_id] for doc_id in docs]
+        self.specs = list(specs)
+        self.algo_type = algo_type
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.model_path = model_dir or os.path.join("NERResources", "Models")
+        self.feature_path = feature_dir or os.path.join("NERResources", "Features")
+        self.clusters = registry.get("clusters")
+        self.results = list()
+
+    def train(self):
+        '''
+        Trains every model
+        :return: dict of model name -> pickled model path
+        '''
+        if not os.path.exists(self.model_path):
+            os.makedirs(self.model_path)
+        all_labels = sorted(set(label for spec in self.specs for label in spec.labels))
+        logger.info("Featurizing %d documents for %d models", len(self.docs), len(self.specs))
+        store = FeatureStore.get_or_build(os.path.join(self.feature_path, "shared"), self.docs,
+                                          [doc.get_crf_training_vectors(all_labels) for doc in self.docs],
+                                          self.clusters)
+
+        jobs = list()
+        for spec in self.specs:
+            model_file, config_file = model_files(self.model_path, spec.model_name, spec.labels)
+            tag_lists = [doc.get_crf_training_vectors(spec.labels) for doc in self.docs]
+            SentencePrefilter.fit(self.docs, spec.labels, self.clusters).save(prefilter_file(model_file))
+            jobs.append((store.path, tag_lists, spec.model_name, model_file, config_file, self.algo_type,
+                         list(spec.labels)))
+
+        start = time.time()
+        pool = multiprocessing.Pool(processes=min(self.n_workers, len(jobs)) or 1, initializer=_init_worker,
+                                    maxtasksperchild=1)
+        try:
+            self.results = list()
+            for result in pool.imap_unordered(_train_model, jobs):
+                logger.info("Trained %s in %.1fs (peak memory +%.0f MB)", result.model_name, result.seconds,
+                            result.peak_rss_growth_mb)
+                self.results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("Trained %d models in %.1fs", len(self.results), time.time() - start)
+        return dict((result.model_name, result.model_file) for result in self.results)
+
+    def report(self):
+        '''
+        :return: list of {"model_name", "model_file", "seconds", "peak_rss_growth_mb"} dicts, one per trained model
+        '''
+        return [result._asdict() for result in sorted(self.results, key=lambda r: r.model_name)]
@@ -7,12 +7,20 @@ import os
 
 import re
 
+from DataLoading.TokenLabels import NEGATION_LABELS
+from NERNegation.NegEx.TriggerAutomaton import TriggerAutomaton
+
 
 class HutchNegEx(object):
-    def __init__(self):
+    def __init__(self, use_automaton=True):
         self.cwd = os.path.dirname(__file__)
         self.negation_patterns = self._load_patterns()
-        self.types_we_care_about = {"DEFINITE_NEGATED_EXISTENCE":3, "PROBABLE_NEGATED_EXISTENCE":2, "AMBIVALENT_EXISTENCE":1}
+        # negation type -> its TokenLabels negation code, higher meaning more certain
+        self.types_we_care_about = dict((label, code) for code, label in enumerate(NEGATION_LABELS) if label)
+        # when set, triggers are matched through a single precompiled automaton rather than pattern by pattern
+        self.use_automaton = use_automaton
+        self.trigger_automaton = TriggerAutomaton([(self._get_pattern_regex(p), p['Type'], p['Direction'])
+                                                   for p in self.negation_patterns])
 
     def negate(self, doc_obj):
         '''
@@ -62,17 +70,22 @@ class HutchNegEx(object):
                     })
         return list_pattern_dicts
 
+    def _get_pattern_regex(self, pattern_dict):
+        if pattern_dict['Regex'] != "":
+            return pattern_dict['Regex']
+        return pattern_dict['Lex']
+
     def _match_negation(self, text):
+        if self.use_automaton:
+            return self.trigger_automaton.match(text)
+        return self._match_negation_per_pattern(text)
+
+    def _match_negation_per_pattern(self, text):
         negation_matches = list()
         for p in self.negation_patterns:
-            if p['Regex'] is not "":
-                pat = p['Regex']
-                for m in pat.finditer(text):
-                    negation_matches.append((m.span(), m.group(), p['Type'], p['Direction']))
-            else:
-                pat = p['Lex']
-                for m in pat.finditer(text):
-                    negation_matches.append((m.span(), m.group(), p['Type'], p['Direction']))
+            pat = self._get_pattern_regex(p)
+            for m in pat.finditer(text):
+                negation_matches.append((m.span(), m.group(), p['Type'], p['Direction']))
         return negation_matches
 
     def _update_to_doc_lvl_spans(self,sent_span_start_in_doc, matched_negations):
@@ -87,28 +100,8 @@ class HutchNegEx(object):
         return new_sentence_negations
 
     def _get_tok_start_and_stop_idxs(self, doc_start, doc_stop, doc):
-        tokspan_list = doc.token_spans
-
-        # a and b define the range of values to examine from the tokspan list at each layer of recursion
-        a = 0
-        b = len(tokspan_list)-1
-        start_tok = self._find_tok_idx(a, b, tokspan_list, doc_start)
-        end_tok = self._find_tok_idx(a, b, tokspan_list, doc_stop)
-        return start_tok, end_tok
-
-    def _find_tok_idx(self, a, b, tokspan_list, doc_idx):
-        if len(tokspan_list[a:b]) == 1:
-            return a
-        tok_idx = int(len(tokspan_list[a:b]) / 2)
-        tok_idx += a
-        if doc_idx >= tokspan_list[tok_idx][0] and doc_idx <= tokspan_list[tok_idx][1]:
-            return tok_idx
-        elif doc_idx < tokspan_list[tok_idx][0] and doc_idx < tokspan_list[tok_idx][1]:
-            # recurse with the lower half of the list
-            return self._find_tok_idx(a, tok_idx, tokspan_list, doc_idx)
-        elif doc_idx > tokspan_list[tok_idx][0] and doc_idx > tokspan_list[tok_idx][1]:
-            # recurse with the upper half of the list
-            return self._find_tok_idx(tok_idx, b, tokspan_list, doc_idx)
+        token_index = doc.token_index
+        return token_index.index_at(doc_start), token_index.index_at(doc_stop)
 
     def _set_negation_indexes(self, doc_obj, matched_negs_in_doc):
         negations = list()
@@ -154,19 +147,19 @@ class HutchNegEx(object):
         scope = self._recalculate_scope(t2, scope, window_wideners, label_toks)
         for i in range(t2, t2 + scope, 1):
             if i < len(label_toks):
-                current_word = label_toks[i]['text']
+                current_word = label_toks.texts[i]
                 if current_word in window_breakers:
                     return
-                while i < len(label_toks) and label_toks[i]['label'] != "O":
-                    label_toks[i] = self._add_negation_label(label_toks[i], label)
+                while i < len(label_toks) and not label_toks.is_outside(i):
+                    self._add_negation_label(label_toks, i, label)
                     i += 1
 
     def _scope_crawl_backward(self, t1, scope, label_toks, label):
         for i in range(t1, t1 - scope, -1):
             if i < len(label_toks):
-                if label_toks[i]['label'] != "O" :
-                    while label_toks[i]['label'] != "O":
-                        label_toks[i] = self._add_negation_label(label_toks[i], label)
+                if not label_toks.is_outside(i):
+                    while not label_toks.is_outside(i):
+                        self._add_negation_label(label_toks, i, label)
                         i -= 1
 
     def _create_negation_column_in_result_tuples(self, result_tuples):
@@ -181,20 +174,15 @@ class HutchNegEx(object):
         else:
             return result_tuples
 
-    def _add_negation_label(self, label_tok_dict, label):
-        if 'negation' not in label_tok_dict:
-            label_tok_dict['negation'] = label
-        else:
-            if self.types_we_care_about[label] > self.types_we_care_about[label_tok_dict['negation']]:
-                label_tok_dict['negation'] = label
-        return label_tok_dict
+    def _add_negation_label(self, label_toks, i, label):
+        label_toks.negate(i, self.types_we_care_about[label])
 
     def _recalculate_scope(self, start, scope, window_wideners, label_toks):
         new_scope = scope
-        relevant_tokens = label_toks[start-1:start+scope+15]
+        relevant_tokens = label_toks.texts[start-1:start+scope+15]
         stall=0
         for i, t in enumerate(relevant_tokens):
-            if t['text'] in window_wideners:
+            if t in window_wideners:
                 new_scope += 2
 
         return new_scope
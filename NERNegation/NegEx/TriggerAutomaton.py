@@ -0,0 +1,233 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import re
+
+# Non-ASCII characters that re.IGNORECASE matches against ASCII letters, mapped to the letter they match. Applied
+# before lower() so that folded text keeps the same length as the original
+_IGNORECASE_FOLDS = str.maketrans({u"İ": u"i", u"ı": u"i", u"ſ": u"s", u"K": u"k"})
+
+_QUANTIFIERS = {"*", "?", "{"}
+_WILDCARDS = {".", "^", "$"}
+
+
+def fold_text(text):
+    '''
+    Case-folds text so that any ASCII literal re.IGNORECASE would find in the text is a plain substring of the result
+    :param text: a string
+    :return: the folded string
+    '''
+    return text.translate(_IGNORECASE_FOLDS).lower()
+
+
+def _skip_group(pattern, i):
+    '''
+    Returns the index just past the group that opens at pattern[i]
+    '''
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            i = _skip_class(pattern, i)
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def _skip_class(pattern, i):
+    '''
+    Returns the index just past the character class that opens at pattern[i]
+    '''
+    i += 1
+    if i < len(pattern) and pattern[i] == "^":
+        i += 1
+    if i < len(pattern) and pattern[i] == "]":
+        i += 1
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
+    return i + 1
+
+
+def _skip_quantifier(pattern, i):
+    '''
+    Returns the index just past a quantifier starting at pattern[i], if there is one
+    '''
+    if i < len(pattern) and pattern[i] == "{":
+        i = pattern.find("}", i)
+        i = len(pattern) if i == -1 else i + 1
+    elif i < len(pattern) and pattern[i] in "*?+":
+        i += 1
+    if i < len(pattern) and pattern[i] in "?+":  # lazy or possessive modifier
+        i += 1
+    return i
+
+
+def extract_anchor(pattern):
+    '''
+    Finds the longest literal that must appear in any match of a regex. Only the top level of the pattern is read:
+    groups, classes, escapes and wildcards end a literal run, and a character followed by an optional quantifier is
+    dropped from it. Anchors are looked up in folded text, so case-sensitive patterns get none and are always run.
+    :param pattern: a compiled regex
+    :return: the folded anchor string, or None if no literal is guaranteed
+    '''
+    if pattern.flags & re.VERBOSE or not pattern.flags & re.IGNORECASE:
+        return None
+    source = pattern.pattern
+    fragments = list()
+    current = list()
+    i = 0
+    while i < len(source):
+        c = source[i]
+        if c == "|":
+            return None  # top level alternation: no single literal is required
+        if c in _QUANTIFIERS:
+            # the quantified character may be absent
+            if current:
+                current.pop()
+            fragments.append("".join(current))
+            current = list()
+            i = _skip_quantifier(source, i)
+            continue
+        if c == "+":
+            fragments.append("".join(current))
+            current = list()
+            i = _skip_quantifier(source, i)
+            continue
+        if c == "(" or c == "[" or c == "\\" or c in _WILDCARDS:
+            fragments.append("".join(current))
+            current = list()
+            if c == "(":
+                i = _skip_group(source, i)
+            elif c == "[":
+                i = _skip_class(source, i)
+            elif c == "\\":
+                i += 2
+            else:
+                i += 1
+            i = _skip_quantifier(source, i)
+            continue
+        current.append(c)
+        i += 1
+    fragments.append("".join(current))
+
+    anchor = max(fragments, key=len)
+    if not anchor or any(ord(ch) > 127 for ch in anchor):
+        return None
+    return anchor.lower()
+
+
+class AhoCorasick(object):
+    """
+    Keyword trie with failure links: reports every keyword occurring in a text, overlapping ones included, in a
+    single pass over the text.
+    """
+    def __init__(self, keywords):
+        self.transitions = [dict()]
+        self.outputs = [set()]
+        for keyword_id, keyword in enumerate(keywords):
+            state = 0
+            for ch in keyword:
+                if ch not in self.transitions[state]:
+                    self.transitions.append(dict())
+                    self.outputs.append(set())
+                    self.transitions[state][ch] = len(self.transitions) - 1
+                state = self.transitions[state][ch]
+            self.outputs[state].add(keyword_id)
+        self.fail = self._build_failure_links()
+
+    def _build_failure_links(self):
+        fail = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for ch, nxt in self.transitions[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in self.transitions[f]:
+                    f = fail[f]
+                fail[nxt] = self.transitions[f].get(ch, 0)
+                if fail[nxt] == nxt:  # children of the root fail back to the root
+                    fail[nxt] = 0
+                self.outputs[nxt] |= self.outputs[fail[nxt]]
+        return fail
+
+    def find_all(self, text):
+        '''
+        :param text: the string to scan
+        :return: set of ids (positions in the keyword list) of the keywords found in text
+        '''
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(ch, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+
+class TriggerAutomaton(object):
+    """
+    Matches all NegEx trigger patterns against a sentence in one pass. Each pattern is indexed under the longest
+    literal it requires; one Aho-Corasick scan of the folded sentence finds which of those literals occur, and only
+    the patterns that can match there (plus the few without a literal) are run, in their original order. The output
+    is identical to running every pattern's finditer in turn.
+    """
+    def __init__(self, patterns):
+        '''
+        :param patterns: list of (compiled regex, Type, Direction) tuples, in matching order
+        '''
+        self.patterns = patterns
+        anchors = list()
+        anchor_ids = dict()
+        self.patterns_by_anchor = list()
+        unanchored = list()
+        for idx, (regex, _, _) in enumerate(patterns):
+            anchor = extract_anchor(regex)
+            if anchor is None:
+                unanchored.append(idx)
+                continue
+            if anchor not in anchor_ids:
+                anchor_ids[anchor] = len(anchors)
+                anchors.append(anchor)
+                self.patterns_by_anchor.append(list())
+            self.patterns_by_anchor[anchor_ids[anchor]].append(idx)
+        self.unanchored = frozenset(unanchored)
+        self.anchors = anchors
+        self.automaton = AhoCorasick(anchors)
+
+    def candidates(self, text):
+        '''
+        :param text: a sentence
+        :return: sorted indexes of the patterns that may match somewhere in text
+        '''
+        candidates = set(self.unanchored)
+        for anchor_id in self.automaton.find_all(fold_text(text)):
+            candidates.update(self.patterns_by_anchor[anchor_id])
+        return sorted(candidates)
+
+    def match(self, text):
+        '''
+        :param text: a sentence
+        :return: list of (span, matched text, Type, Direction) tuples, as HutchNegEx._match_negation returns them
+        '''
+        negation_matches = list()
+        for idx in self.candidates(text):
+            regex, neg_type, direction = self.patterns[idx]
+            for m in regex.finditer(text):
+                negation_matches.append((m.span(), m.group(), neg_type, direction))
+        return negation_matches
+
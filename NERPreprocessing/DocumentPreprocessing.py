@@ -2,8 +2,14 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import logging
 import re
 from DataLoading.DataClasses import Sentence
+from NERPreprocessing.PreprocessingCache import get_cache
+from NERUtilities.RequestLogging import count
+
+# Number of texts handed to spaCy per nlp.pipe() batch
+DEFAULT_BATCH_SIZE = 64
 
 
 class DocumentPreprocessor(object):
@@ -13,11 +19,35 @@ class DocumentPreprocessor(object):
     Args:
         documents_info (TextDataLoader) - Dataloading object for text/tsv files. An instantiated object of this
     type contains all the information about the documents that we need.
+        batch_size (int) - number of texts spaCy parses per nlp.pipe() batch
+        n_process (int) - number of processes spaCy parses with (values > 1 require spaCy >= 2.2.2)
+        cache_dir (str) - directory of the preprocessing cache, defaults to $HUTCHNER_PREPROCESS_CACHE (no caching
+    if neither is set)
     """
-    def __init__(self, documents, spacy_model):
+    def __init__(self, documents, spacy_model, batch_size=DEFAULT_BATCH_SIZE, n_process=1, cache_dir=None):
         self.documents = documents
         self.nlppp = spacy_model
-        print("Processing documents...")
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache = get_cache(spacy_model, cache_dir)
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug("Processing documents...")
+
+    def _parse_texts(self, texts):
+        """
+        Streams texts through spaCy's nlp.pipe() so parsing runs over batches of texts rather than one call per text
+        :param texts: an iterable of strings
+        :return: an iterator of parsed spaCy Doc objects, in the same order as texts
+        """
+        if self.cache is not None:
+            # texts parsed before with the same spaCy model are read back instead of parsed again
+            return iter(self.cache.parse(texts, self._pipe))
+        return self._pipe(texts)
+
+    def _pipe(self, texts):
+        if self.n_process > 1:
+            return self.nlppp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process)
+        return self.nlppp.pipe(texts, batch_size=self.batch_size)
 
     def _add_doc_attributes(self, doc):
         """
@@ -40,26 +70,27 @@ class bratDocumentPreprocessor(DocumentPreprocessor):
     """ Ecapsulates the preprocessing pipeline specific to data sources in the i2b2 format:
             - IE: Every line is a list of space seperated tokens representing a single sentence
     """
-    def __init__(self, documents, spacy_model):
+    def __init__(self, documents, spacy_model, batch_size=DEFAULT_BATCH_SIZE, n_process=1, cache_dir=None):
 
-        super(bratDocumentPreprocessor, self).__init__(documents, spacy_model)
+        super(bratDocumentPreprocessor, self).__init__(documents, spacy_model, batch_size, n_process, cache_dir)
         docnum = 0
-        for docid, doc in self.documents.items():            
-            doc, doc.sentences = self._add_doc_attributes(doc)
+        docs = list(self.documents.values())
+        for doc, parsed_data in zip(docs, self._parse_texts(doc.text for doc in docs)):
+            doc, doc.sentences = self._add_doc_attributes(doc, parsed_data)
             
-            # move this to logging (ets)
             docnum += 1
             if docnum%100 == 0 or docnum >= len(self.documents.keys()):
-                print ('Processed %d documents out of %d' % (docnum, len(self.documents.keys())))
+                self.logger.debug('Processed %d documents out of %d', docnum, len(self.documents.keys()))
             #doc.is_i2b2 = True
             
-        print("Finished preprocessing documents.")
+        self.logger.debug("Finished preprocessing documents.")
 
-    def _add_doc_attributes(self, doc):
+    def _add_doc_attributes(self, doc, parsed_data=None):
         """
         Populate document token and token span lists
         """
-        parsed_data = self.nlppp(doc.text)
+        if parsed_data is None:
+            parsed_data = self.nlppp(doc.text)
         doc.tokens = [tok_obj for tok_obj in parsed_data]
         doc.token_spans = [(tok_obj.idx, tok_obj.idx+len(tok_obj.orth_)) for tok_obj in parsed_data]
         sentences = self._make_sentence_objects(doc, parsed_data)
@@ -83,16 +114,16 @@ class i2b2DocumentPreprocessor(DocumentPreprocessor):
     """ Ecapsulates the preprocessing pipeline specific to data sources in the i2b2 format:
             - IE: Every line is a list of space seperated tokens representing a single sentence
     """
-    def __init__(self, documents, spacy_model):
-        super(i2b2DocumentPreprocessor, self).__init__(documents, spacy_model)
+    def __init__(self, documents, spacy_model, batch_size=DEFAULT_BATCH_SIZE, n_process=1, cache_dir=None):
+        super(i2b2DocumentPreprocessor, self).__init__(documents, spacy_model, batch_size, n_process, cache_dir)
         docnum=0
         for docid, doc in self.documents.items():
             docnum+=1
             doc.sentences = self._text2parseddata(doc)
             if docnum%100 ==0 or docnum >= len(self.documents.keys()):
-                print ('Processed %d documents out of %d' % (docnum, len(self.documents.keys())))
+                self.logger.debug('Processed %d documents out of %d', docnum, len(self.documents.keys()))
             doc.is_i2b2 = True
-        print("Finished preprocessing documents.")
+        self.logger.debug("Finished preprocessing documents.")
 
     def _text2parseddata(self, doc):
         """
@@ -108,11 +139,9 @@ class i2b2DocumentPreprocessor(DocumentPreprocessor):
 
         if sentences[-1] == "":
             del sentences[-1] # get rid of meaningless trailing tokens
+        sentences = [sent_text if len(sent_text) > 0 else "\n" for sent_text in sentences]
 
-        for index,sent_text in enumerate(sentences):
-            if len(sent_text) == 0:
-                sent_text = "\n"
-            parsedData = self.nlppp(sent_text)
+        for index, (sent_text, parsedData) in enumerate(zip(sentences, self._parse_texts(sentences))):
             # update token spans
             updated_tok_spans = self._update_token_spans(begin, parsedData)
             doc.token_spans.extend(updated_tok_spans)
@@ -144,27 +173,29 @@ class UnformattedDocumentPreprocessor(DocumentPreprocessor):
     """ Ecapsulates the preprocessing pipeline specific to un-pre-formatted data sources (ie not i2b2).
      Just raw text.
      """
-    def __init__(self, documents, spacy_model):
-        super(UnformattedDocumentPreprocessor, self).__init__(documents, spacy_model)
+    def __init__(self, documents, spacy_model, batch_size=DEFAULT_BATCH_SIZE, n_process=1, cache_dir=None):
+        super(UnformattedDocumentPreprocessor, self).__init__(documents, spacy_model, batch_size, n_process, cache_dir)
         dnum = 0
-        for docid, doc in self.documents.items():
+        docs = list(self.documents.values())
+        for doc, parsedData in zip(docs, self._parse_texts(doc.text for doc in docs)):
             dnum += 1
-            if dnum % 100 == 0: # print status of every 100 docs to keep user updated
-                print ("Document pre-processing on doc " + str(dnum) + "/" + str(
-                    len(self.documents)))
-            doc.sentences = self._text2parseddata(doc)
-        print("Finished pre-processing documents.")
+            if dnum % 100 == 0: # log status of every 100 docs to keep user updated
+                self.logger.debug("Document pre-processing on doc %d/%d", dnum, len(self.documents))
+            doc.sentences = self._text2parseddata(doc, parsedData)
+            count("sentences", len(doc.sentences))
+        self.logger.debug("Finished pre-processing documents.")
 
-    def _text2parseddata(self, document):
+    def _text2parseddata(self, document, parsedData=None):
         """
         Given an document object, parse its text into sentence objects and set them in the Document object.
         Also populate the document's token list.
         :param doc: A Document object containing the document text.
+        :param parsedData: the spaCy parse of the document text, if it was already parsed in a batch
         :return: The Sentence objects derived from the document text
         """
-        text = document.text
         # parse the data
-        parsedData = self.nlppp(unicode(text))
+        if parsedData is None:
+            parsedData = self.nlppp(document.text)
         # store document tokens
         document.tokens = [x for x in parsedData]
         document.token_spans = [(x.idx, x.idx + len(x.orth_)) for x in parsedData]
@@ -176,4 +207,5 @@ class UnformattedDocumentPreprocessor(DocumentPreprocessor):
             spanend = span.end_char
             tokens = [parsedData[i] for i in range(span.start, span.end)]
             sent = Sentence(index, senttext, spanbegin, spanend, tokens)
+            sents.append(sent)
         return sents
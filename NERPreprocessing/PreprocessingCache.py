@@ -0,0 +1,130 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+import spacy
+from spacy.tokens import DocBin
+
+from NERUtilities.RequestLogging import count
+
+# Directory of the default cache; unset disables caching
+CACHE_DIR_ENV = "HUTCHNER_PREPROCESS_CACHE"
+
+# Token attributes stored per token. Lexical attributes (shape, cluster, ...) come back from the model's vocab, and
+# sentence boundaries from the dependency heads (or SENT_START when the model has no parser)
+_PARSED_ATTRS = ["ORTH", "SPACY", "TAG", "POS", "LEMMA", "HEAD", "DEP", "ENT_IOB", "ENT_TYPE"]
+_UNPARSED_ATTRS = ["ORTH", "SPACY", "TAG", "POS", "LEMMA", "SENT_START", "ENT_IOB", "ENT_TYPE"]
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def model_key(spacy_model):
+    '''
+    Identifies the spaCy pipeline a parse came from, so a model upgrade never reads stale parses
+    :return: string of spaCy version, model name and version and the pipeline components
+    '''
+    meta = spacy_model.meta
+    return "spacy-{}_{}_{}-{}_{}".format(spacy.__version__, meta.get("lang", ""), meta.get("name", ""),
+                                         meta.get("version", ""), "+".join(spacy_model.pipe_names))
+
+
+class PreprocessingCache(object):
+    """
+    Content-addressed store of spaCy parses. A text's parse is saved under the SHA-1 of the text, in one SQLite file
+    per spaCy pipeline, as a DocBin of its token attribute arrays. Cached parses come back as full spaCy Docs over
+    the model's vocab, so the preprocessors use them exactly like fresh ones.
+    """
+    def __init__(self, cache_dir, spacy_model):
+        self.spacy_model = spacy_model
+        self.key = model_key(spacy_model)
+        self.attrs = _PARSED_ATTRS if "parser" in spacy_model.pipe_names else _UNPARSED_ATTRS
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.key + ".sqlite")
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS docs (hash TEXT PRIMARY KEY, data BLOB)")
+
+    def _connection(self):
+        # sqlite connections can't be shared across threads
+        if getattr(self._local, "db", None) is None:
+            self._local.db = sqlite3.connect(self.path, timeout=60)
+        return self._local.db
+
+    def _hash(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, texts):
+        '''
+        :param texts: list of strings
+        :return: list with the cached Doc of each text, or None where it isn't cached
+        '''
+        hashes = [self._hash(text) for text in texts]
+        found = dict()
+        db = self._connection()
+        unique = list(set(hashes))
+        for i in range(0, len(unique), 500):  # stay under sqlite's host parameter limit
+            chunk = unique[i:i + 500]
+            rows = db.execute("SELECT hash, data FROM docs WHERE hash IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+            found.update(rows)
+        docs = list()
+        for h in hashes:
+            if h in found:
+                docs.append(next(DocBin().from_bytes(found[h]).get_docs(self.spacy_model.vocab)))
+            else:
+                docs.append(None)
+        return docs
+
+    def put_many(self, texts, docs):
+        rows = list()
+        for text, doc in zip(texts, docs):
+            doc_bin = DocBin(attrs=self.attrs)
+            doc_bin.add(doc)
+            rows.append((self._hash(text), sqlite3.Binary(doc_bin.to_bytes())))
+        with self._connection() as db:
+            db.executemany("INSERT OR REPLACE INTO docs (hash, data) VALUES (?, ?)", rows)
+
+    def parse(self, texts, parse_fn):
+        '''
+        Parses texts, taking what it can from the cache and sending only the rest to spaCy
+        :param texts: iterable of strings
+        :param parse_fn: function taking a list of texts and returning an iterable of their parsed Docs
+        :return: list of Docs in the same order as texts
+        '''
+        texts = list(texts)
+        docs = self.get_many(texts)
+        missing = [i for i, doc in enumerate(docs) if doc is None]
+        count("preprocess_cache_hits", len(texts) - len(missing))
+        count("preprocess_cache_misses", len(missing))
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            parsed = list(parse_fn(missing_texts))
+            self.put_many(missing_texts, parsed)
+            for i, doc in zip(missing, parsed):
+                docs[i] = doc
+        self.logger.debug("%d of %d parses read from the preprocessing cache", len(texts) - len(missing), len(texts))
+        return docs
+
+
+def get_cache(spacy_model, cache_dir=None):
+    '''
+    Returns the shared cache for a spaCy pipeline
+    :param spacy_model: the loaded spaCy pipeline
+    :param cache_dir: cache directory, defaults to $HUTCHNER_PREPROCESS_CACHE
+    :return: PreprocessingCache, or None if no directory is configured
+    '''
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    key = (os.path.abspath(cache_dir), id(spacy_model))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = PreprocessingCache(cache_dir, spacy_model)
+        return _caches[key]
@@ -55,6 +55,13 @@ def get_testing_args():
                         help="brat or i2b2 (defaults to brat)")
     parser.add_argument("-en", "--encoding", 
                         help="text encoding (defaults to ISO-8859-1)")
+    parser.add_argument("-nw", "--n_workers", type=int, default=1,
+                        help="number of worker processes to run CRF tagging in (defaults to 1)")
+    parser.add_argument("-pf", "--prefilter",
+                        help="sentence prefilter file (<model>.prefilter.json) to tag with; its recall on the "
+                             "evaluation documents is reported first")
+    parser.add_argument("-pt", "--prefilter_threshold", type=float,
+                        help="threshold to run the prefilter at (defaults to the one saved with it)")
     
     action = parser.add_mutually_exclusive_group(required=True)
     action.add_argument("-s", "--section",
@@ -97,3 +104,64 @@ def get_labkey_predict_args():
 
     args = parser.parse_args()
     return args
+
+
+def get_multi_training_args():
+    """
+    Defines the command line arguments necessary to train several models over one corpus
+    :return: the command line arguments provided from stdin
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--textdir",
+                        help="The directory containing your raw training data", required=True)
+    parser.add_argument("-a", "--annots",
+                        help="The path to the directory housing annotations locally", required=True)
+    parser.add_argument("-c", "--models",
+                        help="JSON file listing the models to train as [{\"model_name\": ..., \"labels\": [...]}, ...]",
+                        required=True)
+    parser.add_argument("-at", "--anno_type",
+                        help="brat or i2b2 (defaults to brat)")
+    parser.add_argument("-nw", "--n_workers", type=int,
+                        help="number of models trained at once (defaults to the number of CPUs)")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_benchmark_args():
+    """
+    Defines the command line arguments necessary to benchmark the pipeline stages
+    :return: the command line arguments provided from stdin
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default="10,100,1000",
+                        help="Comma separated corpus sizes, in documents (defaults to 10,100,1000)")
+    parser.add_argument("-n", "--tokens", type=int, default=400, help="Mean words per generated note")
+    parser.add_argument("-d", "--density", type=float, default=0.1,
+                        help="Fraction of words inside a concept in the generated notes")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Timed passes per stage")
+    parser.add_argument("-w", "--warmup", type=int, default=1, help="Untimed passes per stage before timing")
+    parser.add_argument("--seed", type=int, default=13, help="Random seed of the generated notes")
+    parser.add_argument("--stages", help="Comma separated stages to time (defaults to all)")
+    parser.add_argument("--standin", action="store_true",
+                        help="Use the stand-in models even where the deployed ones are present")
+    parser.add_argument("--work_dir", help="Where stand-in models are built (defaults to a temporary directory)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Results file")
+
+    args = parser.parse_args()
+    return args
+
+
+def get_benchmark_compare_args():
+    """
+    Defines the command line arguments necessary to compare two benchmark results files
+    :return: the command line arguments provided from stdin
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline", help="Results file of the reference commit")
+    parser.add_argument("candidate", help="Results file of the commit under test")
+    parser.add_argument("-th", "--threshold", type=float, default=1.1,
+                        help="Slowdown ratio reported as a regression (defaults to 1.1)")
+
+    args = parser.parse_args()
+    return args
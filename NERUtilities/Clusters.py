@@ -2,47 +2,231 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import logging
+import mmap
+import os
 import re
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Characters cluster_lookup strips before its third probe, and the digit folding used for the fourth
+_STRIP_CHARS = "(){}<>,.?/:;"
+_STRIP_TABLE = str.maketrans("", "", _STRIP_CHARS)
+_ZEROS_TABLE = str.maketrans("123456789", "000000000")
+_STRIP_RE = re.compile(r'[(){}<>,.?/:;]')
+_DIGIT_RE = re.compile(r'\d')
+
+INDEX_SUFFIX = ".idx"
+_INDEX_MAGIC = b"HNCI"
+_INDEX_VERSION = 1
+# magic, version, byte order, source size, source mtime (ns), number of words, number of cluster ids
+_HEADER = struct.Struct("<4sIIQQII")
+_BYTEORDER = 1 if sys.byteorder == "little" else 2
+
+# Number of distinct token forms whose lookup result is remembered per index
+MEMO_SIZE = 500000
+
+# Compiled indexes are shared by every Clusters object built from the same file
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def _lookup_forms(word):
+    '''
+    The keys cluster_lookup probes for a token, in priority order: as is, lower cased, lower cased with punctuation
+    stripped, and the latter with digits replaced by 0
+    '''
+    lower_word = word.lower()
+    try:
+        lower_word.encode("ascii")
+    except UnicodeEncodeError:
+        # \d also matches non ASCII digits, which the translate table does not cover
+        lower_stripped_word = _STRIP_RE.sub('', lower_word)
+        lower_stripped_zeros_word = _DIGIT_RE.sub('0', lower_stripped_word)
+    else:
+        lower_stripped_word = lower_word.translate(_STRIP_TABLE)
+        lower_stripped_zeros_word = lower_stripped_word.translate(_ZEROS_TABLE)
+    return word, lower_word, lower_stripped_word, lower_stripped_zeros_word
+
+
+def _read_cluster_file(filepath):
+    '''
+    Parses a k-means cluster file (one "cluster id<TAB>space separated words" line per cluster)
+    :return: dict of word -> cluster id. A word listed under several clusters maps to the last one
+    '''
+    words2cluster = dict()
+    with open(filepath, encoding="utf8") as f:
+        for line in f:
+            cid_vec = line.split("\t")
+            cid = cid_vec[0]
+            for word in cid_vec[1].split():
+                words2cluster[word] = cid
+    return words2cluster
+
+
+def _build_index_bytes(words2cluster, source_stat):
+    '''
+    Serializes a word -> cluster id map into the compiled index layout: a header, then word offsets, the cluster id
+    number of each word and cluster id offsets (all uint32), then the UTF-8 word and cluster id blobs. Words are
+    sorted by their UTF-8 bytes so they can be binary searched in place.
+    '''
+    encoded = sorted((word.encode("utf8"), cid) for word, cid in words2cluster.items())
+    cids = sorted(set(words2cluster.values()))
+    cid_numbers = {cid: n for n, cid in enumerate(cids)}
+
+    word_offsets = array("I", [0])
+    word_cids = array("I")
+    for word, cid in encoded:
+        word_offsets.append(word_offsets[-1] + len(word))
+        word_cids.append(cid_numbers[cid])
+    cid_offsets = array("I", [0])
+    encoded_cids = [cid.encode("utf8") for cid in cids]
+    for cid in encoded_cids:
+        cid_offsets.append(cid_offsets[-1] + len(cid))
+
+    header = _HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, _BYTEORDER, source_stat.st_size, source_stat.st_mtime_ns,
+                          len(encoded), len(cids))
+    return b"".join([header, word_offsets.tobytes(), word_cids.tobytes(), cid_offsets.tobytes(),
+                     b"".join(word for word, _ in encoded), b"".join(encoded_cids)])
+
+
+class ClusterIndex(object):
+    """
+    Read-only word -> cluster id map over a compiled index buffer (normally an mmap of the .idx file). Nothing but
+    the uint32 tables is unpacked; words are binary searched in the buffer and results are memoized per token.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        magic, version, byteorder, self.source_size, self.source_mtime, n_words, n_cids = _HEADER.unpack_from(buf)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION or byteorder != _BYTEORDER:
+            raise ValueError("Not a compatible cluster index")
+        view = memoryview(buf)
+        pos = _HEADER.size
+        self.word_offsets = view[pos:pos + 4 * (n_words + 1)].cast("I")
+        pos += 4 * (n_words + 1)
+        self.word_cids = view[pos:pos + 4 * n_words].cast("I")
+        pos += 4 * n_words
+        cid_offsets = view[pos:pos + 4 * (n_cids + 1)].cast("I")
+        pos += 4 * (n_cids + 1)
+        self.words = view[pos:pos + self.word_offsets[n_words]]
+        pos += self.word_offsets[n_words]
+        cid_blob = bytes(view[pos:pos + cid_offsets[n_cids]])
+        # there are only a few hundred cluster ids, so they are decoded up front
+        self.cids = [cid_blob[cid_offsets[n]:cid_offsets[n + 1]].decode("utf8") for n in range(n_cids)]
+        self.n_words = n_words
+        self.memo = dict()
+
+    def __len__(self):
+        return self.n_words
+
+    def __getitem__(self, i):
+        return bytes(self.words[self.word_offsets[i]:self.word_offsets[i + 1]])
+
+    def get(self, word):
+        '''
+        :param word: an exact key
+        :return: its cluster id, or None if it is not in the index
+        '''
+        key = word.encode("utf8")
+        i = bisect_left(self, key)
+        if i < self.n_words and self[i] == key:
+            return self.cids[self.word_cids[i]]
+        return None
+
+    def lookup(self, word):
+        '''
+        Resolves a token the way Clusters.cluster_lookup always has: the first of its lookup forms that is in the
+        index wins
+        '''
+        try:
+            return self.memo[word]
+        except KeyError:
+            pass
+        cid = None
+        for form in _lookup_forms(word):
+            cid = self.get(form)
+            if cid is not None:
+                break
+        if len(self.memo) >= MEMO_SIZE:
+            self.memo.clear()
+        self.memo[word] = cid
+        return cid
+
+
+def compile_index(filepath, index_path=None):
+    '''
+    Builds the compiled index for a cluster file and writes it next to the source
+    :param filepath: path to the k-means cluster file
+    :param index_path: where to write the index, defaults to filepath + ".idx"
+    :return: the index bytes
+    '''
+    index_path = index_path or filepath + INDEX_SUFFIX
+    data = _build_index_bytes(_read_cluster_file(filepath), os.stat(filepath))
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # read only resource directory: the index is still usable from memory
+        logger.warning("Could not write cluster index %s", index_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return data
+
+
+def load_index(filepath):
+    '''
+    Opens the compiled index of a cluster file, (re)building it if it is missing or older than the source. Indexes
+    are cached per path, so repeated loads share one mapping
+    :param filepath: path to the k-means cluster file
+    :return: ClusterIndex
+    '''
+    key = os.path.abspath(filepath)
+    with _indexes_lock:
+        if key in _indexes:
+            return _indexes[key]
+        source_stat = os.stat(filepath)
+        index_path = filepath + INDEX_SUFFIX
+        index = None
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "rb") as f:
+                    index = ClusterIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                if (index.source_size, index.source_mtime) != (source_stat.st_size, source_stat.st_mtime_ns):
+                    index = None
+            except (ValueError, struct.error):
+                index = None
+        if index is None:
+            index = ClusterIndex(compile_index(filepath, index_path))
+        _indexes[key] = index
+        return index
 
 
 class Clusters:
     def __init__(self, cluster_dir):
         self.cluster_dir = cluster_dir
-        self.clusters2words, self.words2cluster = self._load_clusters(cluster_dir)
-
-    def _load_clusters(self, filepath):
-        if not filepath:
-            return None, None
-        cluster2words = dict()
-        words2cluster=dict()
-        with open(filepath, encoding="utf8") as f:
-            lines = f.readlines()
-            for line in lines:
-                cid_vec = line.split("\t")
-                cid = cid_vec[0]
-                words = set(cid_vec[1].split())
-                for word in words:
-                    words2cluster[word] = cid
-                cluster2words[cid] = words
-        return cluster2words, words2cluster
+        self.index = load_index(cluster_dir) if cluster_dir else None
 
     def get_list_clusters(self, clusters, tokens):
         if not clusters:
             return None
         else:
-            return [self.cluster_lookup(tokens[i].orth_) for i in range(len(tokens))]
+            return self.lookup_many([token.orth_ for token in tokens])
 
     def cluster_lookup(self, word):
-        lower_word = word.lower()
-        lower_stripped_word = re.sub(r'[(){}<>,.?/:;]', '', word.lower())
-        lower_stripped_zeros_word = re.sub(r'\d', '0', lower_stripped_word)
-
-        if word in self.words2cluster:
-            return self.words2cluster[word]
-        if lower_word in self.words2cluster:
-            return self.words2cluster[lower_word]
-        if lower_stripped_word in self.words2cluster:
-            return self.words2cluster[lower_stripped_word]
-        if lower_stripped_zeros_word in self.words2cluster:
-            return self.words2cluster[lower_stripped_zeros_word]
-        return None
+        return self.index.lookup(word)
+
+    def lookup_many(self, tokens):
+        '''
+        Looks up a batch of tokens
+        :param tokens: list of token strings
+        :return: list of cluster ids (None where a token has no cluster), in the same order
+        '''
+        lookup = self.index.lookup
+        return [lookup(token) for token in tokens]
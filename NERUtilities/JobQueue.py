@@ -0,0 +1,302 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from NERUtilities.RequestLogging import request_counters
+
+logger = logging.getLogger(__name__)
+
+# Documents tagged per pipeline call; results become visible a chunk at a time
+DEFAULT_CHUNK_SIZE = 100
+
+# Finished jobs are deleted this long after they last changed
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+_JOB_FILE = "job.json"
+_LOCK_FILE = "worker.lock"
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Distinguishes this process from an earlier one that had the same pid (e.g. a restarted container)
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+
+def _write_json(path, obj):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore(object):
+    """
+    On-disk store of batch jobs, one directory per job: job.json with the job's status and progress, the submitted
+    documents split into input chunks, and one result file per finished chunk holding the pipeline's JSON output for
+    it. Every file is replaced atomically, so any thread or process can read a job while a worker updates it. A job is
+    run by whichever process holds its worker.lock.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _path(self, job_id, *parts):
+        if not _JOB_ID_RE.match(job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.root, job_id, *parts)
+
+    def create(self, pipeline, alg_type, documents, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Stores a new job and its documents
+        :param pipeline: name of the pipeline to run, e.g. "ner_neg"
+        :param alg_type: the model the pipeline tags with
+        :param documents: dict of document id -> text, kept in order
+        :param chunk_size: documents per chunk
+        :return: the job's status dict
+        '''
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._path(job_id, "input"))
+        os.makedirs(self._path(job_id, "results"))
+        items = list(documents.items())
+        chunk_sizes = list()
+        for n, start in enumerate(range(0, len(items), chunk_size)):
+            chunk = dict(items[start:start + chunk_size])
+            _write_json(self._path(job_id, "input", "%05d.json" % n), chunk)
+            chunk_sizes.append(len(chunk))
+        job = {"job_id": job_id,
+               "pipeline": pipeline,
+               "alg_type": alg_type,
+               "status": QUEUED,
+               "documents": len(items),
+               "documents_done": 0,
+               "chunks": len(chunk_sizes),
+               "chunks_done": 0,
+               "chunk_sizes": chunk_sizes,
+               "submitted": _now(),
+               "started": None,
+               "finished": None,
+               "error": None}
+        _write_json(self._path(job_id, _JOB_FILE), job)
+        return job
+
+    def status(self, job_id):
+        '''
+        :return: the job's status dict, None for an unknown job
+        '''
+        try:
+            return _read_json(self._path(job_id, _JOB_FILE))
+        except (KeyError, IOError):
+            return None
+
+    def update(self, job_id, **fields):
+        '''
+        :return: the job's status dict with fields replaced
+        '''
+        with self._lock:
+            job = _read_json(self._path(job_id, _JOB_FILE))
+            job.update(fields)
+            _write_json(self._path(job_id, _JOB_FILE), job)
+        return job
+
+    def chunk_input(self, job_id, n):
+        return _read_json(self._path(job_id, "input", "%05d.json" % n))
+
+    def write_result(self, job_id, n, result_json):
+        '''
+        :param result_json: the pipeline's JSON output for chunk n
+        '''
+        path = self._path(job_id, "results", "%05d.json" % n)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(result_json)
+        os.replace(path + ".tmp", path)
+
+    def has_result(self, job_id, n):
+        return os.path.exists(self._path(job_id, "results", "%05d.json" % n))
+
+    def results(self, job_id, chunk=None):
+        '''
+        Merges the results of the job's finished chunks
+        :param chunk: only return this chunk's results
+        :return: dict of document id -> result, in submission order
+        '''
+        job = self.status(job_id)
+        merged = dict()
+        for n in ([chunk] if chunk is not None else range(job["chunks"])):
+            if self.has_result(job_id, n):
+                merged.update(_read_json(self._path(job_id, "results", "%05d.json" % n)))
+        return merged
+
+    def claim(self, job_id):
+        '''
+        Takes the job's worker lock for this process; a lock left by a process that is gone is taken over
+        :return: True if this process now runs the job
+        '''
+        path = self._path(job_id, _LOCK_FILE)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(path) as f:
+                        pid, token = f.read().split(":")
+                except (IOError, ValueError):
+                    return False  # being written by the process taking it
+                if (int(pid) != os.getpid() and _pid_alive(int(pid))) or token == _PROCESS_TOKEN:
+                    return False
+                logger.info("Taking over job %s from stopped process %s", job_id, pid)
+                os.remove(path)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write("%d:%s" % (os.getpid(), _PROCESS_TOKEN))
+            return True
+        return False
+
+    def release(self, job_id):
+        try:
+            os.remove(self._path(job_id, _LOCK_FILE))
+        except OSError:
+            pass
+
+    def job_ids(self):
+        return [name for name in os.listdir(self.root) if _JOB_ID_RE.match(name)]
+
+    def unfinished(self):
+        '''
+        :return: ids of queued and running jobs, oldest first
+        '''
+        jobs = [self.status(job_id) for job_id in self.job_ids()]
+        return [job["job_id"] for job in sorted((j for j in jobs if j and j["status"] in (QUEUED, RUNNING)),
+                                                key=lambda j: j["submitted"])]
+
+    def purge(self, max_age=DEFAULT_RETENTION_SECONDS):
+        '''
+        Deletes finished and failed jobs that haven't changed for max_age seconds
+        '''
+        cutoff = time.time() - max_age
+        for job_id in self.job_ids():
+            job = self.status(job_id)
+            try:
+                expired = job is not None and job["status"] in (DONE, FAILED) \
+                    and os.path.getmtime(self._path(job_id, _JOB_FILE)) < cutoff
+            except OSError:
+                continue
+            if expired:
+                logger.info("Deleting expired job %s", job_id)
+                shutil.rmtree(self._path(job_id), ignore_errors=True)
+
+
+class JobQueue(object):
+    """
+    Runs batch jobs in background threads of the web service, so large submissions don't tie up a request thread or
+    hit proxy timeouts. Jobs are taken in submission order; a job's chunks go through the pipeline one at a time and
+    each chunk's results are stored as soon as it is done. Unfinished jobs left by a stopped process are picked up
+    again on start(), from the first chunk without results.
+    """
+    def __init__(self, store, pipelines, n_workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                 retention=DEFAULT_RETENTION_SECONDS):
+        '''
+        :param store: JobStore
+        :param pipelines: dict of pipeline name -> function(documents, alg_type) returning the JSON results string
+        :param n_workers: number of jobs run at once
+        :param chunk_size: documents per pipeline call
+        :param retention: seconds finished jobs are kept
+        '''
+        self.store = store
+        self.pipelines = pipelines
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.retention = retention
+        self._queue = queue.Queue()
+        self._threads = list()
+
+    def start(self):
+        '''
+        Starts the worker threads and requeues the unfinished jobs no other live process is running
+        '''
+        self.store.purge(self.retention)
+        for job_id in self.store.unfinished():
+            if self.store.claim(job_id):
+                logger.info("Resuming job %s", job_id)
+                self._queue.put(job_id)
+        for i in range(self.n_workers):
+            thread = threading.Thread(target=self._work, name="hutchner-job-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, pipeline, alg_type, documents):
+        '''
+        :param pipeline: a key of pipelines
+        :param alg_type: the model to tag with
+        :param documents: dict of document id -> text
+        :return: the new job's status dict
+        '''
+        if pipeline not in self.pipelines:
+            raise KeyError(pipeline)
+        self.store.purge(self.retention)
+        job = self.store.create(pipeline, alg_type, documents, self.chunk_size)
+        self.store.claim(job["job_id"])
+        self._queue.put(job["job_id"])
+        logger.info("Queued job %s: %d documents for %s/%s", job["job_id"], job["documents"], pipeline, alg_type)
+        return job
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception:
+                logger.exception("Job %s failed", job_id)
+            finally:
+                self.store.release(job_id)
+                self._queue.task_done()
+
+    def _run(self, job_id):
+        job = self.store.status(job_id)
+        job = self.store.update(job_id, status=RUNNING, started=job["started"] or _now())
+        labels = {"endpoint": "/jobs/" + job["pipeline"], "alg_type": job["alg_type"]}
+        try:
+            for n in range(job["chunks"]):
+                if self.store.has_result(job_id, n):
+                    continue
+                documents = self.store.chunk_input(job_id, n)
+                name = "/jobs/%s/%s %s chunk %d/%d" % (job["pipeline"], job["alg_type"], job_id, n + 1, job["chunks"])
+                with request_counters(name, logger, labels):
+                    result = self.pipelines[job["pipeline"]](documents, job["alg_type"])
+                self.store.write_result(job_id, n, result)
+                job = self.store.update(job_id, chunks_done=n + 1, documents_done=sum(job["chunk_sizes"][:n + 1]))
+        except Exception as e:
+            self.store.update(job_id, status=FAILED, error=str(e) or e.__class__.__name__, finished=_now())
+            raise
+        self.store.update(job_id, status=DONE, finished=_now())
+        logger.info("Finished job %s: %d documents", job_id, job["documents"])
@@ -0,0 +1,113 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the latency histograms, in seconds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Upper bounds of the size histograms (tokens, documents)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram in the Prometheus sense: per-bucket counts of observations at or below each bound, plus
+    their count and sum
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for n in self.counts:
+            total += n
+            yield total
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+class MetricsRegistry(object):
+    """
+    Process-wide histograms and counters, labelled (e.g. by endpoint and alg_type) and rendered in the Prometheus
+    text exposition format
+    """
+    def __init__(self):
+        self._histograms = dict()  # (name, labels) -> Histogram
+        self._counters = dict()  # (name, labels) -> value
+        self._help = dict()
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, labels=None, buckets=SECONDS_BUCKETS):
+        '''
+        Adds an observation to a histogram, creating it on first use
+        :param name: metric name
+        :param value: observed value
+        :param labels: dict of label name -> value
+        :param buckets: bucket bounds, used when the histogram is created
+        '''
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        '''
+        :return: every metric in the Prometheus text format
+        '''
+        lines = list()
+        with self._lock:
+            for name in sorted(set(name for name, _ in self._counters)):
+                if name in self._help:
+                    lines.append("# HELP %s %s" % (name, self._help[name]))
+                lines.append("# TYPE %s counter" % name)
+                for (n, labels), value in sorted(self._counters.items()):
+                    if n == name:
+                        lines.append("%s%s %s" % (name, _format_labels(labels), value))
+            for name in sorted(set(name for name, _ in self._histograms)):
+                if name in self._help:
+                    lines.append("# HELP %s %s" % (name, self._help[name]))
+                lines.append("# TYPE %s histogram" % name)
+                for (n, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    bounds = [repr(float(b)) for b in histogram.buckets] + ["+Inf"]
+                    for bound, total in zip(bounds, histogram.cumulative_counts()):
+                        lines.append("%s_bucket%s %d" % (name, _format_labels(labels, ("le", bound)), total))
+                    lines.append("%s_sum%s %s" % (name, _format_labels(labels), repr(histogram.sum)))
+                    lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+# The metrics the web service exposes at /metrics
+metrics = MetricsRegistry()
+metrics.describe("hutchner_request_seconds", "Wall time of a request")
+metrics.describe("hutchner_stage_seconds", "Time spent in one pipeline stage of a request")
+metrics.describe("hutchner_stage_seconds_per_document", "Time spent in a pipeline stage per document of the request")
+metrics.describe("hutchner_document_tokens", "Tokens per tagged document")
+metrics.describe("hutchner_request_tokens", "Tokens per request")
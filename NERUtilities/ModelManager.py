@@ -0,0 +1,68 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+from collections import OrderedDict
+
+from NERExtraction import ParallelExtraction
+from NERUtilities.ResourceRegistry import ResourceRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class ModelManager(ResourceRegistry):
+    """
+    Registry for the tagging models, keyed the same way as the alg_type route parameter. Models are loaded on first
+    use and at most max_resident of them (not counting pinned ones) stay loaded; past that the least recently used
+    model is dropped and reloaded when it is next asked for. Supports models[name] so it can stand in for the plain
+    models dict the pipelines take.
+    """
+    def __init__(self, max_resident=None, pinned=()):
+        '''
+        :param max_resident: number of unpinned models kept loaded, None for no limit
+        :param pinned: names that are never evicted (e.g. the spaCy model every pipeline needs)
+        '''
+        super(ModelManager, self).__init__()
+        self.max_resident = max_resident
+        self.pinned = set(pinned)
+        self._recent = OrderedDict()
+
+    def get(self, name):
+        model = super(ModelManager, self).get(name)
+        with self._lock:
+            self._recent.pop(name, None)
+            self._recent[name] = True
+            self._evict()
+        return model
+
+    def _evict(self):
+        if self.max_resident is None:
+            return
+        resident = [name for name in self._recent if name not in self.pinned and self.is_loaded(name)]
+        for name in resident[:max(0, len(resident) - self.max_resident)]:
+            logger.info("Evicting model '%s'", name)
+            self.unload(name)
+            del self._recent[name]
+
+    def unload(self, name):
+        '''
+        Drops a loaded model along with its CRF tagging pool, whose workers hold their own copies of it
+        '''
+        super(ModelManager, self).unload(name)
+        ParallelExtraction.close_pool(name)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name in self._loaders
+
+    def keys(self):
+        return list(self._loaders)
+
+    def report(self):
+        report = super(ModelManager, self).report()
+        for entry in report:
+            entry["pinned"] = entry["name"] in self.pinned
+        return report
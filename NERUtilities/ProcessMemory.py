@@ -0,0 +1,50 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import gc
+import os
+import resource
+
+# smaps fields reported by memory_report, as (smaps name, report key)
+_SMAPS_FIELDS = [("Rss", "rss_kb"), ("Pss", "pss_kb"), ("Shared_Clean", "shared_clean_kb"),
+                 ("Shared_Dirty", "shared_dirty_kb"), ("Private_Clean", "private_clean_kb"),
+                 ("Private_Dirty", "private_dirty_kb"), ("Swap", "swap_kb")]
+
+
+def prepare_for_fork():
+    '''
+    Call in the master process once everything shared has been loaded, right before the server forks its workers.
+    Collects garbage and then moves every surviving object into the permanent generation, so the workers' garbage
+    collector never writes to (and so never copies) the pages holding the preloaded models.
+    '''
+    gc.collect()
+    if hasattr(gc, "freeze"):  # Python 3.7+
+        gc.freeze()
+
+
+def _read_smaps(path):
+    totals = dict((key, 0) for _, key in _SMAPS_FIELDS)
+    names = dict(_SMAPS_FIELDS)
+    with open(path) as f:
+        for line in f:
+            field, _, rest = line.partition(":")
+            if field in names:
+                totals[names[field]] += int(rest.split()[0])
+    return totals
+
+
+def memory_report():
+    '''
+    Describes this process's memory. Shared pages are the ones still shared copy-on-write with the master (or other
+    processes); private dirty pages are this worker's own copy.
+    :return: dict of pid and sizes in kB. Without /proc only the peak RSS is available.
+    '''
+    report = {"pid": os.getpid(), "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    for path in ("/proc/self/smaps_rollup", "/proc/self/smaps"):
+        if os.path.exists(path):
+            report.update(_read_smaps(path))
+            report["shared_kb"] = report["shared_clean_kb"] + report["shared_dirty_kb"]
+            report["private_kb"] = report["private_clean_kb"] + report["private_dirty_kb"]
+            break
+    return report
@@ -0,0 +1,131 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from NERUtilities.RequestLogging import request_counters, timed
+
+logger = logging.getLogger(__name__)
+
+# Longest a request waits for others to join its batch, in seconds
+DEFAULT_MAX_WAIT = 0.005
+
+# Most documents tagged in one batch; requests with at least this many documents are tagged on their own
+DEFAULT_MAX_BATCH = 32
+
+
+class _Request(object):
+    def __init__(self, documents):
+        self.documents = documents
+        self.arrived = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class RequestCoalescer(object):
+    """
+    Merges concurrent small requests for the same model into one pipeline call, so spaCy parsing, featurization and
+    decoding run batched instead of once per request. The first request to arrive waits at most max_wait for others;
+    while a batch is being tagged, new requests queue up and form the next one. Each request gets back exactly its own
+    documents' results, under its own document ids.
+    """
+    def __init__(self, name, tag, max_wait=DEFAULT_MAX_WAIT, max_batch=DEFAULT_MAX_BATCH):
+        '''
+        :param name: pipeline name, used in the batch log lines and metrics labels
+        :param tag: function(documents, alg_type) returning a dict of doc_id -> response record
+        :param max_wait: seconds the oldest queued request may wait before its batch starts
+        :param max_batch: most documents per batch
+        '''
+        self.name = name
+        self.tag = tag
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = defaultdict(list)
+        self._thread = None
+
+    def main(self, documents, alg_type):
+        '''
+        Tags documents along with whatever other requests arrive meanwhile
+        :param documents: dict of doc_id -> text
+        :return: the JSON response, as the pipeline's main() returns it
+        '''
+        if len(documents) >= self.max_batch:
+            results = self.tag(documents, alg_type)
+        else:
+            request = _Request(documents)
+            with self._cond:
+                if self._thread is None:
+                    # started on first use, so that it runs in the process that serves the requests
+                    self._thread = threading.Thread(target=self._dispatch, name="hutchner-coalescer-" + self.name)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._pending[alg_type].append(request)
+                self._cond.notify()
+            with timed("coalesce"):
+                request.done.wait()
+            if request.error is not None:
+                raise request.error
+            results = request.results
+        with timed("serialize"):
+            return json.dumps(results, ensure_ascii=False)
+
+    def _next_batch(self):
+        '''
+        Waits for the oldest queued request's batch to fill or its wait to run out
+        :return: (alg_type, list of _Request)
+        '''
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            alg_type = min(self._pending, key=lambda a: self._pending[a][0].arrived)
+            queued = self._pending[alg_type]
+            deadline = queued[0].arrived + self.max_wait
+            while sum(len(r.documents) for r in queued) < self.max_batch and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            batch, size = list(), 0
+            while queued and (not batch or size + len(queued[0].documents) <= self.max_batch):
+                size += len(queued[0].documents)
+                batch.append(queued.pop(0))
+            if not queued:
+                del self._pending[alg_type]
+            return alg_type, batch
+
+    def _dispatch(self):
+        while True:
+            alg_type, batch = self._next_batch()
+            try:
+                self._run(alg_type, batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                    batch[0].done.set()
+                    continue
+                # don't let one bad request fail the others: tag them one by one
+                logger.warning("Batch of %d requests failed (%s), retrying them separately", len(batch), e)
+                for request in batch:
+                    try:
+                        self._run(alg_type, [request])
+                    except Exception as e:
+                        request.error = e
+                        request.done.set()
+
+    def _run(self, alg_type, batch):
+        # document ids are only unique within a request, so they're prefixed with the request's place in the batch
+        documents = dict()
+        for n, request in enumerate(batch):
+            for doc_id, text in request.documents.items():
+                documents["%d/%s" % (n, doc_id)] = text
+        name = "%s/%s coalesced batch of %d requests" % (self.name, alg_type, len(batch))
+        with request_counters(name, logger, {"endpoint": "/" + self.name + "_batch", "alg_type": alg_type}):
+            results = self.tag(documents, alg_type)
+        for n, request in enumerate(batch):
+            request.results = dict((doc_id, results["%d/%s" % (n, doc_id)]) for doc_id in request.documents
+                                   if "%d/%s" % (n, doc_id) in results)
+            request.done.set()
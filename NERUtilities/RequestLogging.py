@@ -0,0 +1,131 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from NERUtilities.Metrics import COUNT_BUCKETS, metrics
+
+# Level for per-token diagnostics, below DEBUG so that debug logging to file doesn't turn them on
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_local = threading.local()
+
+
+class RequestCounters(object):
+    """
+    Aggregated counts (documents, sentences, tokens, labelled tokens...), per-stage timings and per-document sizes
+    for the work done on behalf of one request
+    """
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or dict()
+        self.counts = Counter()
+        self.stage_seconds = Counter()
+        self.observations = defaultdict(list)
+        self.start = time.time()
+        self.failed = False
+
+    def add(self, key, n=1):
+        self.counts[key] += n
+
+    def add_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def observe(self, key, value):
+        self.observations[key].append(value)
+
+    def summary(self):
+        '''
+        :return: the counters and stage timings as a "key=value" string, followed by the elapsed time
+        '''
+        fields = ["%s=%d" % (key, self.counts[key]) for key in sorted(self.counts)]
+        fields.extend("%s_seconds=%.3f" % (stage, self.stage_seconds[stage]) for stage in sorted(self.stage_seconds))
+        fields.append("seconds=%.3f" % (time.time() - self.start))
+        return " ".join(fields)
+
+    def record_metrics(self):
+        '''
+        Adds this request to the process-wide metrics, labelled with self.labels
+        '''
+        labels = self.labels
+        documents = self.counts.get("documents")
+        metrics.increment("hutchner_requests_total", 1, labels)
+        metrics.observe("hutchner_request_seconds", time.time() - self.start, labels)
+        metrics.observe("hutchner_request_tokens", self.counts.get("tokens", 0), labels, COUNT_BUCKETS)
+        for stage, seconds in self.stage_seconds.items():
+            stage_labels = dict(labels, stage=stage)
+            metrics.observe("hutchner_stage_seconds", seconds, stage_labels)
+            if documents:
+                metrics.observe("hutchner_stage_seconds_per_document", seconds / documents, stage_labels)
+        for key, values in self.observations.items():
+            for value in values:
+                metrics.observe("hutchner_" + key, value, labels, COUNT_BUCKETS)
+        for key, n in self.counts.items():
+            metrics.increment("hutchner_" + key + "_total", n, labels)
+
+
+@contextmanager
+def request_counters(name, logger, labels=None):
+    '''
+    Collects count(), timed() and observe() calls made by this thread while the block runs, logs them as one INFO line
+    at the end and, if the block completes without being marked failed, adds them to the /metrics histograms
+    :param name: label for the log line, e.g. the endpoint and model
+    :param logger: logger the summary is written to
+    :param labels: metric labels of the request, e.g. {"endpoint": "/ner_neg", "alg_type": "crf_ner"}
+    :return: the RequestCounters being filled
+    '''
+    counters = RequestCounters(name, labels)
+    previous = getattr(_local, "counters", None)
+    _local.counters = counters
+    completed = False
+    try:
+        yield counters
+        completed = True
+    finally:
+        _local.counters = previous
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s %s", name, counters.summary())
+        if completed and not counters.failed and labels is not None:
+            counters.record_metrics()
+
+
+def count(key, n=1):
+    '''
+    Adds to a counter of the current request; does nothing outside request_counters
+    '''
+    counters = getattr(_local, "counters", None)
+    if counters is not None:
+        counters.add(key, n)
+
+
+def observe(key, value):
+    '''
+    Records a per-item size (e.g. the tokens of one document) for the current request; does nothing outside
+    request_counters
+    '''
+    counters = getattr(_local, "counters", None)
+    if counters is not None:
+        counters.observe(key, value)
+
+
+@contextmanager
+def timed(stage):
+    '''
+    Adds the time the block takes to a pipeline stage (preprocess, featurize, decode, negation, serialize) of the
+    current request; repeated blocks of one stage add up
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        counters = getattr(_local, "counters", None)
+        if counters is not None:
+            counters.add_time(stage, time.time() - start)
@@ -0,0 +1,143 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import gc
+import logging
+import mmap
+import sys
+import threading
+import time
+import types
+
+from NERExtraction.SentenceCache import load_sentence_cache
+from NERNegation.NegEx.HutchNegEx import HutchNegEx
+from NERUtilities.Clusters import Clusters
+from NERUtilities.MiscFunctions import CLUSTER_PATH
+
+logger = logging.getLogger(__name__)
+
+# Objects that are shared by the whole interpreter and shouldn't be counted towards a resource's size
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def deep_sizeof(obj):
+    '''
+    Approximates the memory held by an object and everything it references. Memory mapped buffers count for their
+    mapped length, and views onto them are not counted again.
+    :param obj: any object
+    :return: size in bytes
+    '''
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SHARED_TYPES):
+            continue
+        seen.add(id(o))
+        if isinstance(o, mmap.mmap):
+            total += len(o)
+            continue
+        if isinstance(o, memoryview):
+            total += sys.getsizeof(o)
+            stack.append(o.obj)
+            continue
+        total += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return total
+
+
+class ResourceRegistry(object):
+    """
+    Process-wide store for the expensive, read-only objects the pipelines share (cluster tables, NegEx patterns,
+    models). A resource is registered with a loader, built the first time it is asked for (or on warmup) and then
+    handed out to every caller. Loading is serialized per resource, so concurrent requests never build it twice.
+    """
+    def __init__(self):
+        self._loaders = dict()
+        self._resources = dict()
+        self._load_seconds = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        '''
+        :param name: key the resource is fetched by
+        :param loader: function with no arguments returning the resource
+        '''
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        '''
+        Returns a resource, loading it on first use
+        :param name: key the resource was registered under
+        :return: the resource
+        '''
+        try:
+            return self._resources[name]
+        except KeyError:
+            pass
+        if name not in self._loaders:
+            raise KeyError("No resource registered as '" + name + "'")
+        with self._locks[name]:
+            if name not in self._resources:
+                start = time.time()
+                resource = self._loaders[name]()
+                self._load_seconds[name] = time.time() - start
+                self._resources[name] = resource
+                logger.info("Loaded resource '%s' in %.2fs", name, self._load_seconds[name])
+        return self._resources[name]
+
+    def is_registered(self, name):
+        return name in self._loaders
+
+    def is_loaded(self, name):
+        return name in self._resources
+
+    def warmup(self, names=None):
+        '''
+        Loads resources ahead of the first request
+        :param names: keys to load, defaults to every registered resource
+        '''
+        for name in names or list(self._loaders):
+            self.get(name)
+
+    def unload(self, name):
+        '''
+        Drops a loaded resource; the next get() loads it again
+        '''
+        with self._locks[name]:
+            self._resources.pop(name, None)
+            self._load_seconds.pop(name, None)
+
+    def report(self):
+        '''
+        Describes every registered resource
+        :return: list of {"name", "loaded", "load_seconds", "size_bytes"} dicts
+        '''
+        report = list()
+        for name in sorted(self._loaders):
+            loaded = name in self._resources
+            report.append({"name": name,
+                           "loaded": loaded,
+                           "load_seconds": self._load_seconds.get(name),
+                           "size_bytes": deep_sizeof(self._resources[name]) if loaded else 0})
+        return report
+
+
+def _load_clusters():
+    return Clusters(CLUSTER_PATH)
+
+
+def _load_negex():
+    return HutchNegEx()
+
+
+# The registry the pipelines and the web service share
+registry = ResourceRegistry()
+registry.register("clusters", _load_clusters)
+registry.register("negex", _load_negex)
+registry.register("sentence_cache", load_sentence_cache)
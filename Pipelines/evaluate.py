@@ -16,9 +16,11 @@ from DataLoading.bratDataLoading import bratDataLoader
 from LSTMExec.model import Model
 from NEREvaluation.Evaluation import NEREvaluator
 from NERExtraction.Extraction import NERExtraction
+from NERExtraction.SentencePrefilter import SentencePrefilter
 from NERUtilities import ArgumentParsingSettings
 
 from NERUtilities.DocumentPrinter import HTMLPrinter
+from NERUtilities.ResourceRegistry import registry
 
 def load_lstm_model(model_dir):
     model = Model(model_path=model_dir)
@@ -34,9 +36,11 @@ def load_lstm_model(model_dir):
 
     # Load the model
     _, f_eval = model.build(training=False, **parameters)
+    f_eval_batch = model.build_batch(**parameters)
     model.reload()
     return {"model":model,
             "f_eval":f_eval,
+            "f_eval_batch":f_eval_batch,
             "word_to_id":word_to_id,
             "char_to_id":char_to_id,
             "tag_to_id":tag_to_id,
@@ -102,6 +106,7 @@ def main():
     model_name = args.model
     model_type = args.model_type
     anno_type = args.anno_type
+    n_workers = args.n_workers
     print ('model_name:')
     print (model_name)
     # Load the documents
@@ -111,8 +116,23 @@ def main():
         text_dl = bratDataLoader(txt_dir=text_dir, annotation_dir=local_annotations)
     docs = text_dl.load()
 
+    prefilter = None
+    if args.prefilter:
+        # with the same clusters as the service, so the figures describe the classifier /ner runs
+        prefilter = SentencePrefilter.load(args.prefilter, registry.get("clusters"), args.prefilter_threshold)
+        # what each threshold would cost: recall of gold concept tokens against the share of sentences skipped
+        thresholds = sorted(set([0.001, 0.005, 0.01, 0.02, 0.05, 0.1, prefilter.threshold]))
+        for row in prefilter.measure_recall(list(docs.values()), thresholds):
+            print ("Prefilter threshold {threshold}: skips {skipped_sentences}/{sentences} sentences, "
+                   "recall {recall:.4f} of {gold_tokens} gold tokens".format(**row))
+
+        # skipped sentences aren't the whole cost: candidates are decoded without the sentences around them, so
+        # compare the tagger's own recall with and without the prefilter
+        unfiltered = NERExtraction(docs, model_name, model_type, n_workers=n_workers)
+        unfiltered_ev = NEREvaluator(unfiltered.tag_all(models=models), unfiltered.possible_labels)
+
     # Run NER driver with models and data provided in dirs
-    extractor = NERExtraction(docs, model_name, model_type)
+    extractor = NERExtraction(docs, model_name, model_type, n_workers=n_workers, prefilter=prefilter)
     tagged_documents = extractor.tag_all(models=models)    
     neg_documents = extractor.remove_negated_concepts(tagged_documents)
 
@@ -121,6 +141,14 @@ def main():
     # Evaluate the performance on TAGGED DOCUMENTS (not the negated ones)
     labels = extractor.possible_labels
     ev = NEREvaluator(tagged_documents, labels)
+    if prefilter:
+        for label in labels:
+            if label != "O":
+                print ("{0}: exact recall {1:.4f} with the prefilter, {2:.4f} without; overlap recall {3:.4f} with, "
+                       "{4:.4f} without".format(label,
+                                                ev.get_recall_by_tag(label), unfiltered_ev.get_recall_by_tag(label),
+                                                ev.get_recall_by_tag(label, strict=False),
+                                                unfiltered_ev.get_recall_by_tag(label, strict=False)))
 
     # use timestamp to link output labels and files to output results numbers
     time_stamp = time.time()
@@ -2,29 +2,22 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
+import numpy as np
 from flask import json
 
 from DataLoading.JSONDataLoader import JSONDataLoader
+from DataLoading.TokenLabels import TokenLabels
 
 
 def docs2json(docs):
     doc_dict=dict()
     for id, doc in docs.items():
-        doc_dict[doc.document_id]=dict()
-        doc_dict[doc.document_id]['text'] = doc.text
-        doc_dict[doc.document_id]['NER_labels'] = list()
-        for tok in doc.tokens:
-            if tok.ent_type_ == "":
-                entity = "O"
-            else:
-                entity = tok.ent_type_
-            doc_dict[doc.document_id]['NER_labels'].append({
-                'start':tok.idx,
-                'stop':tok.idx + len(tok.orth_),
-                'text':tok.orth_,
-                'confidence':1,
-                'label': entity
-            })
+        # spaCy's entity types, "O" outside entities
+        token_labels = TokenLabels.from_labels([tok.orth_ for tok in doc.tokens],
+                                               [(tok.idx, tok.idx + len(tok.orth_)) for tok in doc.tokens],
+                                               [tok.ent_type_ or "O" for tok in doc.tokens],
+                                               np.ones(len(doc.tokens)))
+        doc_dict[doc.document_id] = {'text': doc.text, 'NER_labels': token_labels.to_dicts()}
     return json.dumps(doc_dict, ensure_ascii=False)
 
 
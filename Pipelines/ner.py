@@ -2,18 +2,49 @@
 #
 # Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
 #
-from DataLoading.JSONDataLoader import JSONDataLoader
+from DataLoading.JSONDataLoader import JSONDataLoader, iter_ndjson_batches
 from NERExtraction.Extraction import NERExtraction
+from NERExtraction.SentencePrefilter import get_prefilter
 
+# Number of documents tagged together when streaming; small enough that the first results come back quickly
+STREAM_BATCH_SIZE = 16
 
-def main(documents, model_type, models):
+
+def _tag(documents, model_type, models, n_workers):
     text_dl = JSONDataLoader(documents=documents)
     docs = text_dl.preprocess(spacy_model=models['spacy'])
 
-    extractor = NERExtraction(docs, model_algo=model_type)
+    algo_type = "lstm" if "lstm" in model_type else "crf"
+    extractor = NERExtraction(docs, model_type, algo_type, n_workers=n_workers,
+                              prefilter=get_prefilter(model_type))
     tagged_documents = extractor.tag_all(models)
+    return extractor, tagged_documents
+
+
+def main(documents, model_type, models, n_workers=1):
+    extractor, tagged_documents = _tag(documents, model_type, models, n_workers)
     json_response = extractor.docs2json(tagged_documents)
     return json_response
 
+
+def results(documents, model_type, models, n_workers=1):
+    '''
+    :return: dict of doc_id -> response record, the unserialized form of main()'s response
+    '''
+    extractor, tagged_documents = _tag(documents, model_type, models, n_workers)
+    return dict(extractor.docs2dicts(tagged_documents))
+
+
+def stream(lines, model_type, models, n_workers=1, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Tags newline-delimited JSON documents batch by batch, yielding each document's result as soon as its batch is done
+    :param lines: iterable of NDJSON lines, each a {doc_id: text} object
+    :return: generator of NDJSON result lines, one per document, in input order
+    '''
+    for documents in iter_ndjson_batches(lines, batch_size):
+        extractor, tagged_documents = _tag(documents, model_type, models, n_workers)
+        for line in extractor.docs2ndjson(tagged_documents):
+            yield line
+
 if __name__ == '__main__':
     main(documents=None, model_type=None, models=None)
@@ -0,0 +1,43 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import json
+import time
+
+from DataLoading.i2b2DataLoading import i2b2DataLoader
+from DataLoading.bratDataLoading import bratDataLoader
+
+from NERExtraction.TrainingOrchestrator import ModelSpec, TrainingOrchestrator
+from NERUtilities import ArgumentParsingSettings
+
+
+def main():
+    """ Entry point for training several CRF models over one corpus in parallel """
+    start = time.time()
+
+    args = ArgumentParsingSettings.get_multi_training_args()
+    with open(args.models) as f:
+        specs = [ModelSpec(m["model_name"], m["labels"]) for m in json.load(f)]
+
+    # load and preprocess the data once for every model
+    if args.anno_type == 'i2b2':
+        text_dl = i2b2DataLoader(txt_dir=args.textdir, annotation_dir=args.annots, encoding="ISO-8859-1")
+    else:
+        text_dl = bratDataLoader(txt_dir=args.textdir, annotation_dir=args.annots, encoding="ISO-8859-1")
+    docs = text_dl.load()
+
+    orchestrator = TrainingOrchestrator(docs, specs, n_workers=args.n_workers)
+    orchestrator.train()
+
+    end = time.time()
+    print ("##################################")
+    print (" Training summary:\n\t " + str(len(specs)) + " models trained")
+    print (" \tTime Elapsed: " + str(int((end-start)/60))+ " minutes and " + str(int((end-start)%60)) + " seconds.")
+    for result in orchestrator.report():
+        print ("\tModel '{model_name}' written to {model_file} ({seconds:.0f}s, peak memory +{peak_rss_growth_mb:.0f} MB)"
+               .format(**result))
+    print ("##################################")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import json
+import sys
+
+from NERUtilities import ArgumentParsingSettings
+
+# Results compared stage by stage
+COMPARED_FIELDS = ["seconds", "p95_ms", "p99_ms"]
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, candidate, threshold=1.1):
+    '''
+    Matches the stages of two results files by corpus size
+    :param baseline: results of the reference commit
+    :param candidate: results of the commit under test
+    :param threshold: candidate/baseline ratio above which a field counts as a regression
+    :return: list of {"documents", "stage", "field", "baseline", "candidate", "ratio", "regression"} dicts
+    '''
+    baseline_by_size = dict((result["documents"], result) for result in baseline["results"])
+    rows = list()
+    for result in candidate["results"]:
+        reference = baseline_by_size.get(result["documents"])
+        if reference is None:
+            continue
+        for stage in candidate["settings"]["stages"]:
+            if stage not in result["stages"] or stage not in reference["stages"]:
+                continue
+            for field in COMPARED_FIELDS:
+                old, new = reference["stages"][stage][field], result["stages"][stage][field]
+                ratio = new / old if old else None
+                rows.append({"documents": result["documents"], "stage": stage, "field": field, "baseline": old,
+                             "candidate": new, "ratio": ratio, "regression": ratio is not None and ratio > threshold})
+        old, new = reference["peak_rss_mb"], result["peak_rss_mb"]
+        rows.append({"documents": result["documents"], "stage": "process", "field": "peak_rss_mb", "baseline": old,
+                     "candidate": new, "ratio": new / old if old else None,
+                     "regression": bool(old) and new / old > threshold})
+    return rows
+
+
+def main():
+    """ Entry point for comparing two benchmark results files; exits with 1 if a stage regressed """
+    args = ArgumentParsingSettings.get_benchmark_compare_args()
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline["settings"] != candidate["settings"] or baseline["models"] != candidate["models"]:
+        print ("Warning: the results were measured with different settings or models")
+    rows = compare(baseline, candidate, args.threshold)
+    print ("Baseline %s, candidate %s" % (baseline["commit"], candidate["commit"]))
+    for row in rows:
+        print ("{documents:>8} {stage:<18} {field:<12} {baseline:12.3f} {candidate:12.3f} {ratio:8.2f}{flag}"
+               .format(flag="  REGRESSION" if row["regression"] else "",
+                       **dict(row, ratio=row["ratio"] if row["ratio"] is not None else float("nan"))))
+    sys.exit(1 if any(row["regression"] for row in rows) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import standins
+from benchmarks.synthetic import LABELS, NoteGenerator, add_gold_annotations
+from DataLoading.JSONDataLoader import JSONDataLoader
+from NERExtraction.CRFDecoder import DECODE_BATCH_SIZE
+from NERExtraction.FeatureProcessing import lexical_features, sent2features, word2features
+from NERPreprocessing.DocumentPreprocessing import DEFAULT_BATCH_SIZE
+from NERPreprocessing.PreprocessingCache import CACHE_DIR_ENV
+from NERUtilities import ArgumentParsingSettings
+from NERUtilities.Clusters import Clusters
+from NERUtilities.ResourceRegistry import registry
+
+logger = logging.getLogger(__name__)
+
+# Format of the results file; bump when its fields change meaning
+RESULTS_VERSION = 1
+
+# Every stage, in pipeline order
+STAGES = ["preprocess", "word2features", "cluster_lookup", "crf_decode", "lstm_tag_document", "negation",
+          "evaluation", "docs2json"]
+
+# Notes the stand-in CRF and LSTM are built from
+STANDIN_TRAINING_NOTES = 50
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _git_revision():
+    '''
+    :return: (commit hash, whether tracked files have uncommitted changes), (None, None) outside a git checkout
+    '''
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=standins.REPO_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                         cwd=standins.REPO_DIR, stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def _batches(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def _preprocess(texts, nlp):
+    return JSONDataLoader(dict(texts)).preprocess(spacy_model=nlp, batch_size=DEFAULT_BATCH_SIZE)
+
+
+class StageTimer(object):
+    """
+    Times the stages of one benchmark run. A stage is a function applied to each of its units (a document, a batch
+    of documents or the whole corpus, as the pipeline calls it); every unit's latency is recorded over repeat passes,
+    after warmup passes that are not recorded. Stages not selected are skipped, or run once untimed when later stages
+    need their output.
+    """
+    def __init__(self, n_documents, n_tokens, repeat=3, warmup=1, stages=None):
+        self.n_documents = n_documents
+        self.n_tokens = n_tokens
+        self.repeat = repeat
+        self.warmup = warmup
+        self.stages = set(stages or STAGES)
+        self.results = dict()
+
+    def run(self, stage, fn, units, unit="document", required=False):
+        '''
+        :param stage: stage name
+        :param fn: function called on each unit
+        :param units: list of units
+        :param unit: what a unit is, for the report
+        :param required: later stages use the outputs, so an unselected stage still runs once
+        :return: the outputs of fn over units from the last pass, None if the stage was skipped
+        '''
+        if stage not in self.stages:
+            return [fn(u) for u in units] if required else None
+        rss_before = _peak_rss_mb()
+        latencies = list()
+        for p in range(self.warmup + self.repeat):
+            outputs = list()
+            for u in units:
+                start = time.perf_counter()
+                outputs.append(fn(u))
+                if p >= self.warmup:
+                    latencies.append(time.perf_counter() - start)
+        self.results[stage] = self._summarize(unit, len(units), latencies, _peak_rss_mb() - rss_before)
+        logger.info("%s: %.3fs per pass, p95 %.2fms per %s", stage, self.results[stage]["seconds"],
+                    self.results[stage]["p95_ms"], unit)
+        return outputs
+
+    def _summarize(self, unit, n_units, latencies, rss_growth_mb):
+        seconds = sum(latencies) / float(self.repeat)
+        latencies_ms = np.array(latencies) * 1000.0 if latencies else np.zeros(1)
+        return {"unit": unit,
+                "units": n_units,
+                "repeat": self.repeat,
+                "seconds": seconds,
+                "documents_per_second": self.n_documents / seconds if seconds else None,
+                "tokens_per_second": self.n_tokens / seconds if seconds else None,
+                "p50_ms": float(np.percentile(latencies_ms, 50)),
+                "p95_ms": float(np.percentile(latencies_ms, 95)),
+                "p99_ms": float(np.percentile(latencies_ms, 99)),
+                "max_ms": float(latencies_ms.max()),
+                "peak_rss_growth_mb": rss_growth_mb}
+
+
+def run_corpus(job):
+    '''
+    Benchmarks every stage on one corpus size. Meant to run in a fresh process, so that peak memory is this run's
+    :param job: dict of settings, see BenchmarkSuite.jobs
+    :return: dict of the corpus' size, memory and per-stage results
+    '''
+    logging.basicConfig(level=job["log_level"], format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # measure parsing, not the preprocessing cache
+    os.environ.pop(CACHE_DIR_ENV, None)
+    nlp, _ = standins.load_spacy_model(job["standin"])
+    clusters = Clusters(job["cluster_file"])
+    registry.register("clusters", lambda: clusters)
+    negexer = registry.get("negex")
+    decoder = standins.load_crf_decoder(job["crf_model"])
+    lstm = standins.load_lstm_model(job["lstm_model"]) \
+        if job["lstm_model"] and "lstm_tag_document" in job["stages"] else None
+    from LSTMExec.predict_lstm import tag_document
+    from NEREvaluation.Evaluation import NEREvaluator
+    from NERExtraction.Extraction import NERExtraction
+    extractor = NERExtraction(dict(), "crf_ner", "crf")
+    lexical_features.cache_clear()
+    baseline_rss_mb = _peak_rss_mb()
+
+    generator = NoteGenerator(job["tokens_per_note"], job["concept_density"], job["seed"])
+    notes = generator.corpus(job["documents"])
+    timer = StageTimer(len(notes), 0, job["repeat"], job["warmup"], job["stages"])
+
+    batches = _batches([(note.doc_id, note.text) for note in notes], DEFAULT_BATCH_SIZE)
+    docs = dict()
+    for batch_docs in timer.run("preprocess", lambda batch: _preprocess(batch, nlp), batches,
+                                "batch of %d documents" % DEFAULT_BATCH_SIZE, required=True):
+        docs.update(batch_docs)
+    add_gold_annotations(docs, notes)
+    doc_list = [docs[note.doc_id] for note in notes]
+    timer.n_tokens = sum(len(doc.tokens) for doc in doc_list)
+    if "preprocess" in timer.results:
+        timer.results["preprocess"]["tokens_per_second"] = timer.n_tokens / timer.results["preprocess"]["seconds"]
+
+    timer.run("word2features", lambda doc: [word2features(doc.tokens, i, clusters) for i in range(len(doc.tokens))],
+              doc_list)
+    timer.run("cluster_lookup", lambda doc: [clusters.cluster_lookup(token.orth_) for token in doc.tokens], doc_list)
+
+    features = [sent2features(doc.tokens, clusters) for doc in doc_list]
+    decodings = [decoding for batch in timer.run("crf_decode", decoder.decode, _batches(features, DECODE_BATCH_SIZE),
+                                                 "batch of %d documents" % DECODE_BATCH_SIZE, required=True)
+                 for decoding in batch]
+    for doc, decoding in zip(doc_list, decodings):
+        doc.set_NER_decoding(decoding.label_ids, decoding.confidences, decoder.classes)
+
+    if lstm is not None:
+        timer.run("lstm_tag_document", lambda doc: tag_document(doc, lstm["parameters"], lstm["model"], lstm["f_eval"],
+                                                                lstm["word_to_id"], lstm["char_to_id"]), doc_list)
+    timer.run("negation", negexer.negate, doc_list)
+    with contextlib.redirect_stdout(io.StringIO()):
+        # the evaluator prints its counts
+        timer.run("evaluation", lambda corpus: NEREvaluator(corpus, LABELS), [docs], "corpus")
+    timer.run("docs2json", lambda doc: extractor.docs2json({doc.document_id: doc}), doc_list)
+
+    return {"documents": len(doc_list),
+            "tokens": timer.n_tokens,
+            "concepts": sum(len(note.concepts) for note in notes),
+            "baseline_rss_mb": baseline_rss_mb,
+            "peak_rss_mb": _peak_rss_mb(),
+            "stages": timer.results}
+
+
+class BenchmarkSuite(object):
+    """
+    Runs the stage benchmarks over synthetic corpora of several sizes, each in a fresh process, and collects the
+    results with the commit and machine they were measured on. Models are the deployed ones where present and
+    stand-ins otherwise (always with standin=True): a blank spaCy English pipeline, clusters over the synthetic
+    vocabulary, and a small CRF and LSTM built from synthetic notes in work_dir.
+    """
+    def __init__(self, sizes, tokens_per_note=400, concept_density=0.1, seed=13, repeat=3, warmup=1, stages=None,
+                 standin=False, work_dir=None):
+        '''
+        :param sizes: corpus sizes, in documents
+        :param tokens_per_note: mean note length in words
+        :param concept_density: fraction of words inside concepts
+        :param seed: random seed of the generated notes
+        :param repeat: timed passes per stage
+        :param warmup: untimed passes per stage before the timed ones
+        :param stages: stages to time, defaults to STAGES
+        :param standin: use stand-ins even where the deployed models are present, so results depend only on the code
+        :param work_dir: where stand-in models are written, defaults to a temporary directory
+        '''
+        self.sizes = sorted(sizes)
+        self.tokens_per_note = tokens_per_note
+        self.concept_density = concept_density
+        self.seed = seed
+        self.repeat = repeat
+        self.warmup = warmup
+        self.stages = list(stages or STAGES)
+        self.standin = standin
+        self.work_dir = work_dir
+        self.models = dict()
+
+    def prepare_models(self, work_dir):
+        '''
+        Locates the models to benchmark and builds the missing ones
+        :return: dict of cluster_file, crf_model and lstm_model paths (lstm_model None when Theano is unavailable)
+        '''
+        nlp, self.models["spacy"] = standins.load_spacy_model(self.standin)
+        cluster_file, self.models["clusters"] = standins.cluster_file(work_dir, self.standin)
+        paths = {"cluster_file": cluster_file, "crf_model": standins.CRF_MODEL_FILE,
+                 "lstm_model": standins.LSTM_MODEL_DIR}
+        need_crf = self.standin or not os.path.exists(standins.CRF_MODEL_FILE)
+        need_lstm = self.standin or not os.path.isdir(standins.LSTM_MODEL_DIR)
+        self.models["crf"] = "stand-in: trained on synthetic notes" if need_crf else standins.CRF_MODEL_FILE
+        self.models["lstm"] = "stand-in: untrained, synthetic vocabulary" if need_lstm else standins.LSTM_MODEL_DIR
+        if need_crf or need_lstm:
+            logger.info("Building stand-in models in %s", work_dir)
+            notes = NoteGenerator(self.tokens_per_note, self.concept_density, self.seed + 1)\
+                .corpus(STANDIN_TRAINING_NOTES, prefix="train")
+            docs = _preprocess([(note.doc_id, note.text) for note in notes], nlp)
+            add_gold_annotations(docs, notes)
+            docs = [docs[note.doc_id] for note in notes]
+            if need_crf:
+                paths["crf_model"] = standins.train_standin_crf(docs, Clusters(cluster_file),
+                                                                os.path.join(work_dir, "standin.crfsuite"))
+            if need_lstm:
+                try:
+                    paths["lstm_model"] = standins.build_standin_lstm(docs, os.path.join(work_dir, "lstm"))
+                except ImportError as e:
+                    logger.warning("Skipping the LSTM stage: %s", e)
+                    self.models["lstm"] = "unavailable: " + str(e)
+                    paths["lstm_model"] = None
+        return paths
+
+    def jobs(self, paths):
+        return [dict(paths,
+                     documents=size,
+                     tokens_per_note=self.tokens_per_note,
+                     concept_density=self.concept_density,
+                     seed=self.seed,
+                     repeat=self.repeat,
+                     warmup=self.warmup,
+                     stages=self.stages,
+                     standin=self.standin,
+                     log_level=logging.getLogger().getEffectiveLevel()) for size in self.sizes]
+
+    def run(self):
+        '''
+        :return: the results document, see write()
+        '''
+        work_dir = self.work_dir or tempfile.mkdtemp(prefix="hutchner_benchmarks_")
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        start = time.time()
+        try:
+            jobs = self.jobs(self.prepare_models(work_dir))
+            # spawned rather than forked, so a run's peak memory doesn't include this process'
+            pool = multiprocessing.get_context("spawn").Pool(processes=1, maxtasksperchild=1)
+            try:
+                results = list()
+                for job, result in zip(jobs, pool.imap(run_corpus, jobs)):
+                    logger.info("%d documents benchmarked (peak memory %.0f MB)", job["documents"],
+                                result["peak_rss_mb"])
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if not self.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        commit, dirty = _git_revision()
+        return {"version": RESULTS_VERSION,
+                "commit": commit,
+                "dirty": dirty,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "seconds": time.time() - start,
+                "machine": {"python": platform.python_version(),
+                            "platform": platform.platform(),
+                            "processor": platform.processor(),
+                            "cpu_count": multiprocessing.cpu_count()},
+                "settings": {"sizes": self.sizes,
+                             "tokens_per_note": self.tokens_per_note,
+                             "concept_density": self.concept_density,
+                             "seed": self.seed,
+                             "repeat": self.repeat,
+                             "warmup": self.warmup,
+                             "stages": self.stages,
+                             "standin": self.standin},
+                "models": self.models,
+                "results": results}
+
+
+def write(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main():
+    """ Entry point for benchmarking the pipeline stages """
+    args = ArgumentParsingSettings.get_benchmark_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    suite = BenchmarkSuite([int(size) for size in args.sizes.split(",")], args.tokens, args.density, args.seed,
+                           args.repeat, args.warmup, args.stages.split(",") if args.stages else None, args.standin,
+                           args.work_dir)
+    results = suite.run()
+    write(results, args.output)
+
+    print ("##################################")
+    print (" Benchmark results (commit " + str(results["commit"]) + ") written to " + args.output)
+    for result in results["results"]:
+        print ("\t" + str(result["documents"]) + " documents, " + str(result["tokens"]) + " tokens, peak memory "
+               + "%.0f MB" % result["peak_rss_mb"])
+        for stage in STAGES:
+            if stage in result["stages"]:
+                print ("\t\t{0:<18} {1[seconds]:9.3f}s {1[tokens_per_second]:12.0f} tokens/s  p95 {1[p95_ms]:9.2f}ms  "
+                       "p99 {1[p99_ms]:9.2f}ms per {1[unit]}".format(stage, result["stages"][stage]))
+    print ("##################################")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import logging
+import os
+
+from NERExtraction.CRFDecoder import CRFDecoder
+from NERExtraction.FeatureProcessing import sent2features
+from NERExtraction.Training import CRF_PARAMS
+from NERUtilities.MiscFunctions import CLUSTER_PATH
+from benchmarks.synthetic import LABELS, write_cluster_file
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The models the web service tags with (crf_ner and lstm_ner in hutchner.py)
+CRF_MODEL_FILE = os.path.join(REPO_DIR, "NERResources", "Models", "model-test_problem_treatment.pk1")
+LSTM_MODEL_DIR = os.path.join(REPO_DIR, "LSTMExec", "models", "i2b2_fh_50_newlines")
+
+# Training iterations of the stand-in CRF; it only has to produce realistic weights, not a good model
+STANDIN_CRF_ITERATIONS = 50
+
+# Network of the stand-in LSTM: the layout of the deployed model with smaller dimensions. Its weights are left
+# untrained, which doesn't change how long a sentence takes to tag
+STANDIN_LSTM_PARAMETERS = {
+    "tag_scheme": "iob",
+    "lower": True,
+    "zeros": True,
+    "char_dim": 25,
+    "char_lstm_dim": 25,
+    "char_bidirect": True,
+    "word_dim": 50,
+    "word_lstm_dim": 50,
+    "word_bidirect": True,
+    "pre_emb": "",
+    "all_emb": False,
+    "cap_dim": 0,
+    "crf": True,
+    "dropout": 0.5,
+    "lr_method": "sgd-lr_.005",
+}
+
+
+def load_spacy_model(standin=False):
+    '''
+    :param standin: skip the installed models
+    :return: (spaCy pipeline, description). The service's en_core_sci_md or else en_core_web_sm when installed,
+             otherwise a blank English tokenizer with a rule-based sentencizer
+    '''
+    if not standin:
+        for name in ("en_core_sci_md", "en_core_web_sm"):
+            try:
+                module = __import__(name)
+            except ImportError:
+                continue
+            return module.load(), name
+    import spacy
+    nlp = spacy.blank("en")
+    try:
+        nlp.add_pipe("sentencizer")
+    except ValueError:
+        # spaCy 2 takes the component itself
+        nlp.add_pipe(nlp.create_pipe("sentencizer"))
+    return nlp, "stand-in: blank en + sentencizer"
+
+
+def cluster_file(work_dir, standin=False):
+    '''
+    :return: (cluster file path, description); the word2vec clusters if present, else clusters over the synthetic
+             vocabulary written to work_dir
+    '''
+    if not standin and os.path.exists(CLUSTER_PATH):
+        return CLUSTER_PATH, os.path.basename(CLUSTER_PATH)
+    return write_cluster_file(os.path.join(work_dir, "standin_clusters.txt")), "stand-in: synthetic vocabulary"
+
+
+def train_standin_crf(docs, clusters, model_file, max_iterations=STANDIN_CRF_ITERATIONS):
+    '''
+    Trains a small crfsuite model over annotated synthetic documents, with the regularization of
+    Training.CRF_PARAMS
+    :param docs: list of preprocessed Documents with gold annotations joined
+    :param clusters: Clusters object for the w2v cluster features
+    :param model_file: crfsuite model file to write
+    :return: model_file
+    '''
+    import pycrfsuite
+    trainer = pycrfsuite.Trainer(verbose=False)
+    trainer.set_params({"c1": CRF_PARAMS["c1"],
+                        "c2": CRF_PARAMS["c2"],
+                        "max_iterations": max_iterations,
+                        "feature.possible_transitions": CRF_PARAMS["all_possible_transitions"]})
+    for doc in docs:
+        trainer.append(sent2features(doc.tokens, clusters), doc.get_crf_training_vectors(LABELS))
+    trainer.train(model_file)
+    return model_file
+
+
+def load_crf_decoder(model_file):
+    '''
+    :param model_file: a joblib pickled sklearn_crfsuite CRF (.pkl/.pk1) or a crfsuite model file
+    :return: CRFDecoder over the model's weights
+    '''
+    if model_file.endswith((".pkl", ".pk1")):
+        from sklearn.externals import joblib
+        return CRFDecoder.for_model(joblib.load(model_file))
+    import pycrfsuite
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_file)
+    try:
+        return CRFDecoder.from_tagger(tagger)
+    finally:
+        tagger.close()
+
+
+def build_standin_lstm(docs, models_path, parameters=None):
+    '''
+    Creates and saves an LSTM-CRF model with STANDIN_LSTM_PARAMETERS and a vocabulary taken from documents
+    :param docs: list of preprocessed Documents
+    :param models_path: directory the model directory is created in
+    :return: the model directory, to be loaded with load_lstm_model
+    '''
+    from LSTMExec.model import Model
+    from LSTMExec.utils import zero_digits
+    parameters = dict(parameters or STANDIN_LSTM_PARAMETERS)
+    words, chars = set(), set()
+    for doc in docs:
+        for token in doc.tokens:
+            word = zero_digits(token.orth_.lower()) if parameters["zeros"] else token.orth_.lower()
+            words.add(word)
+            chars.update(word)
+            chars.update(token.orth_)
+    tags = ["O"] + ["%s-%s" % (prefix, label) for label in LABELS for prefix in ("B", "I")]
+    model = Model(parameters=parameters, models_path=models_path)
+    model.save_mappings(dict(enumerate(["<UNK>"] + sorted(words))), dict(enumerate(sorted(chars))),
+                        dict(enumerate(tags)))
+    model.build(training=False, **parameters)
+    model.save()
+    return model.model_path
+
+
+def load_lstm_model(model_dir):
+    '''
+    Loads an LSTM model the way the web service does
+    :return: dict of "model", "f_eval", "f_eval_batch", "word_to_id", "char_to_id", "tag_to_id", "parameters"
+    '''
+    from LSTMExec.model import Model
+    model = Model(model_path=model_dir)
+    parameters = model.parameters
+    word_to_id, char_to_id, tag_to_id = [
+        {v: k for k, v in x.items()}
+        for x in [model.id_to_word, model.id_to_char, model.id_to_tag]
+    ]
+    _, f_eval = model.build(training=False, **parameters)
+    f_eval_batch = model.build_batch(**parameters)
+    model.reload(readonly=True)
+    return {"model": model,
+            "f_eval": f_eval,
+            "f_eval_batch": f_eval_batch,
+            "word_to_id": word_to_id,
+            "char_to_id": char_to_id,
+            "tag_to_id": tag_to_id,
+            "parameters": parameters}
@@ -0,0 +1,191 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import random
+import re
+import zlib
+from collections import namedtuple
+
+from DataLoading.DataClasses import GoldAnnotation
+
+# The concept labels of the synthetic notes, as in the i2b2 problem/treatment/test model
+LABELS = ["problem", "treatment", "test"]
+
+# A generated note: its text and its gold concepts as (label, start, stop, text)
+SyntheticNote = namedtuple("SyntheticNote", ["doc_id", "text", "concepts"])
+
+LEXICON = {
+    "problem": ["hypertension", "coronary artery disease", "chest pain", "shortness of breath",
+                "type 2 diabetes mellitus", "atrial fibrillation", "pneumonia", "acute kidney injury",
+                "lower back pain", "COPD exacerbation", "nausea", "fever", "anemia", "urinary tract infection",
+                "metastatic breast cancer", "hyperlipidemia", "peripheral neuropathy", "cellulitis of the left leg"],
+    "treatment": ["aspirin 81 mg", "metoprolol", "lisinopril 10 mg daily", "insulin glargine", "albuterol nebulizer",
+                  "ceftriaxone", "physical therapy", "lumpectomy", "carboplatin", "furosemide 40 mg", "atorvastatin",
+                  "Flonase", "a nicotine patch", "IV fluids"],
+    "test": ["chest x-ray", "CBC", "basic metabolic panel", "CT of the abdomen", "echocardiogram", "troponin",
+             "hemoglobin A1c", "urinalysis", "MRI of the lumbar spine", "blood cultures", "an EKG", "a lipid panel"],
+}
+
+# Sentences mentioning concepts; {problem}, {treatment} and {test} are filled from the lexicon
+CONCEPT_TEMPLATES = [
+    "The patient is a {age}-year-old {person} with a history of {problem} and {problem}.",
+    "{Pronoun} was started on {treatment} for {problem}.",
+    "{Pronoun} denies {problem} or {problem}.",
+    "No evidence of {problem} on {test}.",
+    "{test} on {date} showed {problem}.",
+    "Continue {treatment} and follow up in {n} weeks.",
+    "{test} was within normal limits.",
+    "Negative for {problem}.",
+    "We will obtain {test} and {test} today.",
+    "{Pronoun} reports {problem} since {date}, partially relieved by {treatment}.",
+]
+
+# Sentences without concepts
+FILLER_TEMPLATES = [
+    "{Pronoun} reports doing well overall.",
+    "{Pronoun} lives at home with a spouse and is independent in activities of daily living.",
+    "Discussed the plan with the patient, who agrees.",
+    "Vital signs were reviewed.",
+    "Return to clinic as scheduled.",
+    "{Pronoun} has no further questions at this time.",
+    "Time spent with the patient was {n} minutes, more than half in counseling.",
+    "This note was dictated using voice recognition software and may contain transcription errors.",
+]
+
+SECTIONS = ["HISTORY OF PRESENT ILLNESS:", "PAST MEDICAL HISTORY:", "CURRENT MEDICATIONS:", "ALLERGIES:",
+            "REVIEW OF SYSTEMS:", "LABORATORY DATA:", "ASSESSMENT AND PLAN:"]
+
+_SLOT_RE = re.compile(r"\{(\w+)\}")
+
+
+def _words(text):
+    return len(text.split())
+
+
+class NoteGenerator(object):
+    """
+    Generates clinical-like notes with known concept spans. Note i of a corpus only depends on the seed and i, so a
+    smaller corpus is a prefix of a larger one and every run with the same settings produces the same text.
+    """
+    def __init__(self, tokens_per_note=400, concept_density=0.1, seed=13, length_jitter=0.25,
+                 sentences_per_section=6):
+        '''
+        :param tokens_per_note: mean length of a note in whitespace separated words
+        :param concept_density: target fraction of words that are inside a concept
+        :param seed: random seed
+        :param length_jitter: note lengths are drawn uniformly within this fraction of tokens_per_note
+        :param sentences_per_section: number of sentences between section headers
+        '''
+        self.tokens_per_note = tokens_per_note
+        self.concept_density = concept_density
+        self.seed = seed
+        self.length_jitter = length_jitter
+        self.sentences_per_section = sentences_per_section
+
+    def note(self, index, prefix="note"):
+        '''
+        :param index: position of the note in the corpus
+        :return: SyntheticNote
+        '''
+        rand = random.Random(self.seed * 1000003 + index)
+        target = max(1, int(self.tokens_per_note * rand.uniform(1 - self.length_jitter, 1 + self.length_jitter)))
+        pieces, concepts = list(), list()
+        offset, words, concept_words, sentences = 0, 0, 0, 0
+        while words < target:
+            if sentences % self.sentences_per_section == 0:
+                header = ("\n\n" if sentences else "") + SECTIONS[(sentences // self.sentences_per_section)
+                                                                  % len(SECTIONS)] + "\n"
+                pieces.append(header)
+                offset += len(header)
+                words += _words(header)
+            elif pieces[-1][-1] != "\n":
+                pieces.append(" ")
+                offset += 1
+            # pick a concept sentence while the note is below the target density
+            wants_concepts = concept_words < self.concept_density * max(words, 1)
+            template = rand.choice(CONCEPT_TEMPLATES if wants_concepts else FILLER_TEMPLATES)
+            sentence, sentence_concepts = self._fill(template, rand)
+            sentence = sentence[0].upper() + sentence[1:]
+            for label, start, stop, _ in sentence_concepts:
+                concepts.append((label, offset + start, offset + stop, sentence[start:stop]))
+                concept_words += _words(sentence[start:stop])
+            pieces.append(sentence)
+            offset += len(sentence)
+            words += _words(sentence)
+            sentences += 1
+        return SyntheticNote("%s_%06d" % (prefix, index), "".join(pieces), concepts)
+
+    def _fill(self, template, rand):
+        text, concepts = "", list()
+        position = 0
+        for match in _SLOT_RE.finditer(template):
+            text += template[position:match.start()]
+            slot = match.group(1)
+            if slot in LEXICON:
+                value = rand.choice(LEXICON[slot])
+                concepts.append((slot, len(text), len(text) + len(value), value))
+            else:
+                value = self._filler_value(slot, rand)
+            text += value
+            position = match.end()
+        return text + template[position:], concepts
+
+    def _filler_value(self, slot, rand):
+        if slot == "age":
+            return str(rand.randint(18, 95))
+        if slot == "person":
+            return rand.choice(["man", "woman", "patient"])
+        if slot == "Pronoun":
+            return rand.choice(["He", "She", "The patient"])
+        if slot == "date":
+            return "%02d/%02d/20%02d" % (rand.randint(1, 12), rand.randint(1, 28), rand.randint(10, 19))
+        if slot == "n":
+            return str(rand.randint(2, 40))
+        raise ValueError("Unknown template slot '" + slot + "'")
+
+    def corpus(self, n_notes, prefix="note"):
+        '''
+        :param n_notes: number of notes
+        :return: list of SyntheticNote
+        '''
+        return [self.note(i, prefix) for i in range(n_notes)]
+
+
+def add_gold_annotations(docs, notes):
+    '''
+    Joins the generated concepts to preprocessed documents as gold annotations
+    :param docs: dict of document id -> Document
+    :param notes: the SyntheticNotes the documents were made from
+    '''
+    for note in notes:
+        doc = docs[note.doc_id]
+        for label, start, stop, text in note.concepts:
+            doc.concepts_gold[label].append(GoldAnnotation(label, start, stop, text, None))
+
+
+def vocabulary():
+    '''
+    :return: sorted list of the lowercased words the generator can emit, besides numbers and dates
+    '''
+    words = set()
+    for text in [t for values in LEXICON.values() for t in values] + CONCEPT_TEMPLATES + FILLER_TEMPLATES + SECTIONS \
+            + ["He", "She", "The patient", "man", "woman"]:
+        for word in re.findall(r"[A-Za-z0-9-]+", _SLOT_RE.sub(" ", text)):
+            words.add(word.lower())
+    return sorted(words)
+
+
+def write_cluster_file(path, n_clusters=64):
+    '''
+    Writes a k-means cluster file (one "cluster id<TAB>space separated words" line per cluster) over the generator's
+    vocabulary, to stand in for the word2vec clusters. Words are assigned to clusters by a hash of their text.
+    :return: path
+    '''
+    clusters = dict()
+    for word in vocabulary() + ["0", "00", "00/00/0000"]:
+        clusters.setdefault(zlib.crc32(word.encode("utf-8")) % n_clusters, list()).append(word)
+    with open(path, "w", encoding="utf-8") as f:
+        for cluster_id in sorted(clusters):
+            f.write("%d\t%s\n" % (cluster_id, " ".join(clusters[cluster_id])))
+    return path
@@ -15,20 +15,33 @@
 # limitations under the License.
 #
 
+import logging
 import os
 
 import requests
 import sys
-from flask import Flask, make_response, jsonify, request, render_template, g, json
+from flask import Flask, make_response, jsonify, request, render_template, g, json, Response, stream_with_context
 from os.path import isfile, join
 
 from sklearn.externals import joblib
 
+from DataLoading.JSONDataLoader import MalformedNDJSON
 from Dates import date_finder
 from LSTMExec.model import Model
+from NERExtraction.SentencePrefilter import PREFILTER_KEY_SUFFIX, SentencePrefilter, prefilter_file
+from NERUtilities.JobQueue import JobQueue, JobStore
+from NERUtilities.ModelManager import ModelManager
+from NERUtilities.ProcessMemory import memory_report, prepare_for_fork
+from NERUtilities.Metrics import metrics
+from NERUtilities.RequestCoalescer import RequestCoalescer
+from NERUtilities.RequestLogging import LOG_FORMAT, request_counters
+from NERUtilities.ResourceRegistry import registry
 from Pipelines import ner_negation, ner, general_ner
 from flask_oauthlib.provider import OAuth2Provider
-import en_core_sci_md
+
+# HUTCHNER_LOG_LEVEL sets the service's log level; per-token diagnostics are logged at TRACE (5)
+logging.basicConfig(level=os.environ.get("HUTCHNER_LOG_LEVEL", "INFO"), format=LOG_FORMAT)
+logger = logging.getLogger("hutchner")
 
 ####################
 ## Preload Models ##
@@ -36,7 +49,7 @@ import en_core_sci_md
 def load_lstm_model(model_dir):
     model = Model(model_path=model_dir)
     # Load existing model
-    print ("Loading model...")
+    logger.info("Loading model...")
     parameters = model.parameters
 
     # Load reverse mappings
@@ -47,25 +60,96 @@ def load_lstm_model(model_dir):
 
     # Load the model
     _, f_eval = model.build(training=False, **parameters)
-    model.reload()
+    f_eval_batch = model.build_batch(**parameters)
+    # inference only: weights are kept as read-only arrays so forked workers share them
+    model.reload(readonly=True)
     return {"model":model,
             "f_eval":f_eval,
+            "f_eval_batch":f_eval_batch,
             "word_to_id":word_to_id,
             "char_to_id":char_to_id,
             "tag_to_id":tag_to_id,
             "parameters":parameters}
 
-# initialize large models on server startup
-spacy_model = en_core_web_sm.load()
-lstm_ner_model= load_lstm_model(model_dir=os.path.join(os.path.dirname(__file__), os.path.join("LSTMExec","models","i2b2_fh_50_newlines")))
-crf_ner_model= joblib.load(os.path.join(os.path.dirname(__file__), os.path.join("NERResources","Models", "model-test_problem_treatment.pk1")))
-crf_deid_model = joblib.load(os.path.join(os.path.dirname(__file__), os.path.join("NERResources","Models",
-                                                                                  "model-phone_number_url_or_ip_age_profession_ward_name_employer_email_medical_record_number_account_number_date_provider_name_address_and_components_patient_or_family_name_hospital_name.pk1")))
-breast_path_model = joblib.load(os.path.join(os.path.dirname(__file__), os.path.join("NERResources","Models","model-positivesentinelnodes_totalnonsentinelnodes_laterality_tubuleformation_sectiondesc_pathstaget_her2ihc_highriskfinding_pathspecimentype_pathdate_malignantfinding_er_pathsite_benignfinding.pk1")))
-breast_laterality_model = joblib.load(os.path.join(os.path.dirname(__file__), os.path.join("NERResources","Models","model-na_right_bilateral_unknown_left.pk1")))
+def _model_path(*parts):
+    return os.path.join(os.path.dirname(__file__), os.path.join("NERResources", "Models", *parts))
+
+
+def load_spacy_model():
+    import en_core_sci_md
+    return en_core_sci_md.load()
+
+
+def load_crf_model(model_file):
+    return lambda: joblib.load(_model_path(model_file))
+
+
+def register_crf_model(name, model_file):
+    '''
+    Registers a CRF model, and its sentence prefilter when HUTCHNER_PREFILTER=1 and one was saved with the model
+    (HUTCHNER_PREFILTER_THRESHOLD overrides the saved threshold). The prefilter goes in the resource registry, so it
+    stays loaded and doesn't count against HUTCHNER_MAX_MODELS
+    '''
+    models.register(name, load_crf_model(model_file))
+    path = prefilter_file(_model_path(model_file))
+    if prefilter_enabled and os.path.exists(path):
+        registry.register(name + PREFILTER_KEY_SUFFIX,
+                          lambda: SentencePrefilter.load(path, registry.get("clusters"), prefilter_threshold))
+
+
+# Models are loaded on first use. HUTCHNER_MAX_MODELS caps how many tagging models stay loaded at once (least
+# recently used is dropped first, spaCy is always kept) and HUTCHNER_PRELOAD_MODELS names the ones loaded at startup
+# ("all" for every model).
+# HUTCHNER_SHARED_PRELOAD=1 is the preload-then-fork mode for multi-process servers that import the app before
+# forking (e.g. gunicorn --preload): every model and resource is loaded in the master, nothing is ever evicted, and the
+# heap is frozen so workers share it copy-on-write
+shared_preload = os.environ.get("HUTCHNER_SHARED_PRELOAD", "0") == "1"
+prefilter_enabled = os.environ.get("HUTCHNER_PREFILTER", "0") == "1"
+prefilter_threshold = float(os.environ["HUTCHNER_PREFILTER_THRESHOLD"]) if "HUTCHNER_PREFILTER_THRESHOLD" in os.environ \
+    else None
+max_models = None if shared_preload else os.environ.get("HUTCHNER_MAX_MODELS")
+preload_models = ["all"] if shared_preload else \
+    [m.strip() for m in os.environ.get("HUTCHNER_PRELOAD_MODELS", "spacy").split(",") if m.strip()]
 
 ## IMPORTANT: if the model is an LSTM model, "lstm" MUST be found in the key name somewhere, otherwise crf is assumed
-models={"crf_ner":crf_ner_model, "lstm_ner":lstm_ner_model, "spacy":spacy_model, "deid_crf":crf_deid_model, "breast_laterality_model": breast_laterality_model, "breast_path_model":breast_path_model}
+models = ModelManager(max_resident=int(max_models) if max_models else None, pinned=["spacy"])
+models.register("spacy", load_spacy_model)
+models.register("lstm_ner", lambda: load_lstm_model(model_dir=os.path.join(os.path.dirname(__file__), os.path.join("LSTMExec","models","i2b2_fh_50_newlines"))))
+register_crf_model("crf_ner", "model-test_problem_treatment.pk1")
+register_crf_model("deid_crf", "model-phone_number_url_or_ip_age_profession_ward_name_employer_email_medical_record_number_account_number_date_provider_name_address_and_components_patient_or_family_name_hospital_name.pk1")
+register_crf_model("breast_path_model", "model-positivesentinelnodes_totalnonsentinelnodes_laterality_tubuleformation_sectiondesc_pathstaget_her2ihc_highriskfinding_pathspecimentype_pathdate_malignantfinding_er_pathsite_benignfinding.pk1")
+register_crf_model("breast_laterality_model", "model-na_right_bilateral_unknown_left.pk1")
+models.warmup(None if "all" in preload_models else preload_models)
+
+# load the cluster table and NegEx patterns now rather than on the first request
+registry.warmup()
+
+if shared_preload:
+    prepare_for_fork()
+
+# number of worker processes the CRF models tag with (1 tags in the request thread)
+crf_workers = int(os.environ.get("HUTCHNER_CRF_WORKERS", "1"))
+
+# HUTCHNER_COALESCE=1 merges concurrent /ner and /ner_neg requests for the same model into one pipeline call: a request
+# waits up to HUTCHNER_COALESCE_MAX_WAIT_MS for others, and batches hold up to HUTCHNER_COALESCE_MAX_BATCH documents
+coalescers = dict()
+if os.environ.get("HUTCHNER_COALESCE", "0") == "1":
+    max_wait = float(os.environ.get("HUTCHNER_COALESCE_MAX_WAIT_MS", "5")) / 1000
+    max_batch = int(os.environ.get("HUTCHNER_COALESCE_MAX_BATCH", "32"))
+    coalescers["ner"] = RequestCoalescer("ner", lambda documents, alg_type: ner.results(
+        documents, alg_type, models, n_workers=crf_workers), max_wait, max_batch)
+    coalescers["ner_neg"] = RequestCoalescer("ner_neg", lambda documents, alg_type: ner_negation.results(
+        documents, alg_type, models, n_workers=crf_workers), max_wait, max_batch)
+
+# Batch jobs (/jobs/...) run in HUTCHNER_JOB_WORKERS background threads, HUTCHNER_JOB_CHUNK_SIZE documents per pipeline
+# call, and are kept under HUTCHNER_JOB_DIR for HUTCHNER_JOB_RETENTION_DAYS after they finish
+job_queue = JobQueue(JobStore(os.environ.get("HUTCHNER_JOB_DIR", os.path.join(os.path.dirname(__file__), "NERResources", "Jobs"))),
+                     {"ner": lambda documents, alg_type: ner.main(documents, alg_type, models, n_workers=crf_workers),
+                      "ner_neg": lambda documents, alg_type: ner_negation.main(documents, alg_type, models,
+                                                                                n_workers=crf_workers)},
+                     n_workers=int(os.environ.get("HUTCHNER_JOB_WORKERS", "1")),
+                     chunk_size=int(os.environ.get("HUTCHNER_JOB_CHUNK_SIZE", "100")),
+                     retention=float(os.environ.get("HUTCHNER_JOB_RETENTION_DAYS", "7")) * 24 * 3600)
 
 # configs for CSS colors and headers etc
 configs = json.load(open(os.path.join(os.path.dirname(__file__),'css_configs.json'),'r'))
@@ -73,6 +157,12 @@ configs = json.load(open(os.path.join(os.path.dirname(__file__),'css_configs.jso
 app = Flask(__name__)
 oauth=OAuth2Provider(app)
 
+
+@app.before_first_request
+def start_job_workers():
+    # started here rather than at import, so that with a preloading server the threads run in the forked workers
+    job_queue.start()
+
 #################
 ### Endpoints ###
 #################
@@ -94,11 +184,13 @@ def general_ner_pipeline():
 
 @app.route('/ner/<string:alg_type>', methods=['GET'])
 def ner_pipeline(alg_type):
-    sys.stdout.write('in ner for alg type')
     documents = request.json
-    sys.stdout.write(str(type(documents)))
     if documents:
-        json_response = ner.main(documents, alg_type, models)
+        with request_counters("/ner/" + alg_type, logger, {"endpoint": "/ner", "alg_type": alg_type}):
+            if "ner" in coalescers:
+                json_response = coalescers["ner"].main(documents, alg_type)
+            else:
+                json_response = ner.main(documents, alg_type, models, n_workers=crf_workers)
         return json_response.encode('utf-8')
     else:
         return make_response(jsonify({'error': 'No data provided'}), 400)
@@ -108,11 +200,105 @@ def ner_pipeline(alg_type):
 def ner_negation_pipeline(alg_type, data=None):
     documents = data or request.json
     if documents:
-        json_response = ner_negation.main(documents, alg_type, models)
+        with request_counters("/ner_neg/" + alg_type, logger, {"endpoint": "/ner_neg", "alg_type": alg_type}):
+            if "ner_neg" in coalescers:
+                json_response = coalescers["ner_neg"].main(documents, alg_type)
+            else:
+                json_response = ner_negation.main(documents, alg_type, models, n_workers=crf_workers)
         return json_response.encode('utf-8')
     return make_response(jsonify({'error': 'No data provided'}), 400)
 
 
+def _ndjson_response(result_lines, name, labels):
+    '''
+    Streams NDJSON result lines back as they are produced. Malformed input ends the stream with an error line, since
+    the status code has already been sent by then, and keeps the request out of /metrics
+    '''
+    def generate():
+        with request_counters(name, logger, labels) as counters:
+            try:
+                for line in result_lines:
+                    yield line.encode('utf-8')
+            except MalformedNDJSON as e:
+                counters.failed = True
+                yield (json.dumps({'error': str(e)}) + "\n").encode('utf-8')
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/ner_stream/<string:alg_type>', methods=['POST'])
+def ner_stream_pipeline(alg_type):
+    return _ndjson_response(ner.stream(request.stream, alg_type, models, n_workers=crf_workers),
+                            "/ner_stream/" + alg_type, {"endpoint": "/ner_stream", "alg_type": alg_type})
+
+
+@app.route('/ner_neg_stream/<string:alg_type>', methods=['POST'])
+def ner_negation_stream_pipeline(alg_type):
+    return _ndjson_response(ner_negation.stream(request.stream, alg_type, models, n_workers=crf_workers),
+                            "/ner_neg_stream/" + alg_type, {"endpoint": "/ner_neg_stream", "alg_type": alg_type})
+
+
+@app.route('/jobs/<string:pipeline>/<string:alg_type>', methods=['POST'])
+def submit_job(pipeline, alg_type):
+    '''
+    Queues a batch of documents for the ner or ner_neg pipeline and returns the job's status right away; poll
+    /jobs/<job_id> for progress and fetch /jobs/<job_id>/results as chunks finish
+    '''
+    documents = request.json
+    if not documents:
+        return make_response(jsonify({'error': 'No data provided'}), 400)
+    if pipeline not in job_queue.pipelines or alg_type not in models:
+        return make_response(jsonify({'error': 'Unknown pipeline or model: ' + pipeline + '/' + alg_type}), 404)
+    job = job_queue.submit(pipeline, alg_type, documents)
+    response = make_response(jsonify(job), 202)
+    response.headers['Location'] = '/jobs/' + job['job_id']
+    return response
+
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.store.status(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'Unknown job ' + job_id}), 404)
+    return jsonify(job)
+
+
+@app.route('/jobs/<string:job_id>/results', methods=['GET'])
+def job_results(job_id):
+    '''
+    Results of the job's finished chunks, in the format of the synchronous endpoint; ?chunk=n returns a single chunk.
+    The X-Job-Status header says whether more are to come
+    '''
+    job = job_queue.store.status(job_id)
+    chunk = request.args.get('chunk', type=int)
+    if job is None or (chunk is not None and not 0 <= chunk < job['chunks']):
+        return make_response(jsonify({'error': 'Unknown job or chunk ' + job_id}), 404)
+    response = make_response(json.dumps(job_queue.store.results(job_id, chunk)).encode('utf-8'))
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['X-Job-Status'] = job['status']
+    return response
+
+
+@app.route('/resources', methods=['GET'])
+def resources_report():
+    sentence_cache = registry.get("sentence_cache")
+    return jsonify({"resources": registry.report(), "models": models.report(),
+                    "sentence_cache": sentence_cache.stats() if sentence_cache is not None else None})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_report():
+    '''
+    Per endpoint and alg_type latency histograms (whole request, and each stage: preprocess, featurize, decode,
+    negation, serialize), document and request sizes and the request counters, in the Prometheus text format
+    '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/memory', methods=['GET'])
+def memory_usage():
+    return jsonify(memory_report())
+
+
 @app.route('/section_detection', methods = ['GET'])
 def section_detection_pipeline():
     return jsonify({"NotImplementedError": "Section detection endpoint is not yet hooked up. Sorry!"})
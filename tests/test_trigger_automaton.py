@@ -0,0 +1,51 @@
+# Copyright (c) 2016-2017 Fred Hutchinson Cancer Research Center
+#
+# Licensed under the Apache License, Version 2.0: http://www.apache.org/licenses/LICENSE-2.0
+#
+import random
+import re
+
+import pytest
+
+from NERNegation.NegEx.HutchNegEx import HutchNegEx
+from NERNegation.NegEx.TriggerAutomaton import TriggerAutomaton, extract_anchor
+
+FILLER = ["patient", "denies", "chest", "pain", "No", "not", "fever", "CT", "evidence", "of", "mass", ",", ".",
+          "ruled", "out", "NOR", "without", "sign", "signs", "\n", "r/o", "free", "KIDNEY", "ſign", "?"]
+
+
+def _sentences(negexer, n=5000, seed=0):
+    '''
+    Every trigger phrase on its own, then seeded random filler sentences, most with a trigger phrase inserted
+    '''
+    phrases = [p['Lex'] if isinstance(p['Lex'], str) else p['Lex'].pattern for p in negexer.negation_patterns]
+    rng = random.Random(seed)
+    sentences = list(phrases)
+    for _ in range(n):
+        words = [rng.choice(FILLER) for _ in range(rng.randint(0, 12))]
+        if rng.random() < 0.7:
+            words.insert(rng.randint(0, len(words)), rng.choice(phrases))
+        sentences.append(" ".join(words) + rng.choice(["", " ", ".", "?"]))
+    return sentences
+
+
+@pytest.fixture(scope="module")
+def negexer():
+    return HutchNegEx()
+
+
+def test_matches_per_pattern_loop(negexer):
+    for sentence in _sentences(negexer):
+        assert negexer.trigger_automaton.match(sentence) == negexer._match_negation_per_pattern(sentence), sentence
+
+
+def test_case_sensitive_patterns_are_unanchored():
+    patterns = [(re.compile(r"\s*No evidence(\s+|\.)"), "DEFINITE_NEGATED_EXISTENCE", "forward"),
+                (re.compile(r"\s*denies(\s+)", re.IGNORECASE), "DEFINITE_NEGATED_EXISTENCE", "forward")]
+    assert extract_anchor(patterns[0][0]) is None
+    assert extract_anchor(patterns[1][0]) == "denies"
+    automaton = TriggerAutomaton(patterns)
+    for sentence in ["No evidence of mass. Patient DENIES pain ", "no evidence of mass.", "NO EVIDENCE."]:
+        assert automaton.match(sentence) == [(m.span(), m.group(), neg_type, direction)
+                                            for regex, neg_type, direction in patterns
+                                            for m in regex.finditer(sentence)]